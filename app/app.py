@@ -1,5 +1,7 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import traceback
+import uuid
 
 # importing experts
 import os, sys
@@ -10,19 +12,32 @@ if geode_dir not in sys.path:
 from experts.functional_experts import *
 from experts.model_experts import *  
 from experts.database_experts import *  
+from codegen.query_cache import QueryCache
+from codegen.validation import CodeValidator
+from sandbox import ExecutionPool
+from experts import tracing
 from style import *
 
 
 st.set_page_config(page_title="Geode", layout="wide", page_icon="🪨")
 
+# number of programs generated per query, the ones after the first valid one are runtime fallbacks
+NUM_CANDIDATES = int(os.environ.get('GEODE_CODEGEN_CANDIDATES', 3))
+
+FAILED_ANSWER = 'The code I generated did not run well. You can ask your question again. If problem persists, I probably cannot solve your query, given my current capabilities.'
+
 # setting up session states
 if 'generated_code' not in st.session_state:
     st.session_state['generated_code'] = [{'content': '# No code generated yet'}]
 if 'messages' not in st.session_state:
     st.session_state['messages'] = [{'role': 'assistant', 'content': 'Ask me anything geospatial!'}]
+if 'session_id' not in st.session_state:
+    # expert results of earlier turns are kept for the session in its sandbox worker, a new chat starts afresh
+    st.session_state['session_id'] = uuid.uuid4().hex
 st.session_state.latest_query = ''
 st.session_state.code_ok = None
 st.session_state.latest_patch = None
+st.session_state.timings = []
 st.session_state.error_text = None
 # st.session_state.code_model = 'gpt-3.5-turbo' 
 st.session_state.code_model = 'claude-3-opus'
@@ -54,34 +69,44 @@ def execute_code(code: str):
     # answer, patch = namespace['result'][0], namespace['result'][1]
     # return answer, patch
 
-    answer, patch = None, None
-    try:
-        namespace = globals()
-        exec(code, namespace)
-        answer, patch = namespace['result'][0], namespace['result'][1]
-        st.session_state.error_text = None
-        
-        # safeguards
-        # vector_keys = ['location', 'bbox', 'points', 'boundary']
-        # raster_keys = ['name', 'type', 'colormap', 'data']
-        # for key in vector_keys:
-        #     if key not in patch.vector_data:
-        #         patch.vector_data[key] = None
-        # for key in raster_keys:
-        #     if key not in patch.raster_data:
-        #         patch.raster_data[key] = None
-
+    # the program runs in a sandboxed worker process, with its own namespace and resource limits
+    with tracing.span('execute_code', 'sandbox', code_bytes=len(code.encode()) if code else 0):
+        answer, patch, error_text, timings = get_execution_pool().execute(code, session=st.session_state.session_id)
+    st.session_state.error_text = error_text
+    st.session_state.timings = timings
+    if error_text is None:
         return answer, patch
-    except Exception:
-        error_text = traceback.format_exc()
-        st.session_state.error_text = error_text
-
+    else:
         if answer is not None and patch is None:
             return answer, None
         elif answer is None and patch is not None:
             return 'I do not have a textual answer for your query, please check the map output instead!', patch
         elif answer is None and patch is None:
-            return 'The code I generated did not run well. You can ask your question again. If problem persists, I probably cannot solve your query, given my current capabilities.', None
+            return FAILED_ANSWER, None
+
+@st.cache_resource
+def get_execution_pool() -> ExecutionPool:
+    '''
+    Worker processes executing generated code, started once and shared by all sessions.
+    '''
+    return ExecutionPool()
+
+
+@st.cache_resource
+def get_query_cache() -> QueryCache:
+    '''
+    Programs of past queries, shared by all sessions and persisted across restarts.
+    '''
+    return QueryCache()
+
+
+@st.cache_resource
+def get_code_validator() -> CodeValidator:
+    '''
+    Static checks of generated programs against the API spec and the names the programs are executed with.
+    '''
+    return CodeValidator(known_names=list(globals()))
+
 
 def reset_chat():
     '''
@@ -119,18 +144,44 @@ def main():
             st.session_state.latest_query = query
             conversation.chat_message("user", avatar='🧑').write(query)
 
-            # generating code to solve the query
+            # generating code to solve the query, shown in the reply as it streams in
             # code = code_gen_expert(base_prompt + prompt)
-            code = code_gen_expert(query, model=st.session_state.code_model)
-            code = cleanup_code(code)
-            answer, patch = execute_code(code)
+            reply = conversation.chat_message("assistant", avatar='🪨').empty()
+            on_text = lambda text: reply.code(cleanup_code(text), language='python')
+            query_cache = get_query_cache()
+            with tracing.span('query_cache', 'cache') as cache_span:
+                code = query_cache.get(query)
+                cache_span.set(cache='miss' if code is None else 'hit')
+            if code is not None:
+                answer, patch = execute_code(code)
+                # edge case: a cached program failing for its re-bound query is dropped and the model asked instead
+                if st.session_state.error_text is not None:
+                    query_cache.remove(query)
+                    code = None
+            if code is None:
+                # candidates passing the static checks run first, the others are fallbacks if those fail at runtime
+                candidates = code_gen_expert(query, model=st.session_state.code_model, on_text=on_text, n=NUM_CANDIDATES)
+                candidates = [candidates] if isinstance(candidates, str) else candidates or []
+                candidates = [cleanup_code(candidate) for candidate in candidates if candidate is not None]
+                with tracing.span('validate', 'compute', candidates=len(candidates)):
+                    ranked = get_code_validator().rank(candidates)
+                # edge case: the model returned nothing, answered like a program that did not run
+                answer, patch = FAILED_ANSWER, None
+                st.session_state.error_text = 'No code was generated'
+                for code, _ in ranked:
+                    answer, patch = execute_code(code)
+                    if st.session_state.error_text is None:
+                        break
+            # only programs that ran through are worth reusing
+            if st.session_state.error_text is None:
+                query_cache.put(query, code)
             print(patch)
             st.session_state.latest_patch = patch
             
-            # displaying the answer and generated code, saving it
-            st.session_state.generated_code.append({'content': code}) # put generated code here
+            # displaying the answer in place of the streamed code, saving both
+            st.session_state.generated_code.append({'content': code if code is not None else '# No code was generated'}) # put generated code here
             st.session_state.messages.append({"role": "assistant", "content": answer}) # put generated answer here
-            conversation.chat_message("assistant", avatar='🪨').write(answer)
+            reply.write(answer)
 
     with right_col:
         # map output
@@ -181,10 +232,32 @@ def main():
             {st.session_state.generated_code[-1]['content']}
             """
         )
+
+        # how long each statement of the program took, statements without dependencies between them ran concurrently
+        if st.session_state.timings:
+            st.markdown("Execution timings")
+            st.dataframe(st.session_state.timings, hide_index=True)
     
     if st.session_state.error_text is not None:
         st.error(body=st.session_state.error_text)
 
 
+def show_trace(trace: tracing.Trace):
+    '''
+    Waterfall of the spans recorded while answering the latest query, with JSON and Chrome trace exports.
+    '''
+    with st.expander('Trace'):
+        rows = trace.spans()
+        components.html(trace.waterfall_html(), height=min(16 * len(rows) + 20, 600), scrolling=True)
+        json_col, chrome_col = st.columns(2)
+        json_col.download_button('Download JSON', trace.to_json(), file_name='geode_trace.json', mime='application/json')
+        chrome_col.download_button('Download Chrome trace', trace.to_chrome_trace(), file_name='geode_trace.chrome.json', mime='application/json')
+
+
 if __name__ == "__main__":
-    main()
+    # traced with GEODE_TRACE=1, from the query to the rendered map
+    with tracing.start_trace('query') as trace:
+        main()
+    if trace is not None and st.session_state.latest_query:
+        trace.root.name = st.session_state.latest_query
+        show_trace(trace)
@@ -0,0 +1,410 @@
+'''
+Dataflow execution of generated programs: the statements of compute_answer become a graph of nodes linked by the
+variables they read and write, and independent nodes (e.g. fetching two places) run concurrently on a thread pool.
+Across the turns of a session, expert calls whose subexpressions are unchanged reuse the results of earlier turns.
+'''
+import os, ast, copy, time, hashlib, builtins, threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, List, Tuple
+
+from experts import tracing
+from experts.cache import CacheEntry, MemoryBackend, freeze, shared_copy, _sizeof
+
+
+MAX_WORKERS = int(os.environ.get('GEODE_PLANNER_THREADS', 8))
+
+# how often the waiting main thread wakes up (seconds), as signals like the CPU limit of the sandbox may be delivered
+# to a busy statement thread while only the main thread can run their handlers
+SIGNAL_POLL_INTERVAL = 0.1
+
+# memory budget of the results memoized for one session (bytes)
+MEMO_MAX_BYTES = int(os.environ.get('GEODE_SESSION_MEMO_MB', 128)) << 20
+
+# methods of the API classes which only read from the object they are called on
+READ_ONLY_METHODS = {'copy', 'count', 'index', 'keys', 'values', 'items', 'get', 'area', 'bounds', 'buffer', 'contains', 'intersects', 'within', 'distance'}
+
+# statements holding control flow or scoping that are run as barriers, after everything before them and before everything after them
+BARRIER_STATEMENTS = (ast.If, ast.For, ast.AsyncFor, ast.While, ast.With, ast.AsyncWith, ast.Try, ast.FunctionDef, ast.AsyncFunctionDef,
+                      ast.ClassDef, ast.Import, ast.ImportFrom, ast.Delete, ast.Assert, ast.Raise, ast.Pass, ast.Match)
+
+
+class UnsupportedProgram(Exception):
+    pass
+
+
+def _base_name(node: ast.AST) -> str:
+    # variable at the root of an attribute or subscript chain, e.g. patch in patch.vector_data['points']
+    while isinstance(node, (ast.Attribute, ast.Subscript)):
+        node = node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def _walk_scope(node: ast.AST):
+    # nodes of a statement, without descending into nested functions or lambdas, which are only run when called
+    yield node
+    for child in ast.iter_child_nodes(node):
+        if not isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            yield from _walk_scope(child)
+
+
+class PlanNode():
+    '''
+    Statement of compute_answer with the variables it reads and writes.
+
+    Parameters
+    ----------
+        index (int): Position of the statement in compute_answer.
+        statement (ast.stmt): The statement, the final return being rewritten to an assignment of __return__.
+        source (str): Source code of the statement, for reporting.
+    '''
+    def __init__(self, index: int, statement: ast.stmt, source: str):
+        self.index = index
+        self.source = source
+        self.control = isinstance(statement, BARRIER_STATEMENTS)
+        self.statement = statement
+        self.code = compile(ast.Module(body=[statement], type_ignores=[]), '<generated>', 'exec')
+
+        self.reads, self.writes, self.mutates, self.experts = set(), set(), set(), []
+        for node in _walk_scope(statement):
+            if isinstance(node, ast.Name):
+                (self.reads if isinstance(node.ctx, ast.Load) else self.writes).add(node.id)
+            elif isinstance(node, (ast.Attribute, ast.Subscript)) and isinstance(node.ctx, (ast.Store, ast.Del)):
+                # mutating an object counts as writing the variable holding it
+                self.mutates.add(_base_name(node))
+            elif isinstance(node, ast.Call):
+                if isinstance(node.func, ast.Name) and node.func.id.endswith('_expert'):
+                    self.experts.append(node.func.id)
+                elif isinstance(node.func, ast.Attribute) and not node.func.attr.startswith('get_') and node.func.attr not in READ_ONLY_METHODS:
+                    # so does calling a method that may mutate it, e.g. patch.set_raster_data(...) or points.append(...)
+                    self.mutates.add(_base_name(node.func.value))
+                elif isinstance(node.func, ast.Name) and not hasattr(builtins, node.func.id):
+                    # or handing it to a function of the program (experts copy their inputs)
+                    self.mutates |= {arg.id for arg in node.args + [keyword.value for keyword in node.keywords] if isinstance(arg, ast.Name)}
+        # loop variables of comprehensions are local to them
+        bound = {name.id for node in _walk_scope(statement) if isinstance(node, ast.comprehension) for name in ast.walk(node.target) if isinstance(name, ast.Name)}
+        self.reads -= bound
+        self.mutates -= bound | {None}
+        self.writes = (self.writes | self.mutates) - bound
+        # the mutated object may also be reachable from other variables (e.g. raster = patch.get_raster_data()),
+        # which the names a statement reads and writes cannot tell, so mutations are ordered with every other statement
+        self.barrier = self.control or bool(self.mutates)
+        self.dependencies = set()
+
+    def timing(self, start: float, end: float, origin: float, reused: int = 0) -> Dict:
+        return {'line': self.source.splitlines()[0][:120], 'experts': self.experts, 'dependencies': sorted(self.dependencies),
+                'start': start - origin, 'duration': end - start, 'reused': reused}
+
+
+class SessionMemo():
+    '''
+    Results of expert calls made during the turns of one session, keyed by the hash of the call subexpression
+    (see expression_key), so a refined query only recomputes the calls it changed. As with cached_expert, arrays are
+    stored read-only and every call gets its own copy of the rest, so programs modifying a result do not change it
+    for later turns.
+
+    Parameters
+    ----------
+        max_bytes (int): Memory budget, least recently used results are evicted beyond it.
+    '''
+    def __init__(self, max_bytes: int = MEMO_MAX_BYTES):
+        self.store = MemoryBackend(max_bytes)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_time = 0.0
+
+    def call(self, key: str, ttl: float, compute: Callable[[], Any]) -> Tuple[Any, bool]:
+        '''
+        Stored result of a call, or the result of compute which is then stored for ttl seconds (None for ever).
+        Returns the result and whether it was reused.
+        '''
+        with self.lock:
+            entry = self.store.get(key)
+            if entry is not None and entry.expired(time.time()):
+                self.store.delete(key)
+                entry = None
+            if entry is not None:
+                self.hits += 1
+                self.saved_time += entry.compute_time
+            else:
+                self.misses += 1
+        if entry is not None:
+            return shared_copy(entry.value), True
+
+        start = time.perf_counter()
+        value = compute()
+        # failed requests are returned as None and should be retried
+        if value is not None:
+            entry = CacheEntry(freeze(value), _sizeof(value), time.perf_counter() - start, time.time() + ttl if ttl is not None else None)
+            with self.lock:
+                self.store.put(key, entry)
+        return shared_copy(value), False
+
+
+def _digest(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def _min_ttl(*ttls: float) -> float:
+    ttls = [ttl for ttl in ttls if ttl is not None]
+    return min(ttls) if ttls else None
+
+
+def expression_key(node: ast.expr, symbols: Dict[str, Tuple[str, float]], namespace: dict) -> Tuple[str, float]:
+    '''
+    Merkle hash of an expression and the lifetime of its value, or None if its value cannot be reused: constants hash
+    their value, variables the expression that produced them (symbols), and expert calls the expert name along with
+    the hashes of their arguments. Only experts memoized by cached_expert are deterministic enough to be reused, within
+    the ttl of their cache policy.
+    '''
+    if isinstance(node, ast.Constant):
+        return _digest(f'const:{node.value!r}'), None
+    elif isinstance(node, ast.Name):
+        return symbols.get(node.id)
+    elif isinstance(node, ast.UnaryOp):
+        operand = expression_key(node.operand, symbols, namespace)
+        return None if operand is None else (_digest(f'{type(node.op).__name__}({operand[0]})'), operand[1])
+    elif isinstance(node, (ast.List, ast.Tuple, ast.Dict)):
+        elements = node.elts if not isinstance(node, ast.Dict) else node.keys + node.values
+        if any(element is None or isinstance(element, ast.Starred) for element in elements):
+            return None
+        keys = [expression_key(element, symbols, namespace) for element in elements]
+        if any(key is None for key in keys):
+            return None
+        return _digest(f"{type(node).__name__}({','.join(key for key, _ in keys)})"), _min_ttl(*(ttl for _, ttl in keys))
+    elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+        expert = namespace.get(node.func.id)
+        policy = getattr(expert, 'cache_policy', None)
+        if policy is None or any(isinstance(arg, ast.Starred) for arg in node.args) or any(keyword.arg is None for keyword in node.keywords):
+            return None
+        args = [expression_key(arg, symbols, namespace) for arg in node.args]
+        kwargs = {keyword.arg: expression_key(keyword.value, symbols, namespace) for keyword in node.keywords}
+        if any(key is None for key in args + list(kwargs.values())):
+            return None
+        text = f"{node.func.id}({','.join(key for key, _ in args)};{','.join(f'{name}={key}' for name, (key, _) in sorted(kwargs.items()))})"
+        return _digest(text), _min_ttl(policy['ttl'], *(ttl for _, ttl in args + list(kwargs.values())))
+    return None
+
+
+class _MemoizeCalls(ast.NodeTransformer):
+    # rewrites reusable expert calls f(x) into __memo__(index, key, ttl, lambda: f(x)), so nested calls only run on a miss
+    def __init__(self, index: int, symbols: Dict, namespace: dict):
+        self.index = index
+        self.symbols = symbols
+        self.namespace = namespace
+        self.count = 0
+
+    def visit_Call(self, node: ast.Call) -> ast.expr:
+        key = expression_key(node, self.symbols, self.namespace)
+        node = self.generic_visit(node)
+        if key is None:
+            return node
+        self.count += 1
+        thunk = ast.Lambda(args=ast.arguments(posonlyargs=[], args=[], kwonlyargs=[], kw_defaults=[], defaults=[]), body=node)
+        memo = ast.Call(func=ast.Name(id='__memo__', ctx=ast.Load()),
+                        args=[ast.Constant(value=self.index), ast.Constant(value=key[0]), ast.Constant(value=key[1]), thunk], keywords=[])
+        return ast.copy_location(memo, node)
+
+    def _keep(self, node: ast.AST) -> ast.AST:
+        # comprehensions and lambdas bind names of their own, which the symbols know nothing about
+        return node
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_Lambda = _keep
+
+
+class ProgramPlan():
+    '''
+    Plan of a generated program of the usual shape: module level statements defining compute_answer (and maybe
+    helpers), and a single `result = compute_answer(...)` assignment. Raises UnsupportedProgram otherwise, or if
+    compute_answer returns from anywhere but its last statement, or uses global, nonlocal, yield or await.
+
+    Nodes depend on earlier nodes writing what they read, and on earlier nodes reading or writing what they write,
+    so every variable sees the same values as in sequential execution. Barrier statements (if, for, with... and
+    statements mutating an object) wait for all earlier nodes, and all later nodes wait for them.
+
+    Parameters
+    ----------
+        code (str): Generated program.
+    '''
+    def __init__(self, code: str):
+        self.module = ast.parse(code)
+        calls = [node for node in ast.walk(self.module) if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'compute_answer']
+        definitions = [node for node in self.module.body if isinstance(node, ast.FunctionDef) and node.name == 'compute_answer']
+        self.result_index = next((i for i, node in enumerate(self.module.body)
+                                  if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)
+                                  and node.targets[0].id == 'result' and node.value in calls), None)
+        if len(calls) != 1 or len(definitions) != 1 or self.result_index is None:
+            raise UnsupportedProgram('expected one compute_answer function called once, as result = compute_answer(...)')
+
+        function = definitions[0]
+        body = function.body
+        if ast.get_docstring(function) is not None:
+            body = body[1:]
+        for node in _walk_scope(ast.Module(body=body, type_ignores=[])):
+            if isinstance(node, (ast.Global, ast.Nonlocal, ast.Yield, ast.YieldFrom, ast.Await)):
+                raise UnsupportedProgram(f'{type(node).__name__.lower()} in compute_answer')
+            if isinstance(node, ast.Return) and (not body or node is not body[-1]):
+                raise UnsupportedProgram('compute_answer returns before its last statement')
+
+        # the call binds its arguments to the parameters of compute_answer through a function with the same signature
+        binder = ast.FunctionDef(name='__bind__', args=function.args, body=[ast.Return(value=ast.Call(func=ast.Name(id='locals', ctx=ast.Load()), args=[], keywords=[]))],
+                                 decorator_list=[], returns=None, type_params=[])
+        self.binder = compile(ast.fix_missing_locations(ast.Module(body=[binder], type_ignores=[])), '<generated>', 'exec')
+        call = self.module.body[self.result_index].value
+        bind_call = ast.copy_location(ast.Call(func=ast.Name(id='__bind__', ctx=ast.Load()), args=call.args, keywords=call.keywords), call)
+        self.bind_call = compile(ast.fix_missing_locations(ast.Expression(body=bind_call)), '<generated>', 'eval')
+
+        self.nodes = []
+        for index, statement in enumerate(body):
+            source = ast.get_source_segment(code, statement) or ''
+            if isinstance(statement, ast.Return):
+                value = statement.value if statement.value is not None else ast.Constant(value=None)
+                statement = ast.copy_location(ast.Assign(targets=[ast.Name(id='__return__', ctx=ast.Store())], value=value), statement)
+                ast.fix_missing_locations(statement)
+            self.nodes.append(PlanNode(index, statement, source))
+        self._link()
+        self.timings = []
+
+    def _link(self) -> None:
+        last_writer, readers_since_write, last_barrier = {}, {}, None
+        for node in self.nodes:
+            if node.barrier:
+                node.dependencies = {earlier.index for earlier in self.nodes[:node.index]}
+                last_barrier = node.index
+            else:
+                node.dependencies = {last_writer[name] for name in node.reads | node.writes if name in last_writer}
+                for name in node.writes:
+                    node.dependencies |= readers_since_write.get(name, set())
+                if last_barrier is not None:
+                    node.dependencies.add(last_barrier)
+            node.dependencies.discard(node.index)
+            for name in node.reads:
+                readers_since_write.setdefault(name, set()).add(node.index)
+            for name in node.writes:
+                last_writer[name] = node.index
+                readers_since_write[name] = set()
+
+    def _memoize(self, frame: dict, params: Dict) -> None:
+        # rewrites the statements holding reusable expert calls, following what each variable holds statement by statement
+        constants = {name: (_digest(f'arg:{value!r}'), None) for name, value in params.items() if isinstance(value, (str, int, float, bool, type(None)))}
+        symbols = dict(constants)
+        for node in self.nodes:
+            statement = node.statement
+            target = statement.targets[0].id if isinstance(statement, ast.Assign) and len(statement.targets) == 1 and isinstance(statement.targets[0], ast.Name) else None
+            target_key = expression_key(statement.value, symbols, frame) if target is not None else None
+
+            if not node.control:
+                rewritten = copy.deepcopy(statement)
+                transformer = _MemoizeCalls(node.index, symbols, frame)
+                rewritten = transformer.visit(rewritten)
+                if transformer.count:
+                    node.code = compile(ast.fix_missing_locations(ast.Module(body=[rewritten], type_ignores=[])), '<generated>', 'exec')
+
+            if node.barrier:
+                # the mutated object may be reachable from other variables (see PlanNode), only the parameters it does
+                # not rebind, which cannot be mutated, keep their keys
+                symbols = {name: key for name, key in symbols.items() if constants.get(name) == key and name not in node.writes}
+                continue
+            for name in node.writes:
+                symbols.pop(name, None)
+            if target_key is not None:
+                symbols[target] = target_key
+
+    def _run_function(self, namespace: dict, max_workers: int, memo: SessionMemo = None) -> Any:
+        # locals of compute_answer live in a frame dict used as globals, so comprehensions and lambdas see them
+        exec(self.binder, namespace)
+        frame = dict(namespace)
+        params = eval(self.bind_call, namespace)
+        frame.update(params)
+        del namespace['__bind__']
+
+        reused = Counter()
+        if memo is not None:
+            self._memoize(frame, params)
+            def memo_call(index: int, key: str, ttl: float, compute: Callable[[], Any]) -> Any:
+                value, hit = memo.call(key, ttl, compute)
+                if hit:
+                    reused[index] += 1
+                    tracing.annotate(memo_hits=reused[index])
+                return value
+            frame['__memo__'] = memo_call
+
+        origin = time.perf_counter()
+        timings, errors = {}, {}
+        waiting = {node.index: set(node.dependencies) for node in self.nodes}
+        dependents = {node.index: [other.index for other in self.nodes if node.index in other.dependencies] for node in self.nodes}
+
+        def run(node: PlanNode) -> Tuple[float, float]:
+            start = time.perf_counter()
+            with tracing.span(node.source.splitlines()[0][:80] if node.source else f'statement {node.index}', 'statement', statement=node.index):
+                exec(node.code, frame)
+            return start, time.perf_counter()
+
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='planner')
+        running = {}
+        def submit_ready():
+            for index in [index for index, deps in waiting.items() if not deps]:
+                del waiting[index]
+                running[tracing.submit(executor, run, self.nodes[index])] = index
+        try:
+            submit_ready()
+            while running:
+                done, _ = wait(running, timeout=SIGNAL_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    try:
+                        start, end = future.result()
+                        timings[index] = self.nodes[index].timing(start, end, origin, reused[index])
+                    except Exception as e:
+                        errors[index] = e
+                        continue
+                    for dependent in dependents[index]:
+                        if dependent in waiting:
+                            waiting[dependent].discard(index)
+                # nothing new starts after a failure, as sequential execution would have stopped there
+                if not errors:
+                    submit_ready()
+        except BaseException:
+            # interrupted while waiting, e.g. by the CPU limit of the sandbox: running statements cannot be stopped,
+            # so they are left behind rather than waited for, and the caller has to get rid of their threads
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+
+        self.timings = [timings[index] for index in sorted(timings)]
+        if errors:
+            raise errors[min(errors)]
+        return frame.get('__return__')
+
+    def run(self, namespace: dict, max_workers: int = MAX_WORKERS, memo: SessionMemo = None) -> Any:
+        '''
+        Executes the program in namespace, running the body of compute_answer as planned, and returns result.
+        Expert calls are looked up in and stored to memo if given.
+        '''
+        for index, statement in enumerate(self.module.body):
+            if index == self.result_index:
+                namespace['result'] = self._run_function(namespace, max_workers, memo)
+            else:
+                exec(compile(ast.Module(body=[statement], type_ignores=[]), '<generated>', 'exec'), namespace)
+        return namespace['result']
+
+
+def execute_program(code: str, namespace: dict, max_workers: int = MAX_WORKERS, memo: SessionMemo = None) -> Tuple[Any, List[Dict]]:
+    '''
+    Executes a generated program with its independent statements running concurrently, or with plain exec if the
+    program has a shape the planner does not support. With the memo of a session, expert calls unchanged since
+    earlier turns reuse their results.
+
+    Returns
+    -------
+        Tuple[Any, List[Dict]]: Value of result, and the timing of every statement of compute_answer that ran
+            (source line, experts called, dependencies, start and duration in seconds, number of reused expert calls),
+            empty after plain exec.
+    '''
+    try:
+        plan = ProgramPlan(code)
+    except UnsupportedProgram:
+        exec(code, namespace)
+        return namespace['result'], []
+    return plan.run(namespace, max_workers, memo), plan.timings
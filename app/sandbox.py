@@ -0,0 +1,266 @@
+'''
+Pool of pre-warmed worker processes executing generated code outside the Streamlit process, with CPU time,
+memory and wall-clock limits
+'''
+import os, sys, time, pickle, signal, resource, threading, traceback
+import multiprocessing
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+geode_dir = os.path.abspath(os.curdir)
+if geode_dir not in sys.path:
+    sys.path.append(geode_dir)
+
+from experts.base import GeoPatch
+from experts import tracing
+from planner import execute_program, SessionMemo
+
+
+NUM_WORKERS = int(os.environ.get('GEODE_SANDBOX_WORKERS', min(4, os.cpu_count() or 1)))
+TIMEOUT = float(os.environ.get('GEODE_SANDBOX_TIMEOUT', 120)) # wall-clock seconds per program
+CPU_SECONDS = int(os.environ.get('GEODE_SANDBOX_CPU_SECONDS', 60)) # CPU seconds per program
+MEMORY_BYTES = int(os.environ.get('GEODE_SANDBOX_MEMORY_MB', 4096)) << 20 # heap a worker may grow by beyond the loaded experts
+
+# sessions whose expert results a worker keeps, and how long a session waits for its own worker before taking another (seconds)
+SESSIONS_PER_WORKER = 8
+AFFINITY_WAIT = 2.0
+
+# modules imported once by the fork server, so every worker starts with the experts loaded
+EXPERT_MODULES = ['experts.functional_experts', 'experts.model_experts', 'experts.database_experts']
+
+
+class CPUTimeExceeded(BaseException):
+    # not an Exception, so that programs catching Exception cannot swallow it
+    pass
+
+
+def _raise_cpu_time_exceeded(signum, frame):
+    raise CPUTimeExceeded('the program ran out of CPU time')
+
+
+def _expert_namespace(modules: List[str]) -> dict:
+    # what `from experts.... import *` puts in the globals of the app
+    namespace = {'__builtins__': __builtins__}
+    for name in modules:
+        module = __import__(name, fromlist=['*'])
+        public = getattr(module, '__all__', [key for key in vars(module) if not key.startswith('_')])
+        namespace.update({key: getattr(module, key) for key in public})
+    return namespace
+
+
+def _data_size() -> int:
+    # private writable memory of the process (heap and anonymous mappings), as counted by RLIMIT_DATA
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmData:'):
+                    return int(line.split()[1]) << 10
+    except OSError:
+        pass
+    return 0
+
+
+def _limit_memory(memory_bytes: int) -> None:
+    # RLIMIT_AS would also count the address space reserved by the imported libraries (e.g. torch maps far more than
+    # it uses), making allocations fail well before the budget. RLIMIT_DATA only counts the heap and anonymous mappings,
+    # which is where arrays live, and the budget comes on top of what the experts took at import.
+    limit = _data_size() + memory_bytes
+    _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+    resource.setrlimit(resource.RLIMIT_DATA, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+
+
+def _run(code: str, namespace: dict, cpu_seconds: int, memo: SessionMemo = None) -> Tuple[Any, List[Dict]]:
+    # the CPU limit counts from the start of the worker, so it is moved forward for every program
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(usage.ru_utime + usage.ru_stime) + cpu_seconds
+    resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+    try:
+        return execute_program(code, namespace, memo=memo)
+    finally:
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+
+def _worker_main(conn, modules: List[str], cpu_seconds: int, memory_bytes: int) -> None:
+    '''
+    Executes programs received (with whether to trace them and their session) on conn, each in a fresh copy of the
+    expert namespace, and sends back (answer, serialized patch, error text, statement timings, trace spans, whether
+    the worker exits). Expert results are memoized per session, for the following turns of the session.
+    '''
+    signal.signal(signal.SIGXCPU, _raise_cpu_time_exceeded)
+    base_namespace = _expert_namespace(modules)
+    if memory_bytes > 0:
+        _limit_memory(memory_bytes)
+    memos = OrderedDict()
+
+    while True:
+        try:
+            code, trace, session = conn.recv()
+        except EOFError:
+            return
+        memo = None
+        if session is not None:
+            memo = memos.pop(session, None) or SessionMemo()
+            memos[session] = memo
+            while len(memos) > SESSIONS_PER_WORKER:
+                memos.popitem(last=False)
+        tracing.set_enabled(trace)
+        answer, patch, error_text, timings, exiting = None, None, None, [], False
+        with tracing.start_trace('sandbox'):
+            try:
+                result, timings = _run(code, dict(base_namespace), cpu_seconds, memo)
+                answer, patch = result[0], result[1]
+            except CPUTimeExceeded:
+                # statements of a planned program may still be running on threads which cannot be stopped
+                error_text, exiting = traceback.format_exc(), True
+            except Exception:
+                error_text = traceback.format_exc()
+
+            try:
+                with tracing.span('serialize_patch', 'copy', **tracing.array_size(patch)):
+                    patch = patch.to_bytes() if isinstance(patch, GeoPatch) else None
+                pickle.dumps(answer)
+            except MemoryError:
+                answer, patch, error_text = None, None, traceback.format_exc()
+            except Exception:
+                # edge case: answers which do not pickle (e.g. holding open handles) are sent as text
+                answer = None if answer is None else str(answer)
+            spans = tracing.export_spans()
+        conn.send((answer, patch, error_text, timings, spans, exiting))
+        if exiting:
+            os._exit(0) # without joining the stranded threads
+
+
+class Worker():
+    '''
+    Worker process with the pipe it receives programs on.
+    '''
+    def __init__(self, context, modules: List[str], cpu_seconds: int, memory_bytes: int):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, modules, cpu_seconds, memory_bytes), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ExecutionPool():
+    '''
+    Pre-forked worker processes executing generated programs, each program running in a fresh namespace holding
+    the experts, with its independent expert calls running concurrently (see planner.py). Workers come from a fork
+    server which imported the experts once, so starting or replacing one is cheap. A program running past its
+    wall-clock timeout has its worker killed and replaced, and so does a program running out of CPU time.
+
+    Programs of a session go to the worker which ran its previous ones, where the results of its expert calls are kept,
+    unless that worker stays busy for more than AFFINITY_WAIT seconds.
+
+    Parameters
+    ----------
+        num_workers (int): Number of worker processes, i.e. programs executed concurrently.
+        timeout (float): Wall-clock seconds a program may run.
+        cpu_seconds (int): CPU seconds a program may use.
+        memory_bytes (int): Memory a worker may allocate on top of the loaded experts, 0 for no limit.
+        modules (List[str]): Modules whose public names make up the namespace of the programs.
+    '''
+    def __init__(self, num_workers: int = NUM_WORKERS, timeout: float = TIMEOUT, cpu_seconds: int = CPU_SECONDS, memory_bytes: int = MEMORY_BYTES, modules: List[str] = EXPERT_MODULES):
+        self.modules = modules
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload(modules)
+        self.available = threading.Condition()
+        self.idle = [] # longest idle first
+        self.workers = []
+        self.affinity = OrderedDict() # session to the worker holding its memo, least recently used first
+        for _ in range(num_workers):
+            self._add_worker()
+
+    def _add_worker(self) -> None:
+        worker = Worker(self.context, self.modules, self.cpu_seconds, self.memory_bytes)
+        with self.available:
+            self.workers.append(worker)
+            self.idle.append(worker)
+            self.available.notify_all()
+
+    def _acquire(self, session: str) -> Worker:
+        deadline = time.monotonic() + AFFINITY_WAIT
+        with self.available:
+            while True:
+                preferred = self.affinity.get(session)
+                if preferred is not None and preferred not in self.workers:
+                    preferred = None # replaced after a timeout or crash, its memo is gone
+                now = time.monotonic()
+                if preferred in self.idle:
+                    worker = preferred
+                elif self.idle and (preferred is None or now >= deadline):
+                    worker = self.idle[0]
+                else:
+                    # past the deadline any worker will do, and releasing one notifies
+                    self.available.wait(timeout=deadline - now if preferred is not None and now < deadline else None)
+                    continue
+                self.idle.remove(worker)
+                if session is not None:
+                    self.affinity.pop(session, None)
+                    self.affinity[session] = worker
+                    # workers only keep the memos of their SESSIONS_PER_WORKER most recent sessions
+                    sessions = [s for s, w in self.affinity.items() if w is worker]
+                    for s in sessions[:-SESSIONS_PER_WORKER]:
+                        del self.affinity[s]
+                return worker
+
+    def _release(self, worker: Worker) -> None:
+        with self.available:
+            self.idle.append(worker)
+            self.available.notify_all()
+
+    def _replace(self, worker: Worker) -> None:
+        with self.available:
+            self.workers.remove(worker)
+            self.affinity = OrderedDict((session, w) for session, w in self.affinity.items() if w is not worker)
+        worker.kill()
+        self._add_worker()
+
+    def execute(self, code: str, session: str = None) -> Tuple[Any, GeoPatch, str, List[Dict]]:
+        '''
+        Runs a program on an idle worker, waiting for one if all are busy. Within a trace, the spans recorded by the
+        worker are attached to the current span.
+
+        Parameters
+        ----------
+            code (str): Generated program.
+            session (str): Identifier of the chat session, whose earlier expert results the program can reuse.
+
+        Returns
+        -------
+            Tuple[Any, GeoPatch, str, List[Dict]]: Answer and patch of the program's result, the error text if it failed
+                (None otherwise), and the timings of the statements of compute_answer (see planner.execute_program).
+        '''
+        worker = self._acquire(session)
+        try:
+            worker.conn.send((code, tracing.is_enabled(), session))
+            if not worker.conn.poll(self.timeout):
+                self._replace(worker)
+                return None, None, f'TimeoutError: the program did not finish within {self.timeout:g} seconds', []
+            answer, patch, error_text, timings, spans, exiting = worker.conn.recv()
+        except (EOFError, OSError):
+            # edge case: the worker died, e.g. killed by the kernel for running out of memory
+            self._replace(worker)
+            return None, None, 'The worker executing the program crashed, it probably ran out of memory', []
+        if exiting:
+            self._replace(worker)
+        else:
+            self._release(worker)
+        tracing.graft(spans)
+        with tracing.span('deserialize_patch', 'copy'):
+            patch = None if patch is None else GeoPatch.from_bytes(patch)
+        return answer, patch, error_text, timings
+
+    def close(self) -> None:
+        with self.available:
+            for worker in self.workers:
+                worker.kill()
+            self.workers = []
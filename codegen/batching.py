@@ -0,0 +1,140 @@
+'''
+Request queue grouping concurrent generation requests into batches, with backpressure and per-request timeouts
+'''
+import time, queue, threading
+from concurrent.futures import Future, TimeoutError
+from typing import Callable, Iterator, List
+
+
+class QueueFull(Exception):
+    pass
+
+
+class BatchQueue():
+    '''
+    Serves requests with a single worker thread, which waits for the first request and then gathers more for up to
+    max_wait seconds or max_batch_size requests, and runs one batched call for all of them. Streaming requests wait
+    in the same queue and are served alone.
+
+    Parameters
+    ----------
+        generate_batch (Callable[[List[str]], List[str]]): Batched generation function, one output per input.
+        max_batch_size (int): Largest number of requests in a batch.
+        max_wait (float): Longest time (seconds) the first request of a batch waits for others to join.
+        max_queue (int): Number of waiting requests beyond which new ones are rejected.
+        generate_stream (Callable[[str], Iterator[str]]): Streaming generation function yielding text chunks, for stream.
+    '''
+    def __init__(self, generate_batch: Callable[[List[str]], List[str]], max_batch_size: int = 4, max_wait: float = 0.05, max_queue: int = 32,
+                 generate_stream: Callable[[str], Iterator[str]] = None):
+        self.generate_batch = generate_batch
+        self.generate_stream = generate_stream
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue(maxsize=max_queue)
+        self.deferred = None # streaming request met while gathering a batch, served next
+        self.batch_sizes = [] # recent batch sizes, for monitoring
+
+        self.worker = threading.Thread(target=self._serve, daemon=True)
+        self.worker.start()
+
+    def submit(self, prompt: str, stream: bool = False) -> Future:
+        '''
+        Enqueues a request, raises QueueFull if too many requests are waiting. The future of a streaming request
+        holds the queue of its text chunks (ended by None, or by the exception raised) once it starts.
+        '''
+        future = Future()
+        try:
+            self.requests.put_nowait((prompt, future, stream))
+        except queue.Full:
+            raise QueueFull(f'{self.requests.maxsize} requests are already waiting')
+        return future
+
+    def generate(self, prompt: str, timeout: float = None) -> str:
+        '''
+        Enqueues a request and waits for its output, raises concurrent.futures.TimeoutError after timeout seconds.
+        '''
+        future = self.submit(prompt)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel() # dropped from its batch if not started yet
+            raise
+
+    def stream(self, prompt: str, timeout: float = None) -> Iterator[str]:
+        '''
+        Enqueues a streaming request and waits for it to start, then returns an iterator over its text chunks. The
+        request holds the worker until its last chunk, so it never runs alongside a batch. Raises QueueFull right
+        away, and concurrent.futures.TimeoutError if the request has not started (or, while iterating, finished)
+        after timeout seconds.
+        '''
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        future = self.submit(prompt, stream=True)
+        try:
+            chunks = future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+        def texts():
+            while True:
+                try:
+                    text = chunks.get(timeout=max(deadline - time.monotonic(), 0) if deadline is not None else None)
+                except queue.Empty:
+                    raise TimeoutError(f'Streaming did not finish within {timeout} seconds')
+                if text is None:
+                    return
+                if isinstance(text, Exception):
+                    raise text
+                yield text
+        return texts()
+
+    def qsize(self) -> int:
+        return self.requests.qsize()
+
+    def _next_batch(self) -> list:
+        if self.deferred is not None:
+            batch, self.deferred = [self.deferred], None
+        else:
+            batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while not batch[0][2] and len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request[2]:
+                self.deferred = request
+                break
+            batch.append(request)
+        # requests cancelled after timing out in the queue are skipped
+        return [request for request in batch if request[1].set_running_or_notify_cancel()]
+
+    def _serve_stream(self, prompt: str, future: Future) -> None:
+        chunks = queue.Queue()
+        future.set_result(chunks)
+        try:
+            for text in self.generate_stream(prompt):
+                chunks.put(text)
+            chunks.put(None)
+        except Exception as e:
+            chunks.put(e)
+
+    def _serve(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            if batch[0][2]:
+                self._serve_stream(*batch[0][:2])
+                continue
+            self.batch_sizes = (self.batch_sizes + [len(batch)])[-100:]
+            try:
+                outputs = self.generate_batch([prompt for prompt, _, _ in batch])
+                for (_, future, _), output in zip(batch, outputs):
+                    future.set_result(output)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
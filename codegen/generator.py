@@ -1,49 +1,313 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+import os, copy, time, threading
 import torch
+from typing import Iterator, List
+
+from experts.prompt import RESULT_LINE
+
+# CPU serving profile, overridable through the environment so serve.py needs no changes
+DTYPE = os.environ.get('GEODE_CODEGEN_DTYPE', 'bfloat16') # 'float32', 'bfloat16' or 'int8'
+BACKEND = os.environ.get('GEODE_CODEGEN_BACKEND', 'torch') # 'torch' or 'onnx'
+NUM_THREADS = int(os.environ.get('GEODE_CODEGEN_THREADS', 0)) # 0 to use the physical cores
+NUM_INTEROP_THREADS = int(os.environ.get('GEODE_CODEGEN_INTEROP_THREADS', 1))
+DRAFT_MODEL = os.environ.get('GEODE_CODEGEN_DRAFT') # e.g. 'mtgv/MobileLLaMA-1.4B-Chat', the small model of elaborate_expert
+
+DTYPES = ['float32', 'bfloat16', 'int8']
+BACKENDS = ['torch', 'onnx']
+
+def configure_threads(num_threads: int = NUM_THREADS, num_interop_threads: int = NUM_INTEROP_THREADS) -> None:
+    '''
+    Sets the intra-op threads (matrix multiplications, one per physical core works best) and the inter-op threads
+    (decoding runs one op at a time, so a single one avoids oversubscription).
+    '''
+    if num_threads <= 0:
+        num_threads = max(1, (os.cpu_count() or 2) // 2) # hyperthreads do not help with matmuls
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(num_interop_threads)
+    except RuntimeError: # can only be set once, before any inter-op parallel work
+        pass
+
+
+def quantize_int8(model: torch.nn.Module) -> torch.nn.Module:
+    '''
+    Dynamic int8 quantization of the linear layers of a model loaded in bfloat16, one decoder layer at a time,
+    so peak memory stays around the bfloat16 model instead of a full float32 copy.
+    '''
+    for layer in model.model.layers:
+        layer.float()
+        torch.ao.quantization.quantize_dynamic(layer, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    # embeddings, norms and the output head stay in float32
+    return model.float()
+
+
+def load_model(name: str, dtype: str) -> torch.nn.Module:
+    '''
+    Loads a causal language model on CPU straight into the target dtype.
+    '''
+    model = AutoModelForCausalLM.from_pretrained(name,
+                                         device_map="cpu",
+                                        #  device=0,
+                                         torch_dtype=torch.float32 if dtype == 'float32' else torch.bfloat16,
+                                         low_cpu_mem_usage=True, # loading straight into the target dtype
+                                         trust_remote_code=False,
+                                         revision="main")
+    if dtype == 'int8':
+        model = quantize_int8(model)
+    return model.eval()
+
+
+class ForwardCounter():
+    '''
+    Forward hook counting the calls of a model, used to estimate the acceptance rate of drafted tokens.
+    '''
+    def __init__(self, model: torch.nn.Module):
+        self.calls = 0
+        model.register_forward_hook(self)
+
+    def __call__(self, module, inputs, outputs):
+        self.calls += 1
+
+
+class StopOnResultLine(StoppingCriteria):
+    '''
+    Stops the rows whose completion contains the complete result = compute_answer(query) line.
+    Decoding the completion at every step costs far less than a forward pass of the model.
+    '''
+    def __init__(self, tokenizer, prompt_length: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        completions = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        done = [RESULT_LINE.search(completion) is not None for completion in completions]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
 
 class Generator():
-    def __init__(self):
+    '''
+    Local code generation model. The API spec in base_prompt.txt comes before the query, so its key/value cache
+    is computed once at startup and every query only prefills its own tokens.
+
+    Parameters
+    ----------
+        name (str): Hugging Face model name.
+        prompt_path (str): Prompt template, the query replaces QUERY_TAG near its end.
+        prefix_cache (bool): Reuse the key/value cache of the fixed prompt prefix across queries.
+        dtype (str): Possible values: ['float32', 'bfloat16', 'int8']. Weights of the torch backend, a 13B model takes
+            about 52 GB in float32, 26 GB in bfloat16 and 15 GB with dynamic int8 linear layers.
+        backend (str): Possible values: ['torch', 'onnx']. 'onnx' exports the model with optimum and runs it
+            with ONNX Runtime on CPU, without the prefix cache.
+        num_threads (int): Intra-op threads, 0 to use the physical cores.
+        draft_name (str): Small model sharing the tokenizer (e.g. 'mtgv/MobileLLaMA-1.4B-Chat') drafting tokens for
+            speculative decoding, None to decode with the model alone. Disables the prefix cache, requests are decoded one at a time.
+        num_assistant_tokens (int): Tokens drafted per verification step, adapted by transformers if None.
+    '''
+    def __init__(self, name: str = "WizardLM/WizardLM-13B-V1.2", prompt_path: str = 'codegen/base_prompt.txt', prefix_cache: bool = True,
+                 dtype: str = DTYPE, backend: str = BACKEND, num_threads: int = NUM_THREADS, draft_name: str = DRAFT_MODEL,
+                 num_assistant_tokens: int = None):
+        if dtype not in DTYPES:
+            raise ValueError(f"Invalid dtype. dtype must be one of {', '.join(DTYPES)}.")
+        if backend not in BACKENDS:
+            raise ValueError(f"Invalid backend. Backend must be one of {', '.join(BACKENDS)}.")
+
         # self.name = "TheBloke/WizardCoder-Python-13B-V1.0-GPTQ"
-        self.name = "WizardLM/WizardLM-13B-V1.2"
-        print(torch.cuda.get_device_name(0))
-        self.model = AutoModelForCausalLM.from_pretrained(self.name,
-                                             device_map="cpu",
-                                            #  device=0,
-                                             trust_remote_code=False,
-                                             revision="main")
-        # self.model.to(torch.device('cpu'))
-        self.model.to('cpu').float()
+        self.name = name
+        self.dtype = dtype
+        self.backend = backend
+        if torch.cuda.is_available():
+            print(torch.cuda.get_device_name(0))
+        configure_threads(num_threads)
+
+        if backend == 'onnx':
+            from optimum.onnxruntime import ORTModelForCausalLM
+            self.model = ORTModelForCausalLM.from_pretrained(self.name, export=True, use_cache=True, provider='CPUExecutionProvider')
+            prefix_cache = False # ONNX Runtime manages its own past key/values
+        else:
+            self.model = load_model(self.name, dtype)
+
+        # speculative decoding, the draft model proposes tokens that the model verifies in a single forward pass
+        self.draft_model = None
+        if draft_name is not None:
+            if backend != 'torch':
+                raise ValueError("Speculative decoding requires the 'torch' backend.")
+            self.draft_model = load_model(draft_name, dtype)
+            if num_assistant_tokens is not None:
+                self.draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+            # assisted generation prefills the draft model on the whole prompt, which does not combine with a
+            # key/value cache of the prompt prefix given to the main model only
+            prefix_cache = False
+            self.forward_counts = {'model': ForwardCounter(self.model), 'draft': ForwardCounter(self.draft_model)}
+        self.decode_stats = {'tokens': 0, 'time': 0.0, 'model_forwards': 0, 'draft_forwards': 0}
+
         self.tokenizer = AutoTokenizer.from_pretrained(self.name, use_fast=True)
-        self.pipeline = pipeline(
-                            "text-generation",
-                            model=self.model,
-                            tokenizer=self.tokenizer,
+        self.generation_kwargs = dict(
                             max_new_tokens=512,
                             do_sample=True,
                             temperature=0.7,
                             top_p=0.95,
                             top_k=40,
-                            repetition_penalty=1.1
+                            repetition_penalty=1.1,
+                            pad_token_id=self.tokenizer.eos_token_id
                         )
-        
-        with open('codegen/base_prompt.txt', 'r') as f:
+
+        with open(prompt_path, 'r') as f:
             self.base_prompt = f.read()
-        
-    def generate(self, user_query: str):
+        self.prefix, self.suffix = self.base_prompt.split('QUERY_TAG', 1)
+
+        self.lock = threading.Lock() # one generate call at a time, shared by batched and streamed requests
+        self.prefix_ids = None
+        self.prefix_cache = None
+        if prefix_cache:
+            self.build_prefix_cache()
+
+    @torch.no_grad()
+    def build_prefix_cache(self) -> None:
+        '''
+        Runs the fixed prompt prefix through the model once and keeps its key/value cache
+        '''
+        self.prefix_ids = self.tokenizer(self.prefix, return_tensors='pt').input_ids
+        self.prefix_cache = self.model(self.prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+
+    def cached_prefix_length(self, input_ids: torch.Tensor) -> int:
+        '''
+        Number of leading prompt tokens covered by the prefix cache. Tokenization may merge the last prefix token
+        with the query, so only the common leading tokens are reused, and at least one token is left to prefill.
+        '''
+        if self.prefix_cache is None:
+            return 0
+        n = min(self.prefix_ids.shape[1], input_ids.shape[1] - 1)
+        mismatch = (input_ids[0, :n] != self.prefix_ids[0, :n]).nonzero()
+        return int(mismatch[0, 0]) if len(mismatch) > 0 else n
+
+    def get_cache(self, n: int, batch_size: int = 1):
+        '''
+        Fresh copy of the prefix cache for one generate call, cropped to the first n prefix tokens and repeated for the batch
+        '''
+        if n == 0:
+            return None
+        cache = copy.deepcopy(self.prefix_cache)
+        if n < self.prefix_ids.shape[1]:
+            cache.crop(n)
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        return cache
+
+    @torch.no_grad()
+    def generate(self, user_query: str, **kwargs):
         '''
         Generate python code based on provided user query
         '''
-        prompt = self.get_prompt(user_query)
-        return self.pipeline(prompt)[0]['generated_text']
+        return self.generate_batch([user_query], **kwargs)[0]
 
-    def get_prompt(self, user_query: str) -> str:
+    def prepare_inputs(self, user_queries: List[str]) -> dict:
         '''
-        Incorporate user query into the prompt template
+        Inputs of a generate call for several user queries. The shared prompt prefix comes first, then padding,
+        then each query, so the prefix cache is reused by every row and padding is masked out.
+        '''
+        prompts = [self.tokenizer(self.get_prompt(query), return_tensors='pt').input_ids[0] for query in user_queries]
+        n = min(self.cached_prefix_length(ids[None]) for ids in prompts)
+        suffixes = [ids[n:] for ids in prompts]
+        width = max(len(suffix) for suffix in suffixes)
+
+        pad_token_id = self.generation_kwargs['pad_token_id']
+        input_ids = torch.full((len(prompts), n + width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        input_ids[:, :n] = prompts[0][:n]
+        attention_mask[:, :n] = 1
+        for i, suffix in enumerate(suffixes):
+            input_ids[i, n + width - len(suffix):] = suffix
+            attention_mask[i, n + width - len(suffix):] = 1
+
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'past_key_values': self.get_cache(n, len(prompts)),
+            'stopping_criteria': StoppingCriteriaList([StopOnResultLine(self.tokenizer, input_ids.shape[1])]),
+        }
+
+    @torch.no_grad()
+    def generate_batch(self, user_queries: List[str], **kwargs) -> List[str]:
+        '''
+        Generate python code for several user queries with a single generate call
+        '''
+        if self.draft_model is not None and len(user_queries) > 1:
+            # assisted generation only supports a batch size of 1
+            return [completion for query in user_queries for completion in self.generate_batch([query], **kwargs)]
+
+        inputs = self.prepare_inputs(user_queries)
+        with self.lock:
+            start, counts = time.perf_counter(), self._forward_counts()
+            output_ids = self.model.generate(**inputs, **self.get_generation_kwargs(**kwargs))
+            self._record(output_ids[:, inputs['input_ids'].shape[1]:], time.perf_counter() - start, counts)
+        completions = self.tokenizer.batch_decode(output_ids[:, inputs['input_ids'].shape[1]:], skip_special_tokens=True)
+        return [self.truncate(completion) for completion in completions]
+
+    def get_generation_kwargs(self, **kwargs) -> dict:
+        generation_kwargs = {**self.generation_kwargs, **kwargs}
+        if self.draft_model is not None:
+            generation_kwargs['assistant_model'] = self.draft_model
+        return generation_kwargs
+
+    def _forward_counts(self):
+        if self.draft_model is None:
+            return (0, 0)
+        return (self.forward_counts['model'].calls, self.forward_counts['draft'].calls)
+
+    def _record(self, new_ids: torch.Tensor, elapsed: float, counts) -> None:
+        model_calls, draft_calls = self._forward_counts()
+        self.decode_stats['tokens'] += int((new_ids != self.generation_kwargs['pad_token_id']).sum()) # rows finished early are padded
+        self.decode_stats['time'] += elapsed
+        self.decode_stats['model_forwards'] += model_calls - counts[0]
+        self.decode_stats['draft_forwards'] += draft_calls - counts[1]
+
+    def get_decode_stats(self) -> dict:
+        '''
+        Decoding speed since startup, and for speculative decoding the estimated share of drafted tokens accepted.
+        Every verification pass of the model accepts some drafted tokens plus one token of its own, so
+        accepted = tokens - model forwards, out of one drafted token per draft forward.
+        '''
+        stats = dict(self.decode_stats)
+        stats['tokens_per_sec'] = stats['tokens'] / stats['time'] if stats['time'] > 0 else 0.0
+        if self.draft_model is not None:
+            accepted = max(stats['tokens'] - stats['model_forwards'], 0)
+            stats['acceptance_rate'] = accepted / stats['draft_forwards'] if stats['draft_forwards'] > 0 else 0.0
+            stats['tokens_per_model_forward'] = stats['tokens'] / stats['model_forwards'] if stats['model_forwards'] > 0 else 0.0
+        return stats
+
+    def stream(self, user_query: str, **kwargs) -> Iterator[str]:
+        '''
+        Generate python code based on provided user query, yielding text chunks as they are decoded
         '''
-        prompt = self.base_prompt
-        prompt = prompt.replace('QUERY_TAG', user_query)
-        return prompt
+        inputs = self.prepare_inputs([user_query])
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
 
+        def run():
+            with self.lock, torch.no_grad():
+                start, counts = time.perf_counter(), self._forward_counts()
+                output_ids = self.model.generate(**inputs, streamer=streamer, **self.get_generation_kwargs(**kwargs))
+                self._record(output_ids[:, inputs['input_ids'].shape[1]:], time.perf_counter() - start, counts)
 
-    
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        completion, emitted = '', 0
+        for text in streamer:
+            completion += text
+            truncated = self.truncate(completion) # text decoded after the result line is dropped
+            if len(truncated) > emitted:
+                yield truncated[emitted:]
+                emitted = len(truncated)
+        thread.join()
 
+    def truncate(self, completion: str) -> str:
+        '''
+        Completion up to and including the result line, rows of a batch may keep decoding after it
+        '''
+        match = RESULT_LINE.search(completion)
+        return completion[:match.end()] if match is not None else completion
+
+    def get_prompt(self, user_query: str) -> str:
+        '''
+        Incorporate user query into the prompt template
+        '''
+        return self.prefix + user_query + self.suffix
@@ -0,0 +1,253 @@
+'''
+Persistent cache of generated programs keyed by normalized queries, with place names abstracted into slots
+so a program written for one place can be re-bound to another, and near-duplicate lookup for reworded queries
+'''
+import os, re, ast, json, hashlib, threading
+from typing import Dict, List, Tuple
+
+
+DEFAULT_CACHE_PATH = os.environ.get('GEODE_QUERY_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'geode', 'query_cache.json'))
+
+# near-duplicate queries must share this fraction of their distinct normalized tokens (Jaccard similarity)
+SIMILARITY_THRESHOLD = 0.85
+
+MAX_ENTRIES = 5000
+
+# capitalized words opening a question, not entities
+QUESTION_WORDS = {
+    'what', 'which', 'where', 'when', 'who', 'how', 'is', 'are', 'was', 'were', 'do', 'does', 'did', 'can', 'could', 'show',
+    'find', 'give', 'tell', 'list', 'plot', 'compare', 'the', 'a', 'an', 'in', 'i', 'please', 'and', 'or', 'of',
+}
+
+STOPWORDS = {'a', 'an', 'the', 'of', 'in', 'on', 'at', 'to', 'for', 'is', 'are', 'me', 'show', 'what', 'please', 'like', 'right', 'now', 'there'}
+
+# words that change the meaning of a query, near-duplicates must agree on them exactly
+CRITICAL_WORDS = {
+    'more', 'less', 'greater', 'smaller', 'larger', 'bigger', 'above', 'below', 'over', 'under', 'highest', 'lowest', 'most',
+    'least', 'max', 'min', 'maximum', 'minimum', 'not', 'no', 'without', 'both', 'either', 'hot', 'cold', 'dry', 'wet',
+}
+
+SLOT = '{{{{E{}}}}}'
+QUERY_SLOT = '{{QUERY}}'
+SLOT_PATTERN = re.compile(r'\{\{(?:QUERY|E\d+)\}\}')
+SLOT_TOKEN = re.compile(r'<e\d+>')
+
+
+def extract_entities(query: str) -> List[str]:
+    '''
+    Place names of a query: quoted strings and runs of capitalized words (e.g. "New York"), in order of appearance.
+    '''
+    entities = [m.group(1) or m.group(2) for m in re.finditer(r'"([^"]+)"|\'([^\']+)\'', query)]
+    unquoted = re.sub(r'"[^"]+"|\'[^\']+\'', ' , ', query)
+    for match in re.finditer(r"\b[A-Z][\w\-']*(?:\s+(?:(?:of|de|the)\s+)*[A-Z][\w\-']*)*", unquoted):
+        words = match.group(0).split()
+        while words and words[0].lower() in QUESTION_WORDS:
+            words = words[1:]
+        entity = ' '.join(words)
+        if entity and entity not in entities:
+            entities.append(entity)
+    return entities
+
+
+def normalize(query: str, entities: List[str]) -> List[str]:
+    '''
+    Lowercase content tokens of a query with its entities replaced by slots <e0>, <e1>...
+    '''
+    for i, entity in enumerate(entities):
+        query = query.replace(entity, f' <e{i}> ')
+    tokens = re.findall(r'<e\d+>|[a-z0-9]+(?:\.[0-9]+)?', query.lower())
+    return [token for token in tokens if token not in STOPWORDS]
+
+
+def _qualifiers(tokens: List[str]) -> List[Tuple[str, str]]:
+    # numbers and meaning changing words in order, each with the closest content word before it (e.g. the variable
+    # a threshold applies to), so "temperature above 30 and humidity below 60" differs from its swapped variant
+    qualifiers, subject = [], None
+    for token in tokens:
+        if token[0].isdigit() or token in CRITICAL_WORDS:
+            qualifiers.append((subject, token))
+        elif not SLOT_TOKEN.fullmatch(token):
+            subject = token
+    return qualifiers
+
+
+def _compatible(tokens1: List[str], tokens2: List[str]) -> bool:
+    # numbers and meaning changing words have to match exactly, in the same order and on the same words
+    return _qualifiers(tokens1) == _qualifiers(tokens2)
+
+
+def similarity(tokens1: List[str], tokens2: List[str]) -> float:
+    # on distinct tokens, word order is left to _compatible so reworded queries still match
+    set1, set2 = set(tokens1), set(tokens2)
+    if not set1 or not set2:
+        return 0.0
+    return len(set1 & set2) / len(set1 | set2)
+
+
+def _string_nodes(tree: ast.AST) -> List[ast.expr]:
+    # outermost string literals of a program, f-strings included, in source order
+    nodes = []
+    def visit(node):
+        if isinstance(node, ast.JoinedStr) or (isinstance(node, ast.Constant) and isinstance(node.value, str)):
+            nodes.append(node)
+            return
+        for child in ast.iter_child_nodes(node):
+            visit(child)
+    visit(tree)
+    return nodes
+
+
+def _map_strings(node: ast.expr, function) -> str:
+    # source of a string literal with function applied to its text, quoted and escaped by ast.unparse
+    for child in ast.walk(node):
+        if isinstance(child, ast.Constant) and isinstance(child.value, str):
+            child.value = function(child.value)
+    return ast.unparse(node)
+
+
+class QueryCache():
+    '''
+    Query to program cache persisted as JSON, only holding programs that executed successfully.
+
+    Programs are stored as templates: the query and the entities it names are replaced by slots within the string
+    literals of the program (never in its identifiers), which a hit re-binds to the entities of the new query as
+    properly escaped literals. Programs that do not mention every entity of their query in a string (e.g. the model
+    resolved "the city of the Eiffel tower" to Paris) are only reused for the very same entities.
+
+    Parameters
+    ----------
+        path (str): JSON file holding the cache.
+        spec_path (str): API spec the programs were generated from, entries of older versions of it are ignored.
+        threshold (float): Minimum similarity of near-duplicate queries.
+    '''
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, spec_path: str = 'codegen/base_prompt.txt', threshold: float = SIMILARITY_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        with open(spec_path, 'rb') as f:
+            self.spec_version = hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+
+        self.entries = {}
+        try:
+            with open(path, 'r') as f:
+                # templates of older versions of the cache were plain strings
+                self.entries = {self._key(entry['tokens'], entry['entities'], entry['rebindable']): entry for entry in json.load(f).values()
+                                if entry.get('spec_version') == self.spec_version and isinstance(entry.get('template'), list)}
+        except (OSError, ValueError):
+            pass
+        self.stats = {'hits': 0, 'near_hits': 0, 'misses': 0}
+
+    def _key(self, tokens: List[str], entities: List[str], rebindable: bool) -> str:
+        # insensitive to word order, except for the words numbers and meaning changing words apply to
+        key = ' '.join(sorted(tokens)) + ' # ' + ' '.join(f'{subject}:{word}' for subject, word in _qualifiers(tokens))
+        return key if rebindable else key + ' | ' + ' | '.join(entities)
+
+    def get(self, query: str) -> str:
+        '''
+        Program for the query re-bound to its entities, None on a miss.
+        '''
+        entities = extract_entities(query)
+        tokens = normalize(query, entities)
+        with self.lock:
+            entry = self.entries.get(self._key(tokens, entities, True)) or self.entries.get(self._key(tokens, entities, False))
+            near = False
+            if entry is None:
+                entry = self._nearest(tokens, entities)
+                near = entry is not None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['near_hits' if near else 'hits'] += 1
+        return self.bind(entry['template'], query, entities)
+
+    def _nearest(self, tokens: List[str], entities: List[str]) -> Dict:
+        best, best_score = None, self.threshold
+        for entry in self.entries.values():
+            if len(entry['entities']) != len(entities) or not _compatible(tokens, entry['tokens']):
+                continue
+            if not entry['rebindable'] and entry['entities'] != entities:
+                continue
+            score = similarity(tokens, entry['tokens'])
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    def put(self, query: str, code: str) -> None:
+        '''
+        Stores the program of a query, to be called once it has executed successfully.
+        '''
+        entities = extract_entities(query)
+        tokens = normalize(query, entities)
+        template, rebindable = self.templatize(code, query, entities)
+        key = self._key(tokens, entities, rebindable)
+        with self.lock:
+            self.entries.pop(key, None) # most recent last
+            self.entries[key] = {'tokens': tokens, 'entities': entities, 'template': template, 'rebindable': rebindable,
+                                 'query': query, 'spec_version': self.spec_version}
+            while len(self.entries) > MAX_ENTRIES:
+                self.entries.pop(next(iter(self.entries)))
+            self._save()
+
+    def remove(self, query: str) -> None:
+        '''
+        Drops the entries a query resolves to, e.g. after their program failed at runtime.
+        '''
+        entities = extract_entities(query)
+        tokens = normalize(query, entities)
+        with self.lock:
+            entry = self.entries.get(self._key(tokens, entities, True)) or self.entries.get(self._key(tokens, entities, False)) or self._nearest(tokens, entities)
+            if entry is not None:
+                self.entries = {key: e for key, e in self.entries.items() if e is not entry}
+                self._save()
+
+    @staticmethod
+    def templatize(code: str, query: str, entities: List[str]) -> Tuple[List[str], bool]:
+        '''
+        Replaces the query and its entities by slots in the string literals of a program, and tells whether every
+        entity was found. The template alternates source code and the sources of the string literals holding slots.
+        '''
+        try:
+            tree = ast.parse(code)
+        except SyntaxError:
+            return [code], False
+
+        # the query first, then the longest entities, so "New York" is not split by "York"; whole words only
+        values = {query: QUERY_SLOT, **{entity: SLOT.format(i) for i, entity in sorted(enumerate(entities), key=lambda item: -len(item[1]))}}
+        values.pop('', None)
+        if not values:
+            return [code], True
+        pattern = re.compile(r'(?<!\w)(?:' + '|'.join(map(re.escape, values)) + r')(?!\w)')
+        line_starts = [0]
+        for line in code.encode().splitlines(keepends=True):
+            line_starts.append(line_starts[-1] + len(line))
+
+        source, template, start, found = code.encode(), [], 0, set()
+        for node in _string_nodes(tree):
+            literal = _map_strings(node, lambda text: pattern.sub(lambda m: values[m.group(0)], text))
+            slots = set(SLOT_PATTERN.findall(literal))
+            if not slots:
+                continue
+            found |= slots
+            # ast offsets are in bytes of the utf-8 source
+            node_start = line_starts[node.lineno - 1] + node.col_offset
+            template += [source[start:node_start].decode(), literal]
+            start = line_starts[node.end_lineno - 1] + node.end_col_offset
+        template.append(source[start:].decode())
+        return template, all(SLOT.format(i) in found for i in range(len(entities)))
+
+    @staticmethod
+    def bind(template: List[str], query: str, entities: List[str]) -> str:
+        '''
+        Program of a template with its slots filled with the query and entities.
+        '''
+        values = {QUERY_SLOT: query, **{SLOT.format(i): entity for i, entity in enumerate(entities)}}
+        fill = lambda text: SLOT_PATTERN.sub(lambda m: values.get(m.group(0), m.group(0)), text)
+        # code and literal sources alternate
+        return ''.join(piece if i % 2 == 0 else _map_strings(ast.parse(piece, mode='eval').body, fill) for i, piece in enumerate(template))
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
@@ -1,9 +1,22 @@
 '''
 This script facilitates local hosting for the code generation model
 '''
-from flask import Flask, request, jsonify
+import os, sys, json
+geode_dir = os.path.abspath(os.curdir) # run from the repository root, as in the launch scripts
+if geode_dir not in sys.path:
+    sys.path.append(geode_dir)
+
+from flask import Flask, Response, request, jsonify, stream_with_context
 from generator import Generator 
+from batching import BatchQueue, QueueFull
 import random
+import concurrent.futures
+
+# batching of concurrent requests into a single generate call
+MAX_BATCH_SIZE = int(os.environ.get('GEODE_MAX_BATCH_SIZE', 4))
+MAX_BATCH_WAIT = float(os.environ.get('GEODE_MAX_BATCH_WAIT', 0.05)) # seconds
+MAX_QUEUE = int(os.environ.get('GEODE_MAX_QUEUE', 32)) # waiting requests beyond which new ones get a 429
+REQUEST_TIMEOUT = float(os.environ.get('GEODE_REQUEST_TIMEOUT', 600)) # seconds before a request gets a 504
 
 codes = [
 '''def solve_query():
@@ -34,6 +47,8 @@ result = solve_query()'''
 
 app = Flask(__name__)
 generator = Generator() 
+batch_queue = BatchQueue(generator.generate_batch, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT, max_queue=MAX_QUEUE,
+                         generate_stream=generator.stream)
 
 @app.route('/generate', methods=['POST'])
 def generate():
@@ -42,7 +57,12 @@ def generate():
         user_query = data.get('user_query')
 
         if user_query:
-            generated_code = generator.generate(user_query) # call the generator
+            try:
+                generated_code = batch_queue.generate(user_query, timeout=REQUEST_TIMEOUT) # call the generator
+            except QueueFull:
+                return jsonify({'error': 'Too many requests, try again later'}), 429
+            except concurrent.futures.TimeoutError: # not the TimeoutError builtin before Python 3.11
+                return jsonify({'error': 'Code generation timed out'}), 504
             # generated_code = random.choice(codes).replace('st.session_state.latest_query', f"'{user_query}'") # mocking the code generation
             # generated_code = '''raise RuntimeError('This is an error in the code')'''
             return jsonify({'generated_code': str(generated_code)}), 200
@@ -51,10 +71,41 @@ def generate():
     else:
         return jsonify({'error': 'Only POST requests are allowed'}), 405
     
+@app.route('/generate_stream', methods=['POST'])
+def generate_stream():
+    '''
+    Server-sent events with the generated code as it is decoded, one 'data' event per chunk of text
+    and a final 'done' event. Decoding stops once the result = compute_answer(query) line is complete.
+    Streams wait in the batch queue, an 'error' event ends a stream timing out once started.
+    '''
+    data = request.get_json()
+    user_query = data.get('user_query') if data is not None else None
+    if not user_query:
+        return jsonify({'error': 'User query is missing'}), 400
+
+    try:
+        texts = batch_queue.stream(user_query, timeout=REQUEST_TIMEOUT)
+    except QueueFull:
+        return jsonify({'error': 'Too many requests, try again later'}), 429
+    except concurrent.futures.TimeoutError:
+        return jsonify({'error': 'Code generation timed out'}), 504
+
+    def events():
+        try:
+            for text in texts:
+                yield f"data: {json.dumps({'text': text})}\n\n"
+        except concurrent.futures.TimeoutError:
+            yield f"event: error\ndata: {json.dumps({'error': 'Code generation timed out'})}\n\n"
+            return
+        yield 'event: done\ndata: {}\n\n'
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 @app.route('/active', methods=['GET'])
 def is_active():
     if request.method == 'GET':
         return jsonify(None), 200
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # threaded so concurrent requests can wait in the batch queue together, no debug reloader loading the model twice
+    app.run(debug=False, threaded=True)
@@ -0,0 +1,127 @@
+'''
+Static checks of generated programs against the expert API spec, so broken candidates are caught before execution
+'''
+import ast
+import builtins
+from typing import Dict, Iterable, List, Tuple
+
+from experts.prompt import extract_prompt_entries
+
+
+class Signature():
+    '''
+    Parameters of an expert as declared in the API spec.
+
+    Parameters
+    ----------
+        node (ast.FunctionDef): Definition of the expert in the spec.
+    '''
+    def __init__(self, node: ast.FunctionDef):
+        args = node.args
+        self.name = node.name
+        self.positional = [arg.arg for arg in args.posonlyargs + args.args]
+        self.keyword_only = [arg.arg for arg in args.kwonlyargs]
+        self.required = set(self.positional[:len(self.positional) - len(args.defaults)])
+        self.required |= {arg.arg for arg, default in zip(args.kwonlyargs, args.kw_defaults) if default is None}
+        self.var_positional = args.vararg is not None
+        self.var_keyword = args.kwarg is not None
+
+    def check(self, call: ast.Call) -> List[str]:
+        '''
+        Problems binding the arguments of a call to the parameters, empty if the call is fine.
+        '''
+        # edge case: starred arguments are only known at runtime
+        if any(isinstance(arg, ast.Starred) for arg in call.args) or any(keyword.arg is None for keyword in call.keywords):
+            return []
+
+        errors = []
+        if len(call.args) > len(self.positional) and not self.var_positional:
+            errors.append(f'{self.name}() takes {len(self.positional)} positional arguments but {len(call.args)} were given')
+        bound = set(self.positional[:len(call.args)])
+        for keyword in call.keywords:
+            if keyword.arg in bound:
+                errors.append(f'{self.name}() got multiple values for argument {keyword.arg!r}')
+            elif keyword.arg not in self.positional and keyword.arg not in self.keyword_only and not self.var_keyword:
+                errors.append(f'{self.name}() got an unexpected keyword argument {keyword.arg!r}')
+            bound.add(keyword.arg)
+        missing = sorted(self.required - bound)
+        if missing:
+            errors.append(f"{self.name}() missing required arguments: {', '.join(map(repr, missing))}")
+        return errors
+
+
+def _bound_names(tree: ast.AST) -> set:
+    # names a program defines itself: functions, classes, imports, assignment and loop targets, parameters
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names |= {(alias.asname or alias.name).split('.')[0] for alias in node.names}
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+    return names
+
+
+class CodeValidator():
+    '''
+    Validates generated programs with ast, without running them: the code parses, defines compute_answer and
+    assigns result, only calls known functions, and calls the experts with arguments matching their signatures.
+
+    Parameters
+    ----------
+        prompt_path (str): Prompt template with the API spec the programs were generated from.
+        known_names (Iterable[str]): Names available to the programs at runtime on top of builtins and the spec,
+            e.g. the globals of the namespace they are executed in.
+    '''
+    def __init__(self, prompt_path: str = 'codegen/base_prompt.txt', known_names: Iterable[str] = ()):
+        header, entries, _ = extract_prompt_entries(prompt_path)
+        self.signatures = {}
+        for name, entry in entries.items():
+            node = ast.parse(entry).body[0]
+            self.signatures[name] = Signature(node)
+
+        # helper classes of the spec (GeoPatch, DataPoint...), skipping the lines of prose around them
+        self.known_names = set(dir(builtins)) | set(known_names) | set(self.signatures)
+        for line in header.splitlines():
+            if line.startswith('class '):
+                self.known_names.add(line[len('class '):].split('(')[0].split(':')[0].strip())
+
+    def validate(self, code: str) -> List[str]:
+        '''
+        Problems found in a program, empty if it looks runnable.
+        '''
+        if code is None or not code.strip():
+            return ['no code was generated']
+        try:
+            tree = ast.parse(code)
+        except SyntaxError as e:
+            return [f'syntax error at line {e.lineno}: {e.msg}']
+
+        errors = []
+        if not any(isinstance(node, ast.FunctionDef) and node.name == 'compute_answer' for node in tree.body):
+            errors.append('compute_answer is not defined')
+        if not any(isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == 'result' for target in node.targets) for node in tree.body):
+            errors.append('result is not assigned')
+
+        known_names = self.known_names | _bound_names(tree)
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Name):
+                continue
+            name = node.func.id
+            if name in self.signatures:
+                errors += [f'line {node.lineno}: {error}' for error in self.signatures[name].check(node)]
+            elif name not in known_names:
+                errors.append(f'line {node.lineno}: unknown function {name}()')
+        return errors
+
+    def rank(self, candidates: List[str]) -> List[Tuple[str, List[str]]]:
+        '''
+        Candidates paired with their problems, valid ones first and otherwise in the given order.
+        '''
+        checked = [(code, self.validate(code)) for code in candidates]
+        return sorted(checked, key=lambda item: len(item[1]) > 0)
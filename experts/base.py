@@ -4,14 +4,20 @@ This is where the base classes are defined, which the API interacts with
 import sys
 sys.path.append('../')
 
+import copy
+import hashlib
+import pickle
 import numpy as np
+import shapely
 from PIL import Image
-from typing import List, Union, Dict
+from typing import List, Union, Dict, Tuple
 from enum import Enum
 from shapely.geometry.polygon import Polygon, Point
 from scipy.interpolate import Rbf
 import random
 from pprint import pformat
+from .grid import CellUnion, cover, auto_level
+from . import tracing
 
 
 class PatchType(Enum):
@@ -86,6 +92,129 @@ class GeoPatch():
     def __str__(self):
         return f"GeoPatch(\n\ttype = {self.type},\n\traster_data = {pformat(self.raster_data, indent=2)},\n\tvector_data = {pformat(self.vector_data, indent=2)}\n)"
 
+    def __deepcopy__(self, memo: Dict) -> 'GeoPatch':
+        # same as the default deep copy, recorded as a span since copies of large rasters add up
+        with tracing.span('deepcopy', 'copy', **tracing.array_size(self)):
+            patch = GeoPatch.__new__(GeoPatch)
+            memo[id(self)] = patch
+            data = self.raster_data.get('data') if isinstance(self.raster_data, dict) else None
+            if isinstance(data, np.ndarray) and memo.get(id(data)) is data and _is_read_only(data):
+                # copies sharing a read-only raster (see cache.shared_copy) share its hash, computed once for all
+                if self.__dict__.get('_raster_hash', {}).get('data') is not data:
+                    self._raster_hash = {'data': data, 'digest': None}
+                memo[id(self._raster_hash)] = self._raster_hash
+            for key, value in self.__dict__.items():
+                setattr(patch, key, copy.deepcopy(value, memo))
+            return patch
+
+    def get_fingerprint(self) -> str:
+        '''
+        Computes a content hash of the raster and vector data within the patch, used to key caches.
+        The hash of a read-only raster (e.g. returned by a cached expert) is computed once and kept on the patch.
+
+        Returns
+        -------
+        str: Hex digest identifying the contents of the patch.
+        '''
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr(self.type).encode())
+
+        if self.raster_data is not None:
+            for key in ('name', 'type', 'colormap'):
+                h.update(repr(self.raster_data.get(key)).encode())
+            data = self.raster_data.get('data')
+            if isinstance(data, np.ndarray):
+                h.update(self._raster_digest(data))
+            elif data is not None:
+                h.update(np.asarray(data).tobytes())
+
+        if self.vector_data is not None:
+            h.update(repr(self.vector_data.get('location')).encode())
+            h.update(repr(self.vector_data.get('bbox')).encode())
+            h.update(self.get_boundary_digest() or b'')
+            points = self.vector_data.get('points')
+            if points is not None:
+                for point in points:
+                    h.update(repr((point.point.x, point.point.y, point.name, point.data)).encode())
+
+        return h.hexdigest()
+
+    def _raster_digest(self, data: np.ndarray) -> bytes:
+        cached = self.__dict__.get('_raster_hash')
+        if cached is not None and cached['data'] is data and cached['digest'] is not None and _is_read_only(data):
+            return cached['digest']
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f'{data.dtype}{data.shape}'.encode())
+        h.update(np.ascontiguousarray(data).view(np.uint8).data)
+        digest = h.digest()
+        # only arrays whose memory cannot be written to keep their hash, writable ones may change in place
+        if _is_read_only(data):
+            if cached is not None and cached['data'] is data:
+                cached['digest'] = digest
+            else:
+                self._raster_hash = {'data': data, 'digest': digest}
+        return digest
+
+    def get_boundary_digest(self) -> bytes:
+        '''
+        Content hash of the boundary polygons, None if the patch has no boundary. Shapely geometries are immutable, so
+        the hash is kept on the patch until the list holds other polygons, and keys the caches derived from the boundary
+        (fingerprint, boundary mask, cell covers).
+        '''
+        boundary = self.vector_data.get('boundary') if self.vector_data is not None else None
+        if boundary is None:
+            return None
+        polygons = tuple(boundary)
+        cached = self.__dict__.get('_boundary_hash')
+        # holding the polygons themselves, so identities are never those of freed polygons
+        if cached is not None and len(cached[0]) == len(polygons) and all(a is b for a, b in zip(cached[0], polygons)):
+            return cached[1]
+        h = hashlib.blake2b(digest_size=16)
+        for wkb in shapely.to_wkb(np.asarray(polygons, dtype=object)):
+            h.update(wkb)
+        self._boundary_hash = (polygons, h.digest())
+        return self._boundary_hash[1]
+
+    def to_bytes(self) -> bytes:
+        '''
+        Compact serialization of the patch, to pass it between processes: enums as values, boundaries as WKB,
+        data points as tuples, and none of the caches kept on the patch.
+
+        Returns
+        -------
+        bytes: Serialized patch, read back with GeoPatch.from_bytes.
+        '''
+        raster_data, vector_data = None, None
+        if self.raster_data is not None:
+            raster_data = dict(self.raster_data)
+            if isinstance(raster_data.get('type'), RasterType):
+                raster_data['type'] = raster_data['type'].value
+            if raster_data.get('data') is not None and not isinstance(raster_data['data'], np.ndarray):
+                raster_data['data'] = np.asarray(raster_data['data'])
+        if self.vector_data is not None:
+            vector_data = dict(self.vector_data)
+            if vector_data.get('boundary') is not None:
+                vector_data['boundary'] = list(shapely.to_wkb(np.asarray(vector_data['boundary'], dtype=object)))
+            if vector_data.get('points') is not None:
+                vector_data['points'] = [(p.point.x, p.point.y, p.name, p.data) for p in vector_data['points']]
+        patch_type = self.type.value if isinstance(self.type, PatchType) else self.type
+        return pickle.dumps((patch_type, raster_data, vector_data), protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def from_bytes(serialized: bytes) -> 'GeoPatch':
+        '''
+        Rebuilds a patch serialized with to_bytes.
+        '''
+        patch_type, raster_data, vector_data = pickle.loads(serialized)
+        if raster_data is not None and isinstance(raster_data.get('type'), int):
+            raster_data['type'] = RasterType(raster_data['type'])
+        if vector_data is not None:
+            if vector_data.get('boundary') is not None:
+                vector_data['boundary'] = list(shapely.from_wkb(vector_data['boundary']))
+            if vector_data.get('points') is not None:
+                vector_data['points'] = [DataPoint(x, y, name=name, data=data) for x, y, name, data in vector_data['points']]
+        return GeoPatch(type=PatchType(patch_type) if isinstance(patch_type, int) else patch_type, raster_data=raster_data, vector_data=vector_data)
+
     # raster data related methods
     def get_raster_data(self) -> Dict:
         if self.raster_data is not None:
@@ -102,6 +231,7 @@ class GeoPatch():
         '''
         self.raster_data = raster_data
 
+    @tracing.traced('compute', name='rbf_interpolation')
     def set_raster_data_from_points(self, points: List[List[float]], name=None, type=None, colormap='gray') -> None:
         '''
         Sets the raster data across the patch from a list of points
@@ -118,6 +248,7 @@ class GeoPatch():
             Colormap for the raster data.
         '''
         # performing RBF interpolation
+        tracing.annotate(points=len(points))
         coordinates = np.array([[point[0], point[1]] for point in points])
         values = np.array([point[2] for point in points])
 
@@ -140,6 +271,124 @@ class GeoPatch():
             'data': data
         }
 
+    def get_pixel_coordinates(self):
+        '''
+        Latitude of every raster row and longitude of every raster column, matching the grid of set_raster_data_from_points
+        (first row at the maximum latitude, first column at the minimum longitude).
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]: Row latitudes and column longitudes.
+        '''
+        data = self.raster_data['data']
+        min_lat, max_lat, min_lon, max_lon = self.vector_data['bbox']
+        latitudes = np.linspace(max_lat, min_lat, data.shape[0])
+        longitudes = np.linspace(min_lon, max_lon, data.shape[1])
+        return latitudes, longitudes
+
+    def get_boundary_mask(self) -> np.ndarray:
+        '''
+        Boolean mask of the raster pixels whose centers lie within the boundary polygons, cached on the patch.
+
+        Returns
+        -------
+        np.ndarray: Mask with the shape of the raster, all True if the patch has no boundary.
+        '''
+        data = self.raster_data['data']
+        boundary = self.vector_data.get('boundary')
+        key = (self.get_boundary_digest(), tuple(self.vector_data['bbox']), data.shape[:2])
+        cached = self.__dict__.get('_boundary_mask')
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        if boundary is None or len(boundary) == 0:
+            mask = np.ones(data.shape[:2], dtype=bool)
+        else:
+            latitudes, longitudes = self.get_pixel_coordinates()
+            mask = rasterize_boundaries([boundary], latitudes, longitudes) >= 0
+        self._boundary_mask = (key, mask)
+        return mask
+
+    def get_raster_summary(self, within_boundary: bool = False, bins: int = 10, quantiles: List[float] = None) -> Dict:
+        '''
+        Summary statistics of the raster data computed in chunked passes, ignoring missing (NaN) and infinite values.
+        Results are cached on the patch by content, so repeated calls on an unchanged raster are free.
+
+        Parameters
+        ----------
+        within_boundary : bool, optional
+            Only consider the pixels within the boundary polygons of the patch.
+        bins : int, optional
+            Number of equal width histogram bins between the minimum and maximum.
+        quantiles : List[float], optional
+            Quantiles between 0 and 1 to compute, defaults to [0.25, 0.5, 0.75].
+
+        Returns
+        -------
+        Dict: with keys 'count', 'mean', 'variance', 'std', 'min', 'max', 'histogram' (counts, bin_edges) and 'quantiles' (quantile to value).
+            Values are NaN (and the histogram empty) if there is no valid pixel.
+        '''
+        quantiles = (0.25, 0.5, 0.75) if quantiles is None else tuple(quantiles)
+        data = np.asarray(self.raster_data['data'])
+        # content keys, so in place writes to the raster are not served stale summaries
+        boundary_key = (self.get_boundary_digest(), tuple(self.vector_data['bbox'])) if within_boundary else None
+        key = (self._raster_digest(data), boundary_key, bins, quantiles)
+        summaries = self.__dict__.setdefault('_raster_summaries', {})
+        if key in summaries:
+            return summaries[key]
+
+        if data.ndim == 3:
+            data = data[:, :, 0] # removing channel dim
+        mask = self.get_boundary_mask() if within_boundary else None
+        summary = summarize_raster(data, mask=mask, bins=bins, quantiles=quantiles)
+
+        # only the summaries of the current raster are kept
+        self._raster_summaries = {k: v for k, v in summaries.items() if k[0] == key[0]}
+        self._raster_summaries[key] = summary
+        return summary
+
+    def get_count(self, within_boundary: bool = False) -> int:
+        '''
+        Number of valid (finite) raster pixels.
+        '''
+        return self.get_raster_summary(within_boundary)['count']
+
+    def get_mean(self, within_boundary: bool = False) -> float:
+        '''
+        Mean of the raster data, ignoring NaN and infinite values.
+        '''
+        return self.get_raster_summary(within_boundary)['mean']
+
+    def get_variance(self, within_boundary: bool = False) -> float:
+        '''
+        Variance of the raster data, ignoring NaN and infinite values.
+        '''
+        return self.get_raster_summary(within_boundary)['variance']
+
+    def get_min(self, within_boundary: bool = False) -> float:
+        '''
+        Minimum of the raster data, ignoring NaN and infinite values.
+        '''
+        return self.get_raster_summary(within_boundary)['min']
+
+    def get_max(self, within_boundary: bool = False) -> float:
+        '''
+        Maximum of the raster data, ignoring NaN and infinite values.
+        '''
+        return self.get_raster_summary(within_boundary)['max']
+
+    def get_histogram(self, bins: int = 10, within_boundary: bool = False):
+        '''
+        Histogram of the raster data as (counts, bin_edges), ignoring NaN and infinite values.
+        '''
+        return self.get_raster_summary(within_boundary, bins=bins)['histogram']
+
+    def get_quantiles(self, quantiles: List[float] = None, within_boundary: bool = False) -> Dict[float, float]:
+        '''
+        Quantiles (between 0 and 1) of the raster data, ignoring NaN and infinite values.
+        '''
+        return self.get_raster_summary(within_boundary, quantiles=quantiles)['quantiles']
+
     def sample_random_points(self, num_points: int = 10) -> List:
         # returns randomly sampled points within the patch's bounding box
         min_lat, max_lat, min_lon, max_lon = self.vector_data['bbox']
@@ -190,6 +439,50 @@ class GeoPatch():
     def set_boundary_polygons(self, boundary: List[Polygon]) -> None:
         self.vector_data['boundary'] = boundary
 
+    def get_cell_cover(self, level: int = None) -> CellUnion:
+        '''
+        Global grid cells covering the boundary of the patch (or its bbox if it has no boundary), cached on the patch.
+        Cell covers make overlap and containment checks between patches independent of the number of polygon vertices.
+
+        Parameters
+        ----------
+        level : int, optional
+            Finest grid level of the cover, chosen from the patch extent if None.
+
+        Returns
+        -------
+        CellUnion: Set of grid cells covering the patch.
+        '''
+        boundary = self.vector_data.get('boundary')
+        bbox = self.vector_data.get('bbox')
+        key = (level, self.get_boundary_digest(), tuple(bbox) if bbox is not None else None)
+
+        if key not in self.__dict__.get('_cell_covers', {}):
+            # only the covers of the current boundary are kept
+            self._cell_covers = {k: v for k, v in self.__dict__.get('_cell_covers', {}).items() if k[1:] == key[1:]}
+            if boundary is not None and len(boundary) > 0:
+                geometry = shapely.union_all(np.asarray(boundary, dtype=object))
+            elif bbox is not None and len(bbox) == 4:
+                geometry = shapely.box(bbox[2], bbox[0], bbox[3], bbox[1]) # polygons are in (lon, lat)
+            else:
+                return CellUnion()
+            self._cell_covers[key] = cover(geometry, level=level)
+        return self._cell_covers[key]
+
+    def overlaps(self, other: 'GeoPatch', level: int = None) -> bool:
+        '''
+        Whether the cell covers of two patches share any cell, a conservative test for overlapping boundaries.
+        '''
+        if level is None:
+            level = min(self._cover_level(), other._cover_level())
+        return self.get_cell_cover(level).intersects(other.get_cell_cover(level))
+
+    def _cover_level(self) -> int:
+        bbox = self.vector_data.get('bbox')
+        if bbox is None or len(bbox) != 4:
+            return 0
+        return auto_level((bbox[2], bbox[0], bbox[3], bbox[1]))
+
     def get_bbox(self) -> List[float]:
         if 'bbox' in self.vector_data:
             return self.vector_data['bbox']
@@ -217,4 +510,196 @@ class GeoPatch():
             return self.vector_data['points']
 
 
-    
\ No newline at end of file
+    
+
+def rasterize_boundaries(boundaries: List[List[Polygon]], latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    '''
+    Burns several boundaries into a single label grid, pixel centers within boundaries[k] get label k.
+    
+    Parameters
+    ----------
+    boundaries : List[List[Polygon]]
+        Boundary polygons of every region, in (lon, lat) coordinates. Later regions win where regions overlap.
+    latitudes : np.ndarray
+        Latitude of every grid row, in ascending or descending order.
+    longitudes : np.ndarray
+        Longitude of every grid column, in ascending order.
+
+    Returns
+    -------
+    np.ndarray: Label grid of shape (len(latitudes), len(longitudes)), -1 outside all regions.
+    '''
+    labels = np.full((len(latitudes), len(longitudes)), -1, dtype=np.int32)
+    descending = len(latitudes) > 1 and latitudes[0] > latitudes[-1]
+    search_lats = latitudes[::-1] if descending else latitudes
+
+    for label, boundary in enumerate(boundaries):
+        if boundary is None or len(boundary) == 0:
+            continue
+        region = shapely.union_all(np.asarray(boundary, dtype=object))
+        if region.is_empty:
+            continue
+        shapely.prepare(region)
+
+        # only the window of the grid overlapping the region bounds is tested
+        min_lon, min_lat, max_lon, max_lat = region.bounds
+        c0, c1 = np.searchsorted(longitudes, min_lon, side='left'), np.searchsorted(longitudes, max_lon, side='right')
+        r0, r1 = np.searchsorted(search_lats, min_lat, side='left'), np.searchsorted(search_lats, max_lat, side='right')
+        if c0 >= c1 or r0 >= r1:
+            continue
+        if descending:
+            r0, r1 = len(latitudes) - r1, len(latitudes) - r0
+
+        lon_grid, lat_grid = np.meshgrid(longitudes[c0:c1], latitudes[r0:r1])
+        inside = shapely.contains_xy(region, lon_grid, lat_grid)
+        labels[r0:r1, c0:c1][inside] = label
+
+    return labels
+
+
+def _is_read_only(data: np.ndarray) -> bool:
+    # the array and every array it is a view of are read-only, or the memory belongs to an immutable bytes object
+    while isinstance(data, np.ndarray):
+        if data.flags.writeable:
+            return False
+        data = data.base
+    return data is None or isinstance(data, bytes)
+
+
+def summarize_raster(data: np.ndarray, mask: np.ndarray = None, bins: int = 10, quantiles: List[float] = (0.25, 0.5, 0.75), chunk_pixels: int = 1 << 20) -> Dict:
+    '''
+    Summary of the finite values of a 2D raster over row chunks, without copying them: moments are merged per chunk
+    (Chan et al.), the histogram is accumulated per chunk, and quantiles are exact order statistics located through
+    a fine histogram (see _order_statistics).
+    '''
+    quantiles = tuple(quantiles)
+    if any(not 0.0 <= q <= 1.0 for q in quantiles):
+        raise ValueError('Quantiles must be in the range [0, 1].')
+
+    count, mean, m2 = 0, 0.0, 0.0
+    min_, max_ = np.inf, -np.inf
+    for chunk in _valid_chunks(data, mask, chunk_pixels):
+        if chunk.size == 0:
+            continue
+        count, mean, m2 = merge_moments(count, mean, m2, chunk)
+        min_, max_ = min(min_, float(chunk.min())), max(max_, float(chunk.max()))
+
+    if count == 0:
+        return {'count': 0, 'mean': np.nan, 'variance': np.nan, 'std': np.nan, 'min': np.nan, 'max': np.nan,
+                'histogram': (np.zeros(0, dtype=np.int64), np.zeros(0)), 'quantiles': {q: np.nan for q in quantiles}}
+
+    counts = None
+    for chunk in _valid_chunks(data, mask, chunk_pixels):
+        chunk_counts, bin_edges = np.histogram(chunk, bins=bins, range=(min_, max_))
+        counts = chunk_counts if counts is None else counts + chunk_counts
+
+    # linear interpolation between the closest ranks, as np.quantile
+    positions = [(count - 1) * q for q in quantiles]
+    ranks = {int(np.floor(p)) for p in positions} | {min(int(np.floor(p)) + 1, count - 1) for p in positions}
+    values = _order_statistics(data, mask, sorted(ranks), min_, max_, chunk_pixels)
+    quantile_values = {}
+    for q, position in zip(quantiles, positions):
+        below = int(np.floor(position))
+        a, b, t = values[below], values[min(below + 1, count - 1)], position - below
+        quantile_values[q] = b - (b - a) * (1 - t) if t >= 0.5 else a + (b - a) * t
+
+    variance = m2 / count
+    return {
+        'count': int(count),
+        'mean': float(mean),
+        'variance': float(variance),
+        'std': float(np.sqrt(variance)),
+        'min': float(min_),
+        'max': float(max_),
+        'histogram': (counts, bin_edges),
+        'quantiles': quantile_values
+    }
+
+
+def merge_moments(count: int, mean: float, m2: float, values: np.ndarray) -> Tuple[int, float, float]:
+    '''
+    Merges the count, mean and sum of squared deviations (m2) of a chunk of values into running ones (Chan et al.),
+    without the cancellation of sums of squares on values far from zero. Returns the updated (count, mean, m2).
+    '''
+    n = values.size
+    if n == 0:
+        return count, mean, m2
+    values = values.astype(np.float64, copy=False)
+    chunk_mean = values.mean()
+    chunk_m2 = np.square(values - chunk_mean).sum()
+    delta = chunk_mean - mean
+    total = count + n
+    return total, mean + delta * n / total, m2 + chunk_m2 + delta * delta * count * n / total
+
+
+# bins of the histograms locating order statistics
+QUANTILE_BINS = 4096
+
+
+def _valid_chunks(data: np.ndarray, mask: np.ndarray, chunk_pixels: int):
+    # finite values of the raster, a chunk of rows at a time, in the dtype of the raster
+    rows_per_chunk = max(1, chunk_pixels // max(1, data.shape[1]))
+    for start in range(0, data.shape[0], rows_per_chunk):
+        chunk = data[start:start + rows_per_chunk]
+        valid = np.isfinite(chunk)
+        if mask is not None:
+            valid &= mask[start:start + rows_per_chunk]
+        yield chunk[valid]
+
+
+def _order_statistics(data: np.ndarray, mask: np.ndarray, ranks: List[int], low: float, high: float, chunk_pixels: int) -> Dict[int, float]:
+    '''
+    Values of the given ranks (0 based, ascending) among the valid values of a raster, in memory bounded by the chunk
+    size: a pass counts the values of the searched range in fine bins, and another gathers the values of the bins
+    holding the ranks. Bins holding more than a chunk of values become the searched range of the next round.
+    '''
+    found = {}
+    pending = {rank: (low, high, rank) for rank in ranks} # searched value range, and rank within it
+    while pending:
+        ranges = {(lo, hi) for lo, hi, _ in pending.values()}
+
+        def fine_bins(chunk: np.ndarray):
+            # the bin index is monotonic in the value, so every bin holds a contiguous run of the sorted values
+            for lo, hi in ranges:
+                in_range = chunk[(chunk >= lo) & (chunk <= hi)]
+                indices = ((in_range.astype(np.float64) - lo) * (QUANTILE_BINS / (hi - lo))) if hi > lo else np.zeros(in_range.size)
+                yield (lo, hi), in_range, np.clip(indices.astype(np.int64), 0, QUANTILE_BINS - 1)
+
+        counts = {searched: np.zeros(QUANTILE_BINS, dtype=np.int64) for searched in ranges}
+        for chunk in _valid_chunks(data, mask, chunk_pixels):
+            for searched, _, indices in fine_bins(chunk):
+                counts[searched] += np.bincount(indices, minlength=QUANTILE_BINS)
+
+        targets = {}
+        for rank, (lo, hi, rank_in_range) in pending.items():
+            cumulative = np.cumsum(counts[(lo, hi)])
+            b = int(np.searchsorted(cumulative, rank_in_range, side='right'))
+            targets[rank] = ((lo, hi), b, rank_in_range - (int(cumulative[b - 1]) if b > 0 else 0))
+
+        # small bins are gathered, the bounds of the others narrow the next round
+        wanted = {(searched, b) for searched, b, _ in targets.values()}
+        gathered = {key: [] for key in wanted if counts[key[0]][key[1]] <= chunk_pixels}
+        bounds = {key: [np.inf, -np.inf] for key in wanted if key not in gathered}
+        for chunk in _valid_chunks(data, mask, chunk_pixels):
+            for searched, in_range, indices in fine_bins(chunk):
+                for key in wanted:
+                    if key[0] != searched:
+                        continue
+                    values = in_range[indices == key[1]]
+                    if key in gathered:
+                        gathered[key].append(values)
+                    elif values.size > 0:
+                        bounds[key] = [min(bounds[key][0], float(values.min())), max(bounds[key][1], float(values.max()))]
+
+        sorted_bins = {key: np.sort(np.concatenate(values)) for key, values in gathered.items()}
+        pending = {}
+        for rank, (searched, b, rank_in_bin) in targets.items():
+            key = (searched, b)
+            if key in sorted_bins:
+                found[rank] = float(sorted_bins[key][rank_in_bin])
+            elif bounds[key][0] == bounds[key][1]:
+                found[rank] = bounds[key][0]
+            else:
+                # the values of the bin are exactly those within its bounds
+                pending[rank] = (bounds[key][0], bounds[key][1], rank_in_bin)
+    return found
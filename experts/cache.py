@@ -0,0 +1,425 @@
+'''
+Memoization layer for the experts, with per-expert eviction policies and queryable statistics
+'''
+import os, time, copy, pickle, hashlib, inspect, threading
+import numpy as np
+import shapely
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Callable, Dict
+
+from .base import GeoPatch, DataPoint
+from . import tracing
+
+
+# default lifetime of weather readings (seconds), beyond which they are fetched again
+WEATHER_TTL = 600
+
+# default memory budget of the in-memory cache (bytes)
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def _sizeof(value: Any) -> int:
+    '''
+    Rough estimate of the memory held by a cached value, dominated by raster arrays.
+    '''
+    if isinstance(value, GeoPatch):
+        size = 1024
+        if value.raster_data is not None and isinstance(value.raster_data.get('data'), np.ndarray):
+            size += value.raster_data['data'].nbytes
+        if value.vector_data is not None:
+            for poly in value.vector_data.get('boundary') or []:
+                size += 16 * shapely.get_num_coordinates(poly) + 64
+            size += 128 * len(value.vector_data.get('points') or [])
+        return size
+    elif isinstance(value, np.ndarray):
+        return value.nbytes + 128
+    elif isinstance(value, (list, tuple)):
+        return 64 + sum(_sizeof(v) for v in value)
+    elif isinstance(value, dict):
+        return 64 + sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    elif isinstance(value, (str, bytes)):
+        return 64 + len(value)
+    return 64
+
+
+def _fingerprint_arg(arg: Any) -> str:
+    '''
+    Stable representation of an expert argument, used as part of the cache key.
+    '''
+    if isinstance(arg, GeoPatch):
+        return f'GeoPatch:{arg.get_fingerprint()}'
+    elif isinstance(arg, DataPoint):
+        return f'DataPoint:{arg.point.x},{arg.point.y},{arg.name!r},{arg.data!r}'
+    elif isinstance(arg, np.ndarray):
+        return f'ndarray:{hashlib.blake2b(np.ascontiguousarray(arg).view(np.uint8).data, digest_size=16).hexdigest()}'
+    elif isinstance(arg, (list, tuple)):
+        return f"{type(arg).__name__}[{','.join(_fingerprint_arg(a) for a in arg)}]"
+    elif isinstance(arg, dict):
+        return f"dict{{{','.join(f'{k!r}:{_fingerprint_arg(v)}' for k, v in sorted(arg.items(), key=lambda kv: repr(kv[0])))}}}"
+    return repr(arg)
+
+
+def freeze(value: Any) -> Any:
+    '''
+    Makes the arrays held by a value (GeoPatch rasters, NumPy arrays, in lists, tuples and dicts) read-only, so the
+    value can be shared between the cache and its callers. Returns the value.
+    '''
+    for array in _arrays(value):
+        array.flags.writeable = False
+    return value
+
+
+def shared_copy(value: Any) -> Any:
+    '''
+    Deep copy of a value sharing its read-only arrays and (immutable) shapely geometries with the original, so
+    copying a cached patch costs its containers, not its raster.
+    '''
+    memo = {}
+    for array in _arrays(value):
+        if not array.flags.writeable:
+            memo[id(array)] = array
+    for geometry in _geometries(value):
+        memo[id(geometry)] = geometry
+    return copy.deepcopy(value, memo)
+
+
+def detached_copy(value: Any, arguments: list) -> Any:
+    '''
+    Copy of a value owning the arrays it shares memory with (e.g. an expert returning its input patch), sharing the
+    others, so freezing it leaves the arguments' arrays writeable.
+    '''
+    argument_arrays = _arrays(list(arguments))
+    memo = {}
+    for array in _arrays(value):
+        if not any(np.may_share_memory(array, other) for other in argument_arrays):
+            memo[id(array)] = array
+    for geometry in _geometries(value):
+        memo[id(geometry)] = geometry
+    return copy.deepcopy(value, memo)
+
+
+def _children(value: Any) -> list:
+    if isinstance(value, GeoPatch):
+        return [value.raster_data, value.vector_data]
+    elif isinstance(value, DataPoint):
+        return [value.point]
+    elif isinstance(value, (list, tuple)):
+        return list(value)
+    elif isinstance(value, dict):
+        return list(value.values())
+    return []
+
+
+def _arrays(value: Any) -> list:
+    if isinstance(value, np.ndarray):
+        return [value] if value.dtype != object else []
+    return [array for child in _children(value) for array in _arrays(child)]
+
+
+def _geometries(value: Any) -> list:
+    if isinstance(value, shapely.Geometry):
+        return [value]
+    return [geometry for child in _children(value) for geometry in _geometries(child)]
+
+
+def make_key(name: str, arguments: Dict) -> str:
+    '''
+    Builds a cache key out of the expert name, GeoPatch fingerprints and the remaining arguments.
+    '''
+    parts = [name]
+    parts += [f'{k}={_fingerprint_arg(v)}' for k, v in arguments.items()]
+    return hashlib.blake2b('|'.join(parts).encode(), digest_size=20).hexdigest()
+
+
+class CacheEntry():
+    def __init__(self, value: Any, size: int, compute_time: float, expires_at: float = None):
+        self.value = value
+        self.size = size
+        self.compute_time = compute_time
+        self.expires_at = expires_at
+
+    def expired(self, now: float) -> bool:
+        return self.expires_at is not None and now >= self.expires_at
+
+
+class MemoryBackend():
+    '''
+    In-memory LRU cache bounded by the estimated size of the stored values.
+
+    Parameters
+    ----------
+        max_bytes (int): Memory budget, least recently used entries are evicted beyond it.
+    '''
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, key: str) -> CacheEntry:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: CacheEntry) -> int:
+        '''
+        Stores an entry, returns the number of entries evicted to make room for it.
+        '''
+        if key in self.entries:
+            self.used_bytes -= self.entries.pop(key).size
+        if entry.size > self.max_bytes:
+            return 0
+
+        self.entries[key] = entry
+        self.used_bytes += entry.size
+
+        evicted = 0
+        while self.used_bytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.used_bytes -= old.size
+            evicted += 1
+        return evicted
+
+    def delete(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.used_bytes -= entry.size
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.used_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class DiskBackend():
+    '''
+    Pickle based cache persisted in a directory, survives app restarts.
+
+    Parameters
+    ----------
+        cache_dir (str): Directory where the cache entries are stored.
+        max_bytes (int): Disk budget, oldest accessed entries are evicted beyond it.
+    '''
+    def __init__(self, cache_dir: str = os.path.join(os.path.expanduser('~'), '.cache', 'geode', 'experts'), max_bytes: int = 4 * DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+    def get(self, key: str) -> CacheEntry:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(path) # bump access time for LRU eviction
+            return entry
+        except OSError:
+            return None
+        except Exception:
+            # edge case: truncated entries, or entries pickled by an older version of the classes
+            self.delete(key)
+            return None
+
+    def put(self, key: str, entry: CacheEntry) -> int:
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return self._evict()
+
+    def _evict(self) -> int:
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in files)
+        evicted = 0
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+            evicted += 1
+        return evicted
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self) -> None:
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def __len__(self) -> int:
+        return sum(1 for name in os.listdir(self.cache_dir) if name.endswith('.pkl'))
+
+
+class CacheStats():
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.saved_time = 0.0 # seconds of expert computation avoided by cache hits
+
+    def as_dict(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hits / total if total > 0 else 0.0,
+            'saved_time': self.saved_time
+        }
+
+
+class ExpertCache():
+    '''
+    Registry of cache backends and per-expert statistics shared by all cached experts.
+
+    Attributes
+    ----------
+    backends: dict
+        - 'memory' (MemoryBackend): Memory bounded LRU backend, always available.
+        - 'disk' (DiskBackend): Persistent backend, only present if enabled.
+    stats: Dict[str, CacheStats]
+        Hit, miss, eviction counters and saved time per expert.
+    '''
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.enabled = os.environ.get('GEODE_CACHE', '1') != '0'
+        self.backends = {'memory': MemoryBackend()}
+        self.stats = {}
+
+        if os.environ.get('GEODE_CACHE_DIR'):
+            self.enable_disk(os.environ['GEODE_CACHE_DIR'])
+
+    def enable_disk(self, cache_dir: str = None, max_bytes: int = None) -> None:
+        kwargs = {}
+        if cache_dir is not None:
+            kwargs['cache_dir'] = cache_dir
+        if max_bytes is not None:
+            kwargs['max_bytes'] = max_bytes
+        with self.lock:
+            self.backends['disk'] = DiskBackend(**kwargs)
+
+    def set_memory_limit(self, max_bytes: int) -> None:
+        with self.lock:
+            self.backends['memory'].max_bytes = max_bytes
+
+    def get_backend(self, name: str):
+        # falls back to memory if the disk backend is not enabled
+        return self.backends.get(name, self.backends['memory'])
+
+    def get_stats(self, name: str) -> CacheStats:
+        with self.lock:
+            if name not in self.stats:
+                self.stats[name] = CacheStats()
+            return self.stats[name]
+
+
+expert_cache = ExpertCache()
+
+
+def cached_expert(ttl: float = None, backend: str = 'memory') -> Callable:
+    '''
+    Decorator memoizing an expert on its name, GeoPatch fingerprints and remaining arguments.
+    Cached values are frozen (see freeze) and callers get copies sharing their arrays, so the arrays of returned
+    values are read-only and have to be copied before being modified in place.
+
+    Parameters
+    ----------
+        ttl (float): Lifetime of cached results in seconds, None to cache indefinitely.
+        backend (str): Possible values: ['memory', 'disk']. Disk falls back to memory if not enabled.
+    '''
+    def decorator(func: Callable) -> Callable:
+        name = func.__name__
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not expert_cache.enabled:
+                return func(*args, **kwargs)
+
+            # binding to the signature so positional, keyword and default arguments share keys
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = make_key(name, bound.arguments)
+            stats = expert_cache.get_stats(name)
+            store = expert_cache.get_backend(backend)
+
+            with expert_cache.lock:
+                entry = store.get(key)
+                if entry is not None and entry.expired(time.time()):
+                    store.delete(key)
+                    stats.expirations += 1
+                    entry = None
+                if entry is not None:
+                    stats.hits += 1
+                    stats.saved_time += entry.compute_time
+                    tracing.annotate(cache='hit', saved_time=entry.compute_time)
+                    return shared_copy(freeze(entry.value))
+                stats.misses += 1
+            tracing.annotate(cache='miss')
+
+            start = time.perf_counter()
+            value = func(*args, **kwargs)
+            compute_time = time.perf_counter() - start
+
+            # failed requests are returned as None and should be retried on the next call
+            if value is None:
+                return value
+
+            # freezing a copy, the value may hold (or view) arrays of the caller's arguments
+            value = freeze(detached_copy(value, bound.arguments.values()))
+            expires_at = time.time() + ttl if ttl is not None else None
+            entry = CacheEntry(value, _sizeof(value), compute_time, expires_at)
+            with expert_cache.lock:
+                stats.evictions += store.put(key, entry)
+            return shared_copy(value)
+
+        wrapper.cache_policy = {'ttl': ttl, 'backend': backend}
+        return wrapper
+    return decorator
+
+
+def get_cache_stats(name: str = None) -> Dict:
+    '''
+    Returns cache statistics for one expert, or for all experts along with backend usage if name is None.
+    '''
+    with expert_cache.lock:
+        if name is not None:
+            return expert_cache.get_stats(name).as_dict()
+
+        stats = {expert: s.as_dict() for expert, s in expert_cache.stats.items()}
+        memory = expert_cache.backends['memory']
+        stats['__backends__'] = {
+            'memory': {'entries': len(memory), 'used_bytes': memory.used_bytes, 'max_bytes': memory.max_bytes}
+        }
+        if 'disk' in expert_cache.backends:
+            disk = expert_cache.backends['disk']
+            stats['__backends__']['disk'] = {'entries': len(disk), 'cache_dir': disk.cache_dir, 'max_bytes': disk.max_bytes}
+        return stats
+
+
+def clear_cache(reset_stats: bool = False) -> None:
+    '''
+    Clears all cache backends, and optionally the accumulated statistics.
+    '''
+    with expert_cache.lock:
+        for store in expert_cache.backends.values():
+            store.clear()
+        if reset_stats:
+            expert_cache.stats.clear()
@@ -5,8 +5,13 @@ from typing import Union, Tuple
 from geopy.geocoders import Nominatim
 from shapely.geometry.polygon import Polygon
 from .base import GeoPatch, PatchType, RasterType, DataPoint
+from .cache import cached_expert, WEATHER_TTL
+from .tracing import traced, record_response
+from .places import get_place_index
 
 
+@traced()
+@cached_expert(backend='disk') # geocoded locations rarely change, persisted if the disk cache is enabled
 def point_location_expert(name: str) -> GeoPatch:
     '''
     Finds the geographic location of any valid place on the map by its name.
@@ -56,6 +61,8 @@ def point_location_expert(name: str) -> GeoPatch:
 
     
 
+@traced()
+@cached_expert(backend='disk') # boundaries rarely change, persisted if the disk cache is enabled
 def patch_location_expert(name: str) -> GeoPatch:
     '''
     Finds the geographic location and boundary polygon of any valid place on the map by its name.
@@ -138,6 +145,8 @@ def patch_location_expert(name: str) -> GeoPatch:
 
     
 
+@traced()
+@cached_expert(ttl=WEATHER_TTL)
 def humidity_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
     '''
     Retrieves humidity (%) values throughout a geographical patch as raster data, or at the central location of a patch based on mode.
@@ -171,6 +180,7 @@ def humidity_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
         # sending the request to WeatherAPI.com
         try:
             response = req.post(url, headers=headers, json=data)
+            record_response(response)
             response.raise_for_status()
             data = response.json()['bulk']
             
@@ -194,6 +204,7 @@ def humidity_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
         # sending the request to WeatherAPI.com
         try:
             response = req.get(url=url)
+            record_response(response)
             response.raise_for_status()
             data = response.json()
             value = data['current']['humidity']
@@ -209,6 +220,8 @@ def humidity_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
         raise ValueError('Unknown mode specified for humidity expert.')
 
 
+@traced()
+@cached_expert(ttl=WEATHER_TTL)
 def precipitation_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
     '''
     Retrieves precipitation values in mm throughout a geographical patch as raster data, or at the central location of a patch based on mode.
@@ -242,6 +255,7 @@ def precipitation_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
         # sending the request to WeatherAPI.com
         try:
             response = req.post(url, headers=headers, json=data)
+            record_response(response)
             response.raise_for_status()
             data = response.json()['bulk']
             
@@ -265,6 +279,7 @@ def precipitation_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
         # sending the request to WeatherAPI.com
         try:
             response = req.get(url=url)
+            record_response(response)
             response.raise_for_status()
             data = response.json()
             value = data['current']['precip_mm']
@@ -280,6 +295,8 @@ def precipitation_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
         raise ValueError('Unknown mode specified for precipitation expert.')
     
 
+@traced()
+@cached_expert(ttl=WEATHER_TTL)
 def temperature_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
     '''
     Retrieves temperature values (Celcius) throughout a geographical patch as raster data, or at the central location of a patch based on mode.
@@ -313,6 +330,7 @@ def temperature_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
         # sending the request to WeatherAPI.com
         try:
             response = req.post(url, headers=headers, json=data)
+            record_response(response)
             response.raise_for_status()
             data = response.json()['bulk']
             
@@ -336,6 +354,7 @@ def temperature_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
         # sending the request to WeatherAPI.com
         try:
             response = req.get(url=url)
+            record_response(response)
             response.raise_for_status()
             data = response.json()
             value = data['current']['precip_mm']
@@ -351,6 +370,8 @@ def temperature_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
         raise ValueError('Unknown mode specified for precipitation expert.')
 
 
+@traced()
+@cached_expert(ttl=WEATHER_TTL)
 def air_quality_expert(patch: GeoPatch, parameter: str = 'pm2_5', mode: str = 'patch') -> GeoPatch:
     '''
     Retrieves a particular air quality parameter throughout a geographical patch as raster data, or at the central location of a patch based on mode.
@@ -395,6 +416,7 @@ def air_quality_expert(patch: GeoPatch, parameter: str = 'pm2_5', mode: str = 'p
         # sending the request to WeatherAPI.com
         try:
             response = req.post(url, headers=headers, json=data)
+            record_response(response)
             response.raise_for_status()
             data = response.json()['bulk']
             
@@ -420,6 +442,7 @@ def air_quality_expert(patch: GeoPatch, parameter: str = 'pm2_5', mode: str = 'p
         # sending the request to WeatherAPI.com
         try:
             response = req.get(url=url)
+            record_response(response)
             response.raise_for_status()
             data = response.json()
             value = data['current']['air_quality'][parameter]
@@ -436,6 +459,8 @@ def air_quality_expert(patch: GeoPatch, parameter: str = 'pm2_5', mode: str = 'p
         raise ValueError('Unknown mode specified for air quality expert.')
 
 
+@traced()
+@cached_expert()
 def elevation_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
     '''
     Retrieves elevation values throughout a geographical patch as raster data, or at the central location of a patch based on mode.
@@ -466,6 +491,7 @@ def elevation_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
         # sending the request to open-meteo.com
         try:
             response = req.get(url)
+            record_response(response)
             response.raise_for_status()
             data = response.json()
             values = data['elevation'] # elevation values
@@ -486,6 +512,7 @@ def elevation_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
         # sending the request to open-meteo.com
         try:
             response = req.get(url)
+            record_response(response)
             response.raise_for_status()
             data = response.json()
             value = data['elevation']
@@ -500,4 +527,67 @@ def elevation_expert(patch: GeoPatch, mode: str = 'patch') -> GeoPatch:
     else:
         raise ValueError('Unknown mode specified for elevation expert.')
 
-    
\ No newline at end of file
+    
+
+@traced()
+@cached_expert()
+def proximity_expert(name: Union[str, GeoPatch], level: str = 'city', count: int = 10, radius_km: float = None, min_population: int = 0) -> GeoPatch:
+    '''
+    Finds the places nearest to a given place, or to the location of a patch, from a local index of populated places.
+
+    Parameters
+    ----------
+        name (Union[str, GeoPatch]): Name of the place to search around, or a GeoPatch whose location is used.
+        level (str): Possible values: ['city', 'admin', 'capital']. Any populated place, seats of administrative divisions (e.g. state or county seats), or national capitals.
+        count (int): Maximum number of places to return, at least 1. If None, all places within radius_km are returned.
+        radius_km (float): Only places within this distance (km) are returned, if given.
+        min_population (int): Only places with at least this population are returned.
+
+    Returns
+    -------
+        GeoPatch: Patch located at the searched place, with one DataPoint per nearby place in patch.vector_data['points'], nearest first.
+            DataPoint.name is the place name and DataPoint.data its distance in km from the searched place.
+    '''
+    # edge cases
+    if name is None or name == '':
+        return None
+    if count is None and radius_km is None:
+        raise ValueError('Either count or radius_km must be specified for proximity expert.')
+    if count is not None and count < 1:
+        raise ValueError('count must be at least 1 for proximity expert.')
+
+    index = get_place_index()
+
+    # resolving the center locally, geocoding only unknown names
+    exclude = None
+    if isinstance(name, GeoPatch):
+        lat, lon = name.get_location()
+    else:
+        exclude = index.find(name)
+        if exclude is not None:
+            lat, lon = float(index.lats[exclude]), float(index.lons[exclude])
+        else:
+            center = point_location_expert(name)
+            if center is None:
+                return None
+            lat, lon = center.get_location()
+
+    if count is None:
+        neighbours = index.within(lat, lon, radius_km, level=level, min_population=min_population, exclude=exclude)
+    else:
+        neighbours = index.nearest(lat, lon, count=count, level=level, min_population=min_population, radius_km=radius_km, exclude=exclude)
+
+    points = [DataPoint(float(index.lats[i]), float(index.lons[i]), name=index.names[i], data=round(distance, 2)) for i, distance in neighbours]
+    lats = [lat] + [point.point.x for point in points]
+    lons = [lon] + [point.point.y for point in points]
+
+    patch = GeoPatch(type=PatchType.vector_only,
+                     raster_data={'name': None,
+                                  'type': None,
+                                  'colormap': None,
+                                  'data': None},
+                     vector_data={'location': [lat, lon],
+                                  'bbox': [min(lats), max(lats), min(lons), max(lons)],
+                                  'points': points,
+                                  'boundary': None})
+    return patch
@@ -1,26 +1,43 @@
 import copy
+import warnings
 import numpy as np
-
-from .base import GeoPatch, RasterType
-from scipy.interpolate import griddata
+import shapely
+from typing import List, Dict, Tuple, Union, Callable
+
+from .base import GeoPatch, RasterType, rasterize_boundaries
+from .cache import cached_expert
+from . import tracing
+from .raster_algebra import RasterExpression
+from .tiles import get_pyramid, tile_url, TILE_THRESHOLD_PIXELS, MAX_ZOOM
+from .rendering import render_overlay, render_boundary, marker_layer, colormap_colors, MAP_WIDTH, MAP_HEIGHT
+from .vector_overlay import overlay, filter_points, boundary_bbox
+from .prompt import RESULT_LINE
+from .retrieval import SpecRetriever, DEFAULT_TOP_K
+from scipy.ndimage import distance_transform_edt, convolve, label
+from scipy.stats import rankdata
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import spsolve, cg
 import folium
 from streamlit_folium import folium_static
 from folium.plugins import Fullscreen
-import matplotlib.pyplot as plt
 from openai import OpenAI
 import anthropic
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
 import os
 
 
-
-def imputation_expert(patch: GeoPatch) -> GeoPatch:
+@tracing.traced()
+@cached_expert()
+def imputation_expert(patch: GeoPatch, mode: str = 'nearest') -> GeoPatch:
     '''
     Impute missing values in a patch using interpolation.
 
     Parameters
     ----------
         patch (GeoPatch): Input patch with missing values within patch.raster_data['data'] represented as NaN.
+        mode (str): Possible values: ['nearest', 'linear', 'inpaint']. Nearest neighbour fill, linear interpolation 
+            between the surrounding known values, or smooth diffusion based inpainting of the missing regions.
 
     Returns
     -------
@@ -29,38 +46,22 @@ def imputation_expert(patch: GeoPatch) -> GeoPatch:
     # edge case
     if patch is None:
         return None
+    if mode not in _imputation_modes:
+        raise ValueError("Invalid mode. Mode must be one of 'nearest', 'linear' or 'inpaint'.")
     
     data = patch.get_raster_data()['data']
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+    data = data.astype(dtype, copy=False)
 
-    # mask nan values
-    mask = ~np.isnan(data)
-
-    # check if there are any known coordinates available
-    if np.any(mask):
-        x, y = np.meshgrid(np.arange(data.shape[1]), np.arange(data.shape[0]))
-
-        # coordinates of known values
-        known_coords = np.column_stack((x[mask], y[mask]))
-
-        # values at known coordinates
-        known_values = data[mask]
-
-        # coordinates where values need to be imputed
-        impute_coords = np.column_stack((x[~mask], y[~mask]))
-
-        # perform interpolation
-        imputed_values = griddata(known_coords, known_values, impute_coords, method='nearest')
-
-        # reshape imputed values to match original image shape
-        imputed_data = np.copy(data)
-        imputed_data[~mask] = imputed_values
+    # imputing channels independently for multi-channel rasters
+    if data.ndim == 3:
+        imputed_data = np.stack([_impute_channel(data[:, :, c], mode) for c in range(data.shape[2])], axis=2)
     else:
-        # if entire matrix is nans, fill with default value or handle as needed
-        default_value = 0.0
-        imputed_data = np.full_like(data, default_value)
+        imputed_data = _impute_channel(data, mode)
 
     out_patch = copy.deepcopy(patch)
     out_patch.set_raster_data({
+        'name': patch.raster_data.get('name'),
         'data': imputed_data, 
         'type': patch.raster_data['type'], 
         'colormap': patch.raster_data['colormap']
@@ -69,6 +70,221 @@ def imputation_expert(patch: GeoPatch) -> GeoPatch:
     return out_patch
 
 
+def _impute_channel(data: np.ndarray, mode: str) -> np.ndarray:
+    # mask nan values
+    mask = ~np.isnan(data)
+
+    # nothing to impute
+    if np.all(mask):
+        return np.copy(data)
+
+    # if entire matrix is nans, fill with default value
+    if not np.any(mask):
+        default_value = 0.0
+        return np.full_like(data, default_value)
+
+    return _imputation_modes[mode](data, mask)
+
+
+def _impute_nearest(data: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    # the distance transform returns for every pixel the index of its nearest known pixel, linear in pixel count
+    indices = np.empty((2,) + data.shape, dtype=np.int32)
+    distance_transform_edt(~mask, return_distances=False, return_indices=True, indices=indices)
+
+    missing = ~mask
+    imputed_data = np.copy(data)
+    imputed_data[missing] = data[indices[0][missing], indices[1][missing]]
+    return imputed_data
+
+
+def _impute_linear(data: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    # linear interpolation across each gap along rows and along columns, blended by inverse gap length
+    row_values, row_gaps = _interpolate_gaps(data, mask, axis=1)
+    col_values, col_gaps = _interpolate_gaps(data, mask, axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        row_weight = np.where(np.isfinite(row_gaps), 1.0 / row_gaps, 0.0).astype(data.dtype)
+        col_weight = np.where(np.isfinite(col_gaps), 1.0 / col_gaps, 0.0).astype(data.dtype)
+        weight = row_weight + col_weight
+        blended = (np.nan_to_num(row_values) * row_weight + np.nan_to_num(col_values) * col_weight) / weight
+
+    # pixels not enclosed by known values along either axis fall back to nearest fill
+    imputed_data = _impute_nearest(data, mask)
+    fill = ~mask & (weight > 0)
+    imputed_data[fill] = blended[fill]
+    return imputed_data
+
+
+def _interpolate_gaps(data: np.ndarray, mask: np.ndarray, axis: int):
+    # index of the previous and next known pixel along the axis, via running max/min, linear in pixel count
+    n = data.shape[axis]
+    positions = np.arange(n, dtype=np.int32).reshape((1, n) if axis == 1 else (n, 1))
+    prev_idx = np.maximum.accumulate(np.where(mask, positions, -1), axis=axis)
+    next_idx = np.flip(np.minimum.accumulate(np.flip(np.where(mask, positions, n), axis=axis), axis=axis), axis=axis)
+
+    enclosed = (prev_idx >= 0) & (next_idx < n)
+    prev_idx = np.clip(prev_idx, 0, n - 1)
+    next_idx = np.clip(next_idx, 0, n - 1)
+
+    prev_values = np.take_along_axis(data, prev_idx, axis=axis)
+    next_values = np.take_along_axis(data, next_idx, axis=axis)
+
+    gaps = (next_idx - prev_idx).astype(data.dtype)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = (positions - prev_idx).astype(data.dtype) / gaps
+    values = prev_values + t * (next_values - prev_values)
+
+    values[~enclosed] = np.nan
+    gaps[~enclosed] = np.inf
+    return values, gaps
+
+
+# missing regions are solved in windows of bounded size: small regions batched per block, regions up to a tile one by one,
+# and larger ones tile by tile
+INPAINT_BLOCK = 256
+INPAINT_TILE = 1024
+INPAINT_HALO = 64
+INPAINT_SWEEPS = 2
+
+
+def _impute_inpaint(data: np.ndarray, mask: np.ndarray, direct_limit: int = 100_000, maxiter: int = 500, tile: int = INPAINT_TILE, halo: int = INPAINT_HALO) -> np.ndarray:
+    # harmonic inpainting, solves the laplace equation over the missing pixels with the known pixels as boundary values.
+    # Missing regions (4-connected, like the laplacian) are independent systems, so they can be solved window by window
+    height, width = data.shape
+    labels, num_regions = label(~mask)
+    imputed_data = np.where(mask, data, np.nan).astype(np.float64)
+    linear_fill = []
+    unconverged = []
+
+    def initial_guess() -> np.ndarray:
+        # linear fill keeps the iterative solves short, computed once for all regions
+        if not linear_fill:
+            linear_fill.append(_impute_linear(data, mask).astype(np.float64))
+        return linear_fill[0]
+
+    def solve(values: np.ndarray, unknown: np.ndarray, initial: Callable[[], np.ndarray]) -> np.ndarray:
+        solution, converged = _solve_laplace(values, unknown, initial, direct_limit, maxiter)
+        if not converged:
+            unconverged.append(solution.size)
+        return solution
+
+    # bounding box of every region, and the window adding the known pixels around it
+    pixels = np.flatnonzero(labels)
+    region_of_pixel = labels.ravel()[pixels]
+    bounds = np.empty((4, num_regions + 1), dtype=np.int64)
+    bounds[[0, 2]], bounds[[1, 3]] = np.iinfo(np.int64).max, -1
+    for axis, position in ((0, pixels // width), (2, pixels % width)):
+        np.minimum.at(bounds[axis], region_of_pixel, position)
+        np.maximum.at(bounds[axis + 1], region_of_pixel, position)
+    row0, row1 = np.maximum(bounds[0] - 1, 0), np.minimum(bounds[1] + 2, height)
+    col0, col1 = np.maximum(bounds[2] - 1, 0), np.minimum(bounds[3] + 2, width)
+
+    # small regions, the most common, are batched by the block holding their top left corner
+    block_size = min(INPAINT_BLOCK, tile)
+    small = (row1 - row0 <= block_size) & (col1 - col0 <= block_size)
+    small[0] = False
+    small_regions = np.flatnonzero(small)
+    blocks, block_index = np.unique((bounds[0, small_regions] // block_size) * (width // block_size + 1) + bounds[2, small_regions] // block_size, return_inverse=True)
+    block_of_region = np.full(num_regions + 1, -1, dtype=np.int64)
+    block_of_region[small_regions] = block_index
+    block_bounds = np.empty((4, len(blocks)), dtype=np.int64)
+    block_bounds[[0, 2]], block_bounds[[1, 3]] = np.iinfo(np.int64).max, -1
+    for axis, starts, stops in ((0, row0, row1), (2, col0, col1)):
+        np.minimum.at(block_bounds[axis], block_index, starts[small_regions])
+        np.maximum.at(block_bounds[axis + 1], block_index, stops[small_regions])
+
+    for block, (r0, r1, c0, c1) in enumerate(block_bounds.T.tolist()):
+        values = imputed_data[r0:r1, c0:c1]
+        unknown = block_of_region[labels[r0:r1, c0:c1]] == block
+        values[unknown] = solve(values, unknown, lambda: initial_guess()[r0:r1, c0:c1])
+
+    for index in np.flatnonzero(~small[1:]) + 1:
+        rows, cols = slice(row0[index], row1[index]), slice(col0[index], col1[index])
+        if (rows.stop - rows.start) * (cols.stop - cols.start) <= tile * tile:
+            values = imputed_data[rows, cols]
+            unknown = labels[rows, cols] == index
+            values[unknown] = solve(values, unknown, lambda: initial_guess()[rows, cols])
+            continue
+
+        # regions larger than a tile: overlapping windows starting from the linear fill, the outer ring of each window
+        # holding the current values as boundary, and only the solution of the window interior kept
+        in_region = labels[rows, cols] == index
+        imputed_data[rows, cols][in_region] = initial_guess()[rows, cols][in_region]
+        for _ in range(INPAINT_SWEEPS):
+            for r0 in range(rows.start, rows.stop, tile):
+                for c0 in range(cols.start, cols.stop, tile):
+                    window_rows = slice(max(r0 - halo, 0), min(r0 + tile + halo, height))
+                    window_cols = slice(max(c0 - halo, 0), min(c0 + tile + halo, width))
+                    values = imputed_data[window_rows, window_cols]
+                    unknown = labels[window_rows, window_cols] == index
+                    unknown[[0, -1], :] &= [[window_rows.start == 0], [window_rows.stop == height]]
+                    unknown[:, [0, -1]] &= [window_cols.start == 0, window_cols.stop == width]
+                    if not unknown.any():
+                        continue
+                    solved = values.copy()
+                    solved[unknown] = solve(values, unknown, lambda: values)
+                    inner = (slice(r0 - window_rows.start, min(r0 + tile, height) - window_rows.start),
+                             slice(c0 - window_cols.start, min(c0 + tile, width) - window_cols.start))
+                    values[inner][unknown[inner]] = solved[inner][unknown[inner]]
+
+    if unconverged:
+        warnings.warn(f'inpainting of {sum(unconverged)} pixels did not converge within {maxiter} iterations, their imputed values are approximate', RuntimeWarning)
+    return imputed_data.astype(data.dtype, copy=False)
+
+
+def _solve_laplace(values: np.ndarray, unknown: np.ndarray, initial: Callable[[], np.ndarray], direct_limit: int, maxiter: int) -> Tuple[np.ndarray, bool]:
+    # discrete laplace equation over the unknown pixels of a window, the other pixels being boundary values,
+    # returns the solution and whether it converged
+    n = int(np.count_nonzero(unknown))
+    index = np.full(values.shape, -1, dtype=np.int64)
+    index[unknown] = np.arange(n)
+
+    rows, cols, vals = [], [], []
+    diag = np.zeros(n, dtype=np.float64)
+    rhs = np.zeros(n, dtype=np.float64)
+
+    # 4-neighbourhood as (source slice, neighbour slice) pairs
+    neighbours = [
+        ((slice(1, None), slice(None)), (slice(None, -1), slice(None))), # up
+        ((slice(None, -1), slice(None)), (slice(1, None), slice(None))), # down
+        ((slice(None), slice(1, None)), (slice(None), slice(None, -1))), # left
+        ((slice(None), slice(None, -1)), (slice(None), slice(1, None))), # right
+    ]
+    for src, dst in neighbours:
+        src_index, dst_index = index[src], index[dst]
+        src_unknown = src_index >= 0
+        diag += np.bincount(src_index[src_unknown], minlength=n)
+
+        # unknown neighbours become off-diagonal terms
+        both = src_unknown & (dst_index >= 0)
+        rows.append(src_index[both])
+        cols.append(dst_index[both])
+        vals.append(np.full(np.count_nonzero(both), -1.0))
+
+        # boundary neighbours move to the right hand side
+        boundary = src_unknown & (dst_index < 0)
+        rhs += np.bincount(src_index[boundary], weights=values[dst][boundary], minlength=n)
+
+    rows.append(np.arange(n))
+    cols.append(np.arange(n))
+    vals.append(diag)
+    laplacian = csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
+
+    if n <= direct_limit:
+        return spsolve(laplacian.tocsc(), rhs), True
+    solution, info = cg(laplacian, rhs, x0=initial()[unknown], maxiter=maxiter)
+    return solution, info == 0
+
+
+_imputation_modes = {
+    'nearest': _impute_nearest,
+    'linear': _impute_linear,
+    'inpaint': _impute_inpaint
+}
+
+
+@tracing.traced()
+@cached_expert()
 def correlation_expert(patch1: GeoPatch, patch2: GeoPatch) -> float:
     '''
     Cross-correlate the raster data within two input patches.
@@ -94,10 +310,133 @@ def correlation_expert(patch1: GeoPatch, patch2: GeoPatch) -> float:
     if data1 is None or data2 is None:
         return 0
 
-    corr = np.corrcoef(data1.flatten(), data2.flatten())[0, 1]
+    # NaN-aware, pixels missing in either raster are ignored
+    corr = _pairwise_correlation(np.stack([_as_single_channel(data1), _as_single_channel(data2)]))[0, 1]
     return float(corr)
 
 
+@tracing.traced()
+@cached_expert()
+def correlation_matrix_expert(patches: List[GeoPatch], method: str = 'pearson', spatial_lag: bool = False) -> np.ndarray:
+    '''
+    Correlate the raster data of many patches covering the same region with each other, in a single call.
+
+    Parameters
+    ----------
+        patches (List[GeoPatch]): N patches with raster data over identical geographical regions (same bbox and raster shape).
+        method (str): Possible values: ['pearson', 'spearman']. Linear or rank correlation.
+        spatial_lag (bool): If True, entry [i, j] correlates raster i with the neighbourhood average of raster j,
+            measuring whether high values of one variable lie next to high values of the other.
+
+    Returns
+    -------
+        np.ndarray: N x N correlation matrix, entry [i, j] is the correlation between patches[i] and patches[j].
+            Missing (NaN) pixels are ignored pairwise, entries are NaN if two rasters do not share enough valid pixels.
+    '''
+    # edge cases
+    if patches is None or len(patches) == 0:
+        return None
+    if method not in ['pearson', 'spearman']:
+        raise ValueError("Invalid method. Method must be either 'pearson' or 'spearman'.")
+    if any(patch is None or patch.raster_data is None or patch.raster_data['data'] is None for patch in patches):
+        raise ValueError('All patches must contain raster data.')
+    if any(patch.get_bbox() != patches[0].get_bbox() for patch in patches):
+        raise ValueError('All patches must cover identical geographical regions.')
+
+    rasters = [_as_single_channel(patch.raster_data['data']) for patch in patches]
+    if any(raster.shape != rasters[0].shape for raster in rasters):
+        raise ValueError('All patches must have raster data of identical shape.')
+    stacked = np.stack(rasters).astype(np.float64)
+
+    lagged = np.stack([_spatial_lag(raster) for raster in stacked]) if spatial_lag else None
+    if method == 'spearman':
+        return _rank_correlation(stacked, lagged)
+    return _pairwise_correlation(stacked, lagged)
+
+
+def _as_single_channel(data: np.ndarray) -> np.ndarray:
+    data = np.asarray(data)
+    return data[:, :, 0] if data.ndim == 3 else data
+
+
+def _spatial_lag(raster: np.ndarray) -> np.ndarray:
+    # NaN-aware average over the 8 neighbours of each pixel
+    valid = ~np.isnan(raster)
+    values = np.where(valid, raster, 0.0)
+    kernel = np.ones((3, 3))
+    kernel[1, 1] = 0.0
+    sums = convolve(values, kernel, mode='constant', cval=0.0)
+    counts = convolve(valid.astype(np.float64), kernel, mode='constant', cval=0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def _rank_correlation(x: np.ndarray, y: np.ndarray = None) -> np.ndarray:
+    '''
+    Spearman correlation between every raster of x (N, ...) and every raster of y (M, ...), ranking each pair over
+    the pixels valid in both.
+    '''
+    symmetric = y is None
+    y = x if y is None else y
+    x = x.reshape(len(x), -1)
+    y = y.reshape(len(y), -1)
+    x_valid, y_valid = ~np.isnan(x), ~np.isnan(y)
+
+    # with a common mask, ranking each raster once is exact and all pairs share the matrix products
+    if (x_valid == x_valid[0]).all() and (y_valid == x_valid[0]).all():
+        valid = x_valid[0]
+        x_ranks, y_ranks = np.full(x.shape, np.nan), np.full(y.shape, np.nan)
+        x_ranks[:, valid] = rankdata(x[:, valid], axis=1)
+        y_ranks[:, valid] = rankdata(y[:, valid], axis=1)
+        return _pairwise_correlation(x_ranks, None if symmetric else y_ranks)
+
+    corr = np.full((len(x), len(y)), np.nan)
+    for i in range(len(x)):
+        for j in range(i if symmetric else 0, len(y)):
+            valid = x_valid[i] & y_valid[j]
+            if valid.sum() > 1:
+                pair = np.stack([rankdata(x[i, valid]), rankdata(y[j, valid])])
+                corr[i, j] = _pairwise_correlation(pair)[0, 1]
+                if symmetric:
+                    corr[j, i] = corr[i, j]
+    return corr
+
+
+def _pairwise_correlation(x: np.ndarray, y: np.ndarray = None, chunk_size: int = 1 << 20) -> np.ndarray:
+    '''
+    Pearson correlation between every raster of x (N, ...) and every raster of y (M, ...), using for each pair
+    only the pixels valid in both. All pairs are accumulated together with matrix products over pixel chunks.
+    '''
+    y = x if y is None else y
+    x = x.reshape(len(x), -1)
+    y = y.reshape(len(y), -1)
+
+    # centering by each raster's own mean keeps the sums numerically stable
+    x = x - np.nanmean(x, axis=1, keepdims=True)
+    y = y - np.nanmean(y, axis=1, keepdims=True)
+
+    n = np.zeros((len(x), len(y)))
+    sx, sy, sxx, syy, sxy = (np.zeros_like(n) for _ in range(5))
+    for start in range(0, x.shape[1], chunk_size):
+        xc, yc = x[:, start:start + chunk_size], y[:, start:start + chunk_size]
+        mx, my = (~np.isnan(xc)).astype(np.float64), (~np.isnan(yc)).astype(np.float64)
+        xc, yc = np.nan_to_num(xc), np.nan_to_num(yc)
+
+        n += mx @ my.T
+        sx += xc @ my.T
+        sy += mx @ yc.T
+        sxx += (xc * xc) @ my.T
+        syy += mx @ (yc * yc).T
+        sxy += xc @ yc.T
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = n * sxy - sx * sy
+        var = (n * sxx - sx * sx) * (n * syy - sy * sy)
+        corr = np.where((n > 1) & (var > 0), cov / np.sqrt(var), np.nan)
+    return np.clip(corr, -1.0, 1.0)
+
+
+@tracing.traced()
 def data_to_text_expert(data: any) -> str:
     '''
     Computes the string representation for any input data.
@@ -114,6 +453,8 @@ def data_to_text_expert(data: any) -> str:
     return str_repr
 
 
+@tracing.traced()
+@cached_expert()
 def threshold_expert(patch: GeoPatch, threshold: float, mode: str = 'greater', relative: bool = True) -> GeoPatch:
     '''
     Threshold the raster data within a GeoPatch by a percent or absolute threshold.
@@ -159,6 +500,65 @@ def threshold_expert(patch: GeoPatch, threshold: float, mode: str = 'greater', r
     return thresholded_patch
 
 
+@tracing.traced()
+@cached_expert()
+def raster_algebra_expert(expression: str, patches: Dict[str, GeoPatch], name: str = None) -> GeoPatch:
+    '''
+    Evaluate an expression over the raster data of several patches covering the same region, in one pass.
+    Replaces chains of threshold_expert and intersection_expert calls, e.g.
+    raster_algebra_expert('(humidity > rel(humidity, 0.4)) & (precipitation < 0.1)', {'humidity': humidity_patch, 'precipitation': precipitation_patch})
+
+    Parameters
+    ----------
+        expression (str): Expression over the names in patches. Supports arithmetic (+, -, *, /, **), comparisons (>, <, >=, <=, ==, !=),
+            boolean operators (&, |, ~), functions abs, sqrt, log, exp, isnan, minimum, maximum, clip, where,
+            whole-raster values nanmin(x), nanmax(x), mean(x), std(x), range(x), rel(x, t) = nanmin(x) + t * range(x),
+            and threshold(x, t, mode='greater', relative=True) with the semantics of threshold_expert.
+            Comparisons with missing (NaN) values are False.
+        patches (Dict[str, GeoPatch]): Patches referenced by the expression, with raster data over identical regions.
+        name (str): Name of the resulting raster data, defaults to the expression.
+
+    Returns
+    -------
+        GeoPatch: Patch with the result as raster data. Conditions give RasterType.binary data (255.0 where true, NaN elsewhere),
+            arithmetic gives RasterType.non_color data.
+    '''
+    # edge cases
+    if patches is None or len(patches) == 0:
+        return None
+    expr = RasterExpression(expression)
+    if any(patches.get(key) is None or patches[key].raster_data is None or patches[key].raster_data['data'] is None for key in expr.names):
+        return None
+
+    referenced = [patches[key] for key in sorted(expr.names)]
+    if any(patch.get_bbox() != referenced[0].get_bbox() for patch in referenced):
+        raise ValueError('All patches in the expression must cover identical geographical regions.')
+
+    result = expr.evaluate({key: _as_single_channel(patches[key].raster_data['data']) for key in expr.names})
+
+    base = referenced[0]
+    if result.dtype == bool:
+        data = np.where(result, np.float32(255.0), np.float32(np.nan))
+        raster_type, colormap = RasterType.binary, 'gray'
+    else:
+        data = result
+        raster_type, colormap = RasterType.non_color, base.raster_data.get('colormap')
+
+    # only the vector data is copied, the result raster is the single allocation of the evaluation
+    return GeoPatch(
+        type=base.type,
+        raster_data={
+            'name': expression if name is None else name,
+            'type': raster_type,
+            'colormap': colormap,
+            'data': data
+        },
+        vector_data=copy.deepcopy(base.vector_data)
+    )
+
+
+@tracing.traced()
+@cached_expert()
 def intersection_expert(patch1: GeoPatch, patch2: GeoPatch, mode: str = 'raster') -> GeoPatch:
     '''
     Perform intersection between the vector or raster data within two geographical patches. 
@@ -172,7 +572,7 @@ def intersection_expert(patch1: GeoPatch, patch2: GeoPatch, mode: str = 'raster'
 
     Returns
     -------
-        GeoPatch: with required intersection present within vector or raster data.
+        GeoPatch: with required intersection present within vector or raster data, None if the vector intersection is empty.
     '''
     # edge cases
     if patch1 is None and patch2 is None:
@@ -182,42 +582,13 @@ def intersection_expert(patch1: GeoPatch, patch2: GeoPatch, mode: str = 'raster'
     elif patch1 is not None and patch2 is None:
         return patch1
     
-    intersect_patch = copy.deepcopy(patch1)
-
     if mode == 'vector':
-        data1 = patch1.get_vector_data()['boundary'][0] # shapely.geometry.Polygon
-        data2 = patch2.get_vector_data()['boundary'][0]
-
-        # computing intersection of boundary
-        intersection_boundary = data1.intersection(data2)
-
-        # recomputing bbox
-        bbox = intersection_boundary.bounds
+        # intersecting every boundary polygon of both patches
+        return _overlay_patches(patch1, patch2, operation='intersection')
 
-        # recomputing location
-        lat1, lon1 = patch1.vector_data['location']
-        lat2, lon2 = patch2.vector_data['location']
-
-        # finding union of points in the intersection boundary
-        data_points1 = patch1.vector_data['points']
-        data_points2 = patch2.vector_data['points']
-
-        if data_points1 is None:
-            data_points = data_points2 if data_points2 is not None else None
-        else:
-            data_points = data_points1 if data_points2 is None else (data_points1 + data_points2, data1 + data2)
-        if data_points is not None:
-            data_points = [data_point for data_point in data_points if intersection_boundary.contains(data_point.point)]
-  
-        # setting the vector data of the intersection patch
-        intersect_patch.set_vector_data({
-            'location': [0.5*(lat1 + lat2), 0.5*(lon1 + lon2)],
-            'bbox': bbox, # [min_lat, max_lat, min_lon, max_lon]
-            'points': data_points, 
-            'boundary': [intersection_boundary]
-        })
+    intersect_patch = copy.deepcopy(patch1)
 
-    elif mode == 'raster':
+    if mode == 'raster':
         data1 = patch1.get_raster_data()['data']
         data2 = patch2.get_raster_data()['data']
 
@@ -236,7 +607,136 @@ def intersection_expert(patch1: GeoPatch, patch2: GeoPatch, mode: str = 'raster'
     return intersect_patch
 
 
+@tracing.traced()
+@cached_expert()
+def overlay_expert(patch1: GeoPatch, patch2: GeoPatch, operation: str = 'intersection') -> GeoPatch:
+    '''
+    Perform an overlay operation between the boundaries of two geographical patches, across all of their boundary polygons (e.g. every island of a country).
+
+    Parameters
+    ----------
+        patch1 (GeoPatch): First patch
+        patch2 (GeoPatch): Second patch
+        operation (str): Possible values: ['intersection', 'union', 'difference', 'symmetric_difference']. 
+            'difference' keeps the parts of patch1 outside patch2.
+
+    Returns
+    -------
+        GeoPatch: Patch with the resulting boundary, and the data points of both patches lying within it. None if the result is empty.
+    '''
+    # edge cases
+    if patch1 is None or patch2 is None:
+        return patch1 if patch2 is None else (patch2 if operation in ['union', 'symmetric_difference'] else None)
+
+    return _overlay_patches(patch1, patch2, operation=operation)
+
+
+def _overlay_patches(patch1: GeoPatch, patch2: GeoPatch, operation: str) -> GeoPatch:
+    # disjoint cell covers imply an empty intersection, checked without touching the polygons
+    if operation == 'intersection' and not patch1.overlaps(patch2):
+        return None
+
+    boundary = overlay(patch1.get_vector_data().get('boundary'), patch2.get_vector_data().get('boundary'), operation=operation)
+    if len(boundary) == 0:
+        return None
+
+    # union of the points of both patches, restricted to the resulting boundary
+    data_points = (patch1.vector_data.get('points') or []) + (patch2.vector_data.get('points') or [])
+    data_points = filter_points(data_points, boundary) if len(data_points) > 0 else None
+
+    # locating the patch at a point guaranteed to lie within the result
+    location = shapely.union_all(np.asarray(boundary, dtype=object)).representative_point()
+
+    out_patch = GeoPatch(type=patch1.type, raster_data=copy.deepcopy(patch1.raster_data))
+    out_patch.set_vector_data({
+        'location': [location.y, location.x],
+        'bbox': boundary_bbox(boundary), # [min_lat, max_lat, min_lon, max_lon]
+        'points': data_points, 
+        'boundary': boundary
+    })
+    return out_patch
+
+
+@tracing.traced()
+@cached_expert()
+def zonal_statistics_expert(patch: GeoPatch, regions: Dict[str, GeoPatch], percentiles: List[float] = None) -> Dict[str, Dict[str, float]]:
+    '''
+    Compute statistics of the raster data of one patch within each of many regions, in a single call.
+    E.g. rank US states by humidity with one humidity_expert call over the whole country and the boundaries of all states.
+
+    Parameters
+    ----------
+        patch (GeoPatch): Patch with raster data covering all the regions.
+        regions (Dict[str, GeoPatch]): Region name to a patch holding the region boundary (as returned by patch_location_expert).
+        percentiles (List[float]): Percentiles between 0 and 100 to compute for every region, defaults to [25, 50, 75].
+
+    Returns
+    -------
+        Dict[str, Dict[str, float]]: For every region name, a dict with keys 'count', 'mean', 'std', 'min', 'max' and 'p<percentile>' (e.g. 'p50').
+            Missing (NaN) pixels are ignored, the values are NaN for regions without any raster pixel.
+    '''
+    # edge cases
+    if patch is None or patch.raster_data is None or patch.raster_data['data'] is None or regions is None:
+        return None
+    percentiles = [25, 50, 75] if percentiles is None else list(percentiles)
+
+    names = list(regions.keys())
+    boundaries = []
+    for name in names:
+        region = regions[name]
+        if isinstance(region, GeoPatch):
+            boundaries.append(region.get_vector_data().get('boundary') if region.vector_data is not None else None)
+        else:
+            boundaries.append(region)
+
+    # rasterizing all regions into a single label grid
+    data = _as_single_channel(patch.raster_data['data'])
+    latitudes, longitudes = patch.get_pixel_coordinates()
+    labels = rasterize_boundaries(boundaries, latitudes, longitudes)
+
+    stats = _label_statistics(data, labels, len(names), percentiles)
+    return {name: {key: values[i] for key, values in stats.items()} for i, name in enumerate(names)}
+
+
+def _label_statistics(data: np.ndarray, labels: np.ndarray, num_labels: int, percentiles: List[float]) -> Dict[str, List[float]]:
+    # per-label reductions with bincount, and a single sort for order statistics
+    valid = (labels >= 0) & ~np.isnan(data)
+    label = labels[valid]
+    values = data[valid].astype(np.float64)
+
+    count = np.bincount(label, minlength=num_labels)
+    total = np.bincount(label, weights=values, minlength=num_labels)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        sq_dev = np.bincount(label, weights=(values - mean[label]) ** 2, minlength=num_labels)
+        std = np.sqrt(sq_dev / count)
+
+    stats = {'count': count.astype(int).tolist(), 'mean': mean.tolist(), 'std': std.tolist()}
+    if len(values) == 0:
+        for key in ['min', 'max'] + [f'p{q:g}' for q in percentiles]:
+            stats[key] = [np.nan] * num_labels
+        return stats
+
+    # sorting by label then value, each region becomes a contiguous sorted run
+    sorted_values = values[np.lexsort((values, label))]
+    starts = np.minimum(np.cumsum(count) - count, len(values) - 1)
+    has_values = count > 0
+
+    stats['min'] = np.where(has_values, sorted_values[starts], np.nan).tolist()
+    stats['max'] = np.where(has_values, sorted_values[np.clip(starts + count - 1, 0, len(values) - 1)], np.nan).tolist()
+    for q in percentiles:
+        # linear interpolation between closest ranks, as np.percentile
+        position = starts + np.maximum(count - 1, 0) * q / 100.0
+        lower = np.floor(position).astype(int)
+        upper = np.minimum(lower + 1, len(values) - 1)
+        value = sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+        stats[f'p{q:g}'] = np.where(has_values, value, np.nan).tolist()
+
+    return stats
+
+
 # methods not a part of base prompt/api spec
+@tracing.traced('render')
 def patch_visualization_expert(patch: GeoPatch) -> None:
     '''
     Visualize the vector and raster data within GeoPatch on a map
@@ -258,53 +758,49 @@ def patch_visualization_expert(patch: GeoPatch) -> None:
             zoom_start=12,  # set an initial zoom level
         )
 
-        # add raster data layer if available
+        # add raster data layer if available, the overlay image is encoded once per raster and colormap
         if patch.raster_data['data'] is not None:
             raster_type = patch.raster_data['type']
-            if raster_type == RasterType.color: # color data
-                # creating image overlay
-                img = folium.raster_layers.ImageOverlay(
-                    image=patch.raster_data['data'],
-                    bounds=[[bbox[1], bbox[3]], [bbox[0], bbox[2]]],  # assuming bbox is in [min_lat, max_lat, min_lon, max_lon] format
+            shape = patch.raster_data['data'].shape
+
+            if raster_type != RasterType.color and shape[0] * shape[1] > TILE_THRESHOLD_PIXELS:
+                # large rasters are served as tiles, the map only fetches the tiles in view
+                pyramid = get_pyramid(patch)
+                rendered = {'min': pyramid.min, 'max': pyramid.max}
+                img = folium.TileLayer(
+                    tiles=tile_url(pyramid),
+                    attr=patch.raster_data['name'],
+                    name=patch.raster_data['name'],
+                    overlay=True,
                     opacity=0.6,
-                    name=patch.raster_data['name']
+                    max_native_zoom=pyramid.max_native_zoom,
+                    max_zoom=MAX_ZOOM,
+                    bounds=pyramid.get_bounds()
                 )
 
-            else: # non-color data or binary
-                data = patch.raster_data['data']
-                if len(data.shape) == 3:
-                    data = data[:,:,0] # removing channel dim
-                
-                # min-max normalization
-                min_, max_ = np.nanmin(data), np.nanmax(data)
-                norm_data = (data - min_)/(max_ - min_ + 1e-7) 
-
-                # applying the colormap
-                colormap = plt.get_cmap('gray' if patch.raster_data['colormap'] is None else patch.raster_data['colormap']) # fallback colormap
-                norm_data = colormap(norm_data)
+            else:
+                rendered = render_overlay(patch)
 
                 # creating image overlay
                 img = folium.raster_layers.ImageOverlay(
-                    image=norm_data,
+                    image=rendered['url'],
                     bounds=[[bbox[1], bbox[3]], [bbox[0], bbox[2]]],  # assuming bbox is in [min_lat, max_lat, min_lon, max_lon] format
                     opacity=0.6,
-                    name=patch.raster_data['name'])
+                    name=patch.raster_data['name']
+                )
 
-                # adding colorbar if non-color
+            # adding colorbar if non-color
+            if raster_type != RasterType.color:
+                colors = colormap_colors(patch.raster_data['colormap'])
                 if raster_type == RasterType.non_color:
-                    bar = folium.LinearColormap([colormap(i) for i in range(colormap.N)], vmin=min_, vmax=max_, max_labels=5)
-                    bar.caption = patch.raster_data['name']
-                    bar.width = 200
-                    svg_style = '<style>svg#legend {background-color: white;}</style>'
-                    m.get_root().add_child(folium.Element(svg_style))
-                    bar.add_to(m)
-                elif raster_type == RasterType.binary:
-                    bar = folium.LinearColormap([colormap(0), colormap(colormap.N)], vmin=0.0, vmax=255.0, max_labels=2)
-                    bar.caption = patch.raster_data['name']
-                    bar.width = 200
-                    svg_style = '<style>svg#legend {background-color: white;}</style>'
-                    m.get_root().add_child(folium.Element(svg_style))
-                    bar.add_to(m)
+                    bar = folium.LinearColormap(colors, vmin=rendered['min'], vmax=rendered['max'], max_labels=5)
+                else: # binary
+                    bar = folium.LinearColormap([colors[0], colors[-1]], vmin=0.0, vmax=255.0, max_labels=2)
+                bar.caption = patch.raster_data['name']
+                bar.width = 200
+                svg_style = '<style>svg#legend {background-color: white;}</style>'
+                m.get_root().add_child(folium.Element(svg_style))
+                bar.add_to(m)
 
             img.add_to(m)
 
@@ -312,26 +808,19 @@ def patch_visualization_expert(patch: GeoPatch) -> None:
         if patch.vector_data is not None:
             # add boundary polygons
             if 'boundary' in patch.vector_data and patch.vector_data['boundary'] is not None:
+                # a single layer simplified to the visible detail, instead of one layer per polygon
                 boundary_fg = folium.FeatureGroup(name='Boundary')
-                for boundary in patch.vector_data['boundary']:
-                    folium.GeoJson(
-                        boundary.__geo_interface__,
-                        name='Boundary',
-                        style_function=lambda _: {'fillColor': '#4254f5', 'color': '#4254f5'}
-                    ).add_to(boundary_fg) 
+                folium.GeoJson(
+                    render_boundary(patch),
+                    name='Boundary',
+                    style_function=lambda _: {'fillColor': '#4254f5', 'color': '#4254f5'}
+                ).add_to(boundary_fg)
                 boundary_fg.add_to(m)
 
             # add points
             if 'points' in patch.vector_data and patch.vector_data['points'] is not None:
-                points_fg = folium.FeatureGroup(name='Data markers')
-                for point in patch.vector_data['points']:
-                    folium.Marker(
-                        location=(point.point.x, point.point.y),
-                        # icon=folium.Icon(color='blue', icon='info-sign')
-                        tooltip=point.name,
-                        popup=point.data
-                    ).add_to(points_fg)
-                points_fg.add_to(m)
+                # clustered in the browser beyond MARKER_CLUSTER_THRESHOLD points
+                marker_layer(patch.vector_data['points'], name='Data markers').add_to(m)
 
         # set the view box based on the bounding box
         m.fit_bounds([[bbox[1], bbox[3]], [bbox[0], bbox[2]]])
@@ -348,7 +837,7 @@ def patch_visualization_expert(patch: GeoPatch) -> None:
     folium.LayerControl(name='Map output').add_to(m)
 
     # display the map
-    folium_static(m, width=470, height=200)
+    folium_static(m, width=MAP_WIDTH, height=MAP_HEIGHT)
 
     
 # def code_gen_expert(query: str) -> str:
@@ -402,7 +891,57 @@ def patch_visualization_expert(patch: GeoPatch) -> None:
 #     return generated_code
 
 
-def code_gen_expert(query: str, model='gpt-3.5-turbo') -> str:
+def _truncate_after_result(code: str) -> Union[str, None]:
+    # code up to and including the result line, None while the line is not complete yet
+    match = RESULT_LINE.search(code)
+    return code[:match.end()] if match is not None else None
+
+
+_spec_retriever = None
+
+
+def _get_prompt(query: str, spec_top_k: int = None) -> str:
+    # full API spec, or only the experts relevant to the query
+    global _spec_retriever
+    if spec_top_k is None:
+        with open('codegen/base_prompt.txt', 'r') as f:
+            return f.read().replace('QUERY_TAG', query)
+    if _spec_retriever is None:
+        _spec_retriever = SpecRetriever('codegen/base_prompt.txt')
+    return _spec_retriever.get_prompt(query, top_k=spec_top_k)
+
+
+def _claude_completion(client, prompt: str, on_text: Callable[[str], None] = None) -> str:
+    # one completion, streamed and cut after the result line if on_text is given
+    if on_text is None:
+        response = client.messages.create(
+            model="claude-3-opus-20240229",
+            max_tokens=2048,
+            messages=[
+                {"role": "user", "content": prompt}
+            ]
+        )
+        return response.content[0].text
+
+    code = ''
+    with client.messages.stream(
+        model="claude-3-opus-20240229",
+        max_tokens=2048,
+        messages=[
+            {"role": "user", "content": prompt}
+        ]
+    ) as stream:
+        for text in stream.text_stream:
+            code += text
+            truncated = _truncate_after_result(code)
+            on_text(code if truncated is None else truncated)
+            if truncated is not None:
+                return truncated # leaving the stream closes the connection
+    return code
+
+
+@tracing.traced('llm')
+def code_gen_expert(query: str, model='gpt-3.5-turbo', on_text: Callable[[str], None] = None, spec_top_k: int = DEFAULT_TOP_K, n: int = 1) -> Union[str, List[str]]:
     '''
     Function to facilitate talking to code generation backend and generate code
 
@@ -410,35 +949,66 @@ def code_gen_expert(query: str, model='gpt-3.5-turbo') -> str:
     ---------
         query (str): User query as typed in the chat input
         model (str): Possible values ['gpt-3-turbo', 'claude-3-opus-20240229']
+        on_text (Callable[[str], None]): If given, the completion is streamed and on_text is called with the code
+            generated so far after every chunk. Streaming stops as soon as the result = compute_answer(query) line is complete.
+            With several candidates, only the first one is streamed to on_text.
+        spec_top_k (int): Number of experts retrieved for the query on top of the core ones, None to send the full API spec.
+        n (int): Number of candidate programs. If above 1 a list of candidates is returned, sampled with n>1 from OpenAI
+            and by parallel requests from Anthropic, which has no n parameter.
     '''
 
     # fusing with base prompt
-    with open('codegen/base_prompt.txt', 'r') as f:
-        prompt = f.read()
-        prompt = prompt.replace('QUERY_TAG', query)
+    prompt = _get_prompt(query, spec_top_k)
+    tracing.annotate(model=model, candidates=n, bytes_sent=n * len(prompt.encode()) if model == 'claude-3-opus' else len(prompt.encode()))
 
     load_dotenv()
     if model == 'claude-3-opus':
-        response = anthropic.Anthropic(api_key=os.environ['CLAUDE_API_KEY']).messages.create(
-            model="claude-3-opus-20240229",
-            max_tokens=2048,
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
-        code = response.content[0].text
-        code = code.replace('(query)', f"('{query}')")
-        print(code)
-        return code
+        client = anthropic.Anthropic(api_key=os.environ['CLAUDE_API_KEY'])
+        if n == 1:
+            codes = [_claude_completion(client, prompt, on_text)]
+        else:
+            # the streamed candidate stays on the calling thread, which is the only one allowed to update the UI
+            with ThreadPoolExecutor(max_workers=n - 1) as executor:
+                futures = [tracing.submit(executor, _claude_completion, client, prompt) for _ in range(n - 1)]
+                codes = [_claude_completion(client, prompt, on_text)] + [future.result() for future in futures]
+        codes = [code.replace('(query)', f"('{query}')") for code in codes]
+        tracing.annotate(bytes_received=sum(len(code.encode()) for code in codes))
+        return codes[0] if n == 1 else codes
     
     elif model == 'gpt-3.5-turbo':
         openai = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo-0125",
-            messages=[
-                {"role": "user", "content": prompt},
-            ],
-            n=1
-        )
-        code = response.choices[0].message.content
-        return code
\ No newline at end of file
+        if on_text is None:
+            response = openai.chat.completions.create(
+                model="gpt-3.5-turbo-0125",
+                messages=[
+                    {"role": "user", "content": prompt},
+                ],
+                n=n
+            )
+            codes = [choice.message.content for choice in sorted(response.choices, key=lambda choice: choice.index)]
+        else:
+            codes, done = [''] * n, [False] * n
+            stream = openai.chat.completions.create(
+                model="gpt-3.5-turbo-0125",
+                messages=[
+                    {"role": "user", "content": prompt},
+                ],
+                n=n,
+                stream=True
+            )
+            for chunk in stream:
+                for choice in chunk.choices:
+                    if choice.delta.content is None or done[choice.index]:
+                        continue
+                    codes[choice.index] += choice.delta.content
+                    truncated = _truncate_after_result(codes[choice.index])
+                    if choice.index == 0:
+                        on_text(codes[0] if truncated is None else truncated)
+                    if truncated is not None:
+                        codes[choice.index] = truncated
+                        done[choice.index] = True
+                if all(done):
+                    stream.close()
+                    break
+        tracing.annotate(bytes_received=sum(len(code.encode()) for code in codes))
+        return codes[0] if n == 1 else codes
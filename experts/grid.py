@@ -0,0 +1,266 @@
+'''
+Hierarchical global grid (quadkey style) over latitude/longitude, shared cell vocabulary for covers, caches and spatial joins
+'''
+import numpy as np
+import shapely
+from shapely.geometry.base import BaseGeometry
+from typing import List, Tuple
+
+
+# leaf level, cells at this level are ~2.4 m (longitude, at the equator) by ~1.2 m (latitude)
+MAX_LEVEL = 24
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def _spread_bits(v: np.ndarray) -> np.ndarray:
+    # inserts a zero bit between every bit of the lower 32 bits
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+
+def _compact_bits(v: np.ndarray) -> np.ndarray:
+    # inverse of _spread_bits
+    v = v.astype(np.uint64) & np.uint64(0x5555555555555555)
+    v = (v | (v >> np.uint64(1))) & np.uint64(0x3333333333333333)
+    v = (v | (v >> np.uint64(2))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v >> np.uint64(4))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v >> np.uint64(8))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v >> np.uint64(16))) & np.uint64(0x00000000FFFFFFFF)
+    return v
+
+
+def encode(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    '''
+    Morton (Z-order) code of cell column x and row y, the quadkey as an integer.
+    '''
+    return (_spread_bits(x) | (_spread_bits(y) << np.uint64(1))).astype(np.int64)
+
+
+def decode(code: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    code = np.asarray(code).astype(np.uint64)
+    return _compact_bits(code).astype(np.int64), _compact_bits(code >> np.uint64(1)).astype(np.int64)
+
+
+def cell_bounds(level: int, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Bounds of cells as (min_lon, min_lat, max_lon, max_lat).
+    '''
+    n = float(1 << level)
+    lon_step, lat_step = 360.0 / n, 180.0 / n
+    return -180.0 + x * lon_step, -90.0 + y * lat_step, -180.0 + (x + 1) * lon_step, -90.0 + (y + 1) * lat_step
+
+
+def cell_area_km2(level: int, y: np.ndarray) -> np.ndarray:
+    '''
+    Spherical area of cells at a level, which only depends on the cell row.
+    '''
+    n = float(1 << level)
+    lat0 = np.radians(-90.0 + y * 180.0 / n)
+    lat1 = np.radians(-90.0 + (y + 1) * 180.0 / n)
+    return EARTH_RADIUS_KM ** 2 * (2.0 * np.pi / n) * (np.sin(lat1) - np.sin(lat0))
+
+
+def point_cells(lats: np.ndarray, lons: np.ndarray, level: int) -> np.ndarray:
+    '''
+    Quadkey codes of the cells containing points at a level.
+    '''
+    n = 1 << level
+    x = np.clip(((np.asarray(lons) + 180.0) / 360.0 * n).astype(np.int64), 0, n - 1)
+    y = np.clip(((np.asarray(lats) + 90.0) / 180.0 * n).astype(np.int64), 0, n - 1)
+    return encode(x, y)
+
+
+def quadkey(level: int, code: int) -> str:
+    '''
+    String token of a cell, one base-4 digit per level, e.g. '0312'.
+    '''
+    return ''.join(str((int(code) >> (2 * (level - 1 - i))) & 3) for i in range(level))
+
+
+class CellUnion():
+    '''
+    Set of grid cells of mixed levels, stored as sorted, disjoint half-open ranges of leaf cells [start, end).
+    Set operations are linear merges over the ranges, independent of the number of polygon vertices.
+
+    Attributes
+    ----------
+    starts: np.ndarray
+        First leaf code of every range.
+    ends: np.ndarray
+        One past the last leaf code of every range.
+    '''
+    def __init__(self, starts: np.ndarray = None, ends: np.ndarray = None):
+        starts = np.zeros(0, dtype=np.int64) if starts is None else np.asarray(starts, dtype=np.int64)
+        ends = np.zeros(0, dtype=np.int64) if ends is None else np.asarray(ends, dtype=np.int64)
+        self.starts, self.ends = self._normalize(starts, ends)
+
+    @staticmethod
+    def _normalize(starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # sorting and merging overlapping or adjacent ranges
+        if len(starts) == 0:
+            return starts, ends
+        order = np.argsort(starts, kind='stable')
+        starts, ends = starts[order], ends[order]
+        running_end = np.maximum.accumulate(ends)
+        new_run = np.r_[True, starts[1:] > running_end[:-1]]
+        run_ids = np.cumsum(new_run) - 1
+        merged_ends = np.zeros(run_ids[-1] + 1, dtype=np.int64)
+        np.maximum.at(merged_ends, run_ids, ends)
+        return starts[new_run], merged_ends
+
+    @classmethod
+    def from_cells(cls, level: int, codes: np.ndarray) -> 'CellUnion':
+        shift = np.int64(2 * (MAX_LEVEL - level))
+        codes = np.asarray(codes, dtype=np.int64)
+        return cls(codes << shift, (codes + 1) << shift)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __eq__(self, other: 'CellUnion') -> bool:
+        return np.array_equal(self.starts, other.starts) and np.array_equal(self.ends, other.ends)
+
+    def __repr__(self) -> str:
+        return f'CellUnion(ranges={len(self)}, leaf_cells={self.leaf_count()})'
+
+    def is_empty(self) -> bool:
+        return len(self.starts) == 0
+
+    def leaf_count(self) -> int:
+        return int(np.sum(self.ends - self.starts))
+
+    def union(self, other: 'CellUnion') -> 'CellUnion':
+        return CellUnion(np.concatenate([self.starts, other.starts]), np.concatenate([self.ends, other.ends]))
+
+    def intersection(self, other: 'CellUnion') -> 'CellUnion':
+        starts, ends = [], []
+        i = j = 0
+        while i < len(self.starts) and j < len(other.starts):
+            start = max(self.starts[i], other.starts[j])
+            end = min(self.ends[i], other.ends[j])
+            if start < end:
+                starts.append(start)
+                ends.append(end)
+            if self.ends[i] < other.ends[j]:
+                i += 1
+            else:
+                j += 1
+        return CellUnion(np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+
+    def intersects(self, other: 'CellUnion') -> bool:
+        i = j = 0
+        while i < len(self.starts) and j < len(other.starts):
+            if max(self.starts[i], other.starts[j]) < min(self.ends[i], other.ends[j]):
+                return True
+            if self.ends[i] < other.ends[j]:
+                i += 1
+            else:
+                j += 1
+        return False
+
+    def contains(self, other: 'CellUnion') -> bool:
+        return self.intersection(other).leaf_count() == other.leaf_count()
+
+    def contains_points(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        '''
+        Vectorized membership test of points.
+        '''
+        leaves = point_cells(lats, lons, MAX_LEVEL)
+        position = np.searchsorted(self.starts, leaves, side='right') - 1
+        valid = position >= 0
+        inside = np.zeros(len(leaves), dtype=bool)
+        inside[valid] = leaves[valid] < self.ends[position[valid]]
+        return inside
+
+    def cells(self) -> List[Tuple[int, int]]:
+        '''
+        Decomposes the ranges into the fewest aligned cells, as (level, code) pairs.
+        '''
+        cells = []
+        for start, end in zip(self.starts.tolist(), self.ends.tolist()):
+            while start < end:
+                # largest aligned block starting at start that fits in the range
+                k = MAX_LEVEL
+                while k > 0 and (start % (1 << (2 * k)) != 0 or start + (1 << (2 * k)) > end):
+                    k -= 1
+                cells.append((MAX_LEVEL - k, start >> (2 * k)))
+                start += 1 << (2 * k)
+        return cells
+
+    def tokens(self) -> List[str]:
+        return [quadkey(level, code) for level, code in self.cells()]
+
+    def area_km2(self) -> float:
+        area = 0.0
+        for level, code in self.cells():
+            _, y = decode(np.array([code]))
+            area += float(cell_area_km2(level, y)[0])
+        return area
+
+
+def auto_level(bounds: Tuple[float, float, float, float], cells_across: int = 16) -> int:
+    '''
+    Level at which about cells_across cells span the larger side of the bounds (min_lon, min_lat, max_lon, max_lat).
+    '''
+    min_lon, min_lat, max_lon, max_lat = bounds
+    span = max((max_lon - min_lon) / 360.0, (max_lat - min_lat) / 180.0, 1e-9)
+    return int(np.clip(np.ceil(np.log2(cells_across / span)), 0, MAX_LEVEL))
+
+
+def cover(geometry: BaseGeometry, level: int = None, max_cells: int = 4096) -> CellUnion:
+    '''
+    Covers a geometry in (lon, lat) coordinates with cells, refined down to level along the boundary.
+    Cells fully inside the geometry are kept at the coarsest level, so the cover stays compact.
+
+    Parameters
+    ----------
+        geometry (BaseGeometry): Polygon or multipolygon to cover.
+        level (int): Finest level of the cover, chosen from the geometry extent if None.
+        max_cells (int): Refinement stops early once the cover would exceed this many cells.
+
+    Returns
+    -------
+        CellUnion: Cells covering the geometry.
+    '''
+    if geometry is None or geometry.is_empty:
+        return CellUnion()
+    if level is None:
+        level = auto_level(geometry.bounds)
+    level = int(np.clip(level, 0, MAX_LEVEL))
+    shapely.prepare(geometry)
+
+    # starting from the coarsest level whose cells around the geometry are few
+    start_level = max(0, min(level, auto_level(geometry.bounds, cells_across=2)))
+    min_lon, min_lat, max_lon, max_lat = geometry.bounds
+    n = 1 << start_level
+    x0, x1 = [int(np.clip((v + 180.0) / 360.0 * n, 0, n - 1)) for v in (min_lon, max_lon)]
+    y0, y1 = [int(np.clip((v + 90.0) / 180.0 * n, 0, n - 1)) for v in (min_lat, max_lat)]
+    xs, ys = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1))
+    xs, ys = xs.ravel(), ys.ravel()
+
+    final = CellUnion()
+    for current in range(start_level, level + 1):
+        boxes = shapely.box(*cell_bounds(current, xs, ys))
+        intersecting = shapely.intersects(geometry, boxes)
+        xs, ys, boxes = xs[intersecting], ys[intersecting], boxes[intersecting]
+
+        inside = shapely.contains_properly(geometry, boxes) if current < level else np.ones(len(xs), dtype=bool)
+        final = final.union(CellUnion.from_cells(current, encode(xs[inside], ys[inside])))
+        xs, ys = xs[~inside], ys[~inside]
+
+        # refining the partially covered cells into their four children, unless the cover grows too large
+        if len(xs) == 0:
+            break
+        if len(final) + 4 * len(xs) > max_cells:
+            final = final.union(CellUnion.from_cells(current, encode(xs, ys)))
+            break
+        xs = np.concatenate([2 * xs, 2 * xs + 1, 2 * xs, 2 * xs + 1])
+        ys = np.concatenate([2 * ys, 2 * ys, 2 * ys + 1, 2 * ys + 1])
+
+    return final
@@ -0,0 +1,202 @@
+'''
+Local index of populated places, for nearest neighbour and radius queries without geocoding round trips.
+
+The index is built from the GeoNames dump of cities with a population above 15000 (about 10 MB unzipped,
+CC BY 4.0), which the first use downloads to GEODE_PLACES_PATH (~/.cache/geode/cities15000.txt by default).
+Point GEODE_PLACES_URL to a mirror, or set GEODE_PLACES_DOWNLOAD=0 and provide the file yourself to stay offline.
+'''
+import os, io, zipfile, threading
+import numpy as np
+import requests as req
+from scipy.spatial import cKDTree
+from typing import Dict, List, Tuple
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+# GeoNames dump of all cities with a population above 15000
+GEONAMES_URL = os.environ.get('GEODE_PLACES_URL', 'https://download.geonames.org/export/dump/cities15000.zip')
+DEFAULT_PLACES_PATH = os.environ.get('GEODE_PLACES_PATH', os.path.join(os.path.expanduser('~'), '.cache', 'geode', 'cities15000.txt'))
+DOWNLOAD_ENABLED = os.environ.get('GEODE_PLACES_DOWNLOAD', '1') != '0'
+
+# GeoNames feature codes included at every admin level
+LEVELS = {
+    'city': None, # every populated place
+    'admin': ('PPLC', 'PPLA', 'PPLA2', 'PPLA3', 'PPLA4', 'PPLG'), # seats of administrative divisions
+    'capital': ('PPLC',),
+}
+
+
+def to_unit_vectors(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    '''
+    Converts latitudes and longitudes (degrees) to points on the unit sphere, where chord distance is monotonic in great circle distance.
+    '''
+    lats, lons = np.radians(lats), np.radians(lons)
+    cos_lat = np.cos(lats)
+    return np.column_stack((cos_lat * np.cos(lons), cos_lat * np.sin(lons), np.sin(lats)))
+
+
+def chord_to_km(chord: np.ndarray) -> np.ndarray:
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2.0, 0.0, 1.0))
+
+
+def km_to_chord(km: float) -> float:
+    return 2.0 * np.sin(min(km / EARTH_RADIUS_KM, np.pi) / 2.0)
+
+
+class PlaceIndex():
+    '''
+    KD-tree over unit-sphere coordinates of populated places, one tree per level.
+
+    Attributes
+    ----------
+    names: np.ndarray
+        Names of the places.
+    lats, lons: np.ndarray
+        Coordinates of the places in degrees.
+    population: np.ndarray
+        Population of the places.
+    feature_codes: np.ndarray
+        GeoNames feature code of the places, e.g. 'PPLC' for capitals.
+    country_codes: np.ndarray
+        ISO country codes of the places.
+    '''
+    def __init__(self, names: List[str], lats: np.ndarray, lons: np.ndarray, population: np.ndarray,
+                 feature_codes: List[str], country_codes: List[str], alternate_names: List[List[str]] = None):
+        self.names = np.asarray(names, dtype=object)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.population = np.asarray(population, dtype=np.int64)
+        self.feature_codes = np.asarray(feature_codes, dtype=object)
+        self.country_codes = np.asarray(country_codes, dtype=object)
+        self.xyz = to_unit_vectors(self.lats, self.lons)
+
+        # name lookup, most populous place first
+        self.lookup = {}
+        for i in np.argsort(-self.population, kind='stable'):
+            keys = [self.names[i]] + (alternate_names[i] if alternate_names is not None else [])
+            for key in keys:
+                self.lookup.setdefault(key.lower(), int(i))
+
+        self.trees = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_geonames(cls, path: str) -> 'PlaceIndex':
+        '''
+        Loads a GeoNames dump (tab separated, e.g. cities15000.txt).
+        '''
+        names, alternate_names, lats, lons, population, feature_codes, country_codes = [], [], [], [], [], [], []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 15 or fields[6] != 'P':
+                    continue
+                names.append(fields[1])
+                alternate_names.append([fields[2]] + [n for n in fields[3].split(',') if n])
+                lats.append(float(fields[4]))
+                lons.append(float(fields[5]))
+                feature_codes.append(fields[7])
+                country_codes.append(fields[8])
+                population.append(int(fields[14] or 0))
+        return cls(names, lats, lons, population, feature_codes, country_codes, alternate_names)
+
+    def _level_tree(self, level: str, min_population: int) -> Tuple[cKDTree, np.ndarray]:
+        if level not in LEVELS:
+            raise ValueError(f"Invalid level. Level must be one of {', '.join(LEVELS)}.")
+        key = (level, min_population)
+        with self.lock:
+            if key not in self.trees:
+                selected = self.population >= min_population
+                if LEVELS[level] is not None:
+                    selected &= np.isin(self.feature_codes, LEVELS[level])
+                ids = np.flatnonzero(selected)
+                self.trees[key] = (cKDTree(self.xyz[ids]), ids)
+            return self.trees[key]
+
+    def find(self, name: str) -> int:
+        '''
+        Index of the most populous place with the given name, None if not found.
+        '''
+        return self.lookup.get(name.strip().lower())
+
+    def nearest(self, lat: float, lon: float, count: int = 10, level: str = 'city', min_population: int = 0,
+                radius_km: float = None, exclude: int = None) -> List[Tuple[int, float]]:
+        '''
+        Nearest places to a location, optionally within a radius.
+
+        Returns
+        -------
+        List[Tuple[int, float]]: Place indices and great circle distances (km), nearest first.
+        '''
+        if count < 1:
+            raise ValueError('count must be at least 1.')
+        tree, ids = self._level_tree(level, min_population)
+        if len(ids) == 0:
+            return []
+        center = to_unit_vectors(np.array([lat]), np.array([lon]))[0]
+
+        k = min(count + (exclude is not None), len(ids))
+        upper_bound = km_to_chord(radius_km) if radius_km is not None else np.inf
+        chords, positions = tree.query(center, k=k, distance_upper_bound=upper_bound)
+        chords, positions = np.atleast_1d(chords), np.atleast_1d(positions)
+
+        found = positions < len(ids) # missing neighbours beyond the radius are reported with index len(ids)
+        results = [(int(ids[p]), float(d)) for p, d in zip(positions[found], chord_to_km(chords[found]))]
+        return [(i, d) for i, d in results if i != exclude][:count]
+
+    def within(self, lat: float, lon: float, radius_km: float, level: str = 'city', min_population: int = 0,
+               exclude: int = None) -> List[Tuple[int, float]]:
+        '''
+        All places within a radius of a location, nearest first.
+        '''
+        tree, ids = self._level_tree(level, min_population)
+        center = to_unit_vectors(np.array([lat]), np.array([lon]))[0]
+        positions = np.asarray(tree.query_ball_point(center, km_to_chord(radius_km)), dtype=np.int64)
+        distances = chord_to_km(np.linalg.norm(self.xyz[ids[positions]] - center, axis=1))
+        order = np.argsort(distances)
+        return [(int(ids[positions[o]]), float(distances[o])) for o in order if ids[positions[o]] != exclude]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def download_geonames(path: str = DEFAULT_PLACES_PATH, url: str = GEONAMES_URL) -> str:
+    '''
+    Downloads and extracts the GeoNames cities dump, once.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    response = req.get(url, timeout=60)
+    response.raise_for_status()
+    with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+        member = [name for name in archive.namelist() if name.endswith('.txt')][0]
+        with archive.open(member) as src, open(f'{path}.tmp', 'wb') as dst:
+            dst.write(src.read())
+    os.replace(f'{path}.tmp', path)
+    return path
+
+
+def get_place_index(path: str = DEFAULT_PLACES_PATH) -> PlaceIndex:
+    '''
+    Process-wide place index, loaded (and downloaded if needed and enabled) on first use.
+    '''
+    global _index
+    with _index_lock:
+        if _index is None:
+            if not os.path.exists(path):
+                if not DOWNLOAD_ENABLED:
+                    raise FileNotFoundError(f'No GeoNames cities dump at {path}, and GEODE_PLACES_DOWNLOAD=0 disables downloading it from {GEONAMES_URL}.')
+                download_geonames(path)
+            _index = PlaceIndex.from_geonames(path)
+        return _index
+
+
+def describe_place(index: PlaceIndex, i: int) -> Dict:
+    return {
+        'name': index.names[i],
+        'lat': float(index.lats[i]),
+        'lon': float(index.lons[i]),
+        'population': int(index.population[i]),
+        'country_code': index.country_codes[i],
+    }
@@ -0,0 +1,37 @@
+'''
+Format of the code generation prompt and of the programs generated from it, shared by code_gen_expert and the local
+code generation backend
+'''
+import re
+from typing import Dict, Tuple
+
+
+EXPERTS_HEADER = '# Here are all the geospatial experts you have access to as API calls:'
+INSTRUCTIONS_HEADER = '# Instructions:'
+
+# the last line of generated code, decoding can stop once it has been emitted
+RESULT_LINE = re.compile(r'^result\s*=\s*compute_answer\(.*\).*\n', re.MULTILINE)
+
+
+def extract_prompt_entries(prompt_path: str = 'codegen/base_prompt.txt') -> Tuple[str, Dict[str, str], str]:
+    '''
+    Splits the hand maintained prompt into the core spec (helper classes and GeoPatch), one entry per expert
+    and the instructions, so the experts can be selected per query.
+
+    Returns
+    -------
+        Tuple[str, Dict[str, str], str]: Core spec up to the experts header (included), expert entries by name in prompt order, instructions.
+    '''
+    with open(prompt_path, 'r') as file:
+        prompt = file.read()
+
+    experts_start = prompt.index(EXPERTS_HEADER) + len(EXPERTS_HEADER) + 1
+    instructions_start = prompt.index(INSTRUCTIONS_HEADER)
+    header, body, footer = prompt[:experts_start], prompt[experts_start:instructions_start], prompt[instructions_start:]
+
+    entries = {}
+    for block in re.split(r'^(?=def )', body, flags=re.MULTILINE):
+        match = re.match(r'def (\w+)\(', block)
+        if match:
+            entries[match.group(1)] = block
+    return header, entries, footer
@@ -0,0 +1,251 @@
+'''
+Fused raster algebra: evaluates an expression over aligned rasters in one chunked pass, without intermediate patches
+'''
+import ast
+import numpy as np
+from typing import Dict, List
+
+from .base import merge_moments
+
+
+# elementwise functions, evaluated chunk by chunk
+_ELEMENTWISE = {
+    'abs': np.abs,
+    'sqrt': np.sqrt,
+    'log': np.log,
+    'exp': np.exp,
+    'isnan': np.isnan,
+    'minimum': np.fmin, # NaN-aware, a NaN operand is ignored
+    'maximum': np.fmax,
+    'clip': np.clip,
+    'where': np.where,
+}
+
+# global reductions, computed once over the full raster before the fused pass
+_REDUCTIONS = ['nanmin', 'nanmax', 'mean', 'std', 'range', 'rel']
+
+_BINOPS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+    ast.Mod: np.mod,
+    ast.BitAnd: np.logical_and,
+    ast.BitOr: np.logical_or,
+    ast.BitXor: np.logical_xor,
+}
+
+# comparisons involving NaN evaluate to False
+_COMPARE = {
+    ast.Gt: np.greater,
+    ast.Lt: np.less,
+    ast.GtE: np.greater_equal,
+    ast.LtE: np.less_equal,
+    ast.Eq: np.equal,
+    ast.NotEq: lambda a, b: np.logical_and(np.not_equal(a, b), ~(np.isnan(a) | np.isnan(b))),
+}
+
+
+class RasterExpression():
+    '''
+    Expression over named rasters, e.g. "(humidity > rel(humidity, 0.4)) & (precipitation < 0.1)".
+
+    Supported syntax
+    ----------------
+        - arithmetic: +, -, *, /, **, %, unary -
+        - comparisons (NaN compares False): >, <, >=, <=, ==, !=, chained comparisons
+        - boolean: &, |, ^, ~, and, or, not
+        - elementwise functions: abs, sqrt, log, exp, isnan, minimum, maximum, clip, where
+        - reductions over the whole raster: nanmin(x), nanmax(x), mean(x), std(x), range(x), rel(x, t) = nanmin(x) + t * range(x)
+        - threshold(x, t, mode='greater', relative=True): mask with the semantics of threshold_expert
+    '''
+    def __init__(self, expression: str):
+        self.expression = expression
+        try:
+            self.tree = ast.parse(expression.strip(), mode='eval').body
+        except SyntaxError as e:
+            raise ValueError(f'Invalid raster expression: {expression}') from e
+        self.names = set()
+        self._validate(self.tree)
+
+    def _validate(self, node: ast.AST) -> None:
+        if isinstance(node, ast.Name):
+            self.names.add(node.id)
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float, bool, str)):
+                raise ValueError(f'Unsupported constant in raster expression: {node.value!r}')
+        elif isinstance(node, ast.BinOp):
+            if type(node.op) not in _BINOPS:
+                raise ValueError(f'Unsupported operator in raster expression: {type(node.op).__name__}')
+            self._validate(node.left)
+            self._validate(node.right)
+        elif isinstance(node, ast.UnaryOp):
+            if not isinstance(node.op, (ast.USub, ast.UAdd, ast.Not, ast.Invert)):
+                raise ValueError(f'Unsupported operator in raster expression: {type(node.op).__name__}')
+            self._validate(node.operand)
+        elif isinstance(node, ast.BoolOp):
+            for value in node.values:
+                self._validate(value)
+        elif isinstance(node, ast.Compare):
+            if any(type(op) not in _COMPARE for op in node.ops):
+                raise ValueError('Unsupported comparison in raster expression.')
+            self._validate(node.left)
+            for comparator in node.comparators:
+                self._validate(comparator)
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in list(_ELEMENTWISE) + _REDUCTIONS + ['threshold']:
+                raise ValueError(f'Unsupported function in raster expression: {ast.unparse(node.func)}')
+            for arg in node.args:
+                self._validate(arg)
+            for keyword in node.keywords:
+                self._validate(keyword.value)
+        else:
+            raise ValueError(f'Unsupported syntax in raster expression: {ast.unparse(node)}')
+
+    def evaluate(self, rasters: Dict[str, np.ndarray], chunk_pixels: int = 1 << 18) -> np.ndarray:
+        '''
+        Evaluates the expression over aligned 2D rasters in row chunks, allocating only the output raster.
+
+        Parameters
+        ----------
+            rasters (Dict[str, np.ndarray]): Rasters referenced by the expression, all of identical shape.
+            chunk_pixels (int): Approximate number of pixels per chunk, bounding the size of temporaries.
+
+        Returns
+        -------
+            np.ndarray: Result of the expression, boolean if the expression is a condition.
+        '''
+        missing = self.names - set(rasters.keys())
+        if missing:
+            raise ValueError(f"Unknown rasters in expression: {', '.join(sorted(missing))}")
+
+        shape = next(iter(rasters[name].shape for name in self.names)) if self.names else None
+        if shape is None:
+            raise ValueError('Raster expression must reference at least one raster.')
+        if any(rasters[name].shape != shape for name in self.names):
+            raise ValueError('All rasters in the expression must have identical shape.')
+
+        # global reductions are resolved to scalars up front
+        scalars = {}
+        self._resolve_reductions(self.tree, rasters, shape, chunk_pixels, scalars)
+
+        out = None
+        rows_per_chunk = max(1, chunk_pixels // max(1, int(np.prod(shape[1:]))))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for start in range(0, shape[0], rows_per_chunk):
+                rows = slice(start, start + rows_per_chunk)
+                chunk = self._eval(self.tree, {name: rasters[name][rows] for name in self.names}, scalars)
+                chunk = np.broadcast_to(chunk, rasters[next(iter(self.names))][rows].shape)
+                if out is None:
+                    dtype = bool if chunk.dtype == bool else np.result_type(chunk.dtype, np.float32)
+                    out = np.empty(shape, dtype=dtype)
+                out[rows] = chunk
+        return out
+
+    def _resolve_reductions(self, node: ast.AST, rasters: Dict, shape, chunk_pixels: int, scalars: Dict) -> None:
+        for child in ast.iter_child_nodes(node):
+            self._resolve_reductions(child, rasters, shape, chunk_pixels, scalars)
+
+        if isinstance(node, ast.Call) and node.func.id in _REDUCTIONS + ['threshold']:
+            if not node.args:
+                raise ValueError(f'{node.func.id}() expects a raster argument.')
+            arg = node.args[0]
+            key = ast.dump(arg)
+            if key in scalars:
+                return
+
+            # streaming min, max and moments of the argument sub-expression
+            sub = RasterExpression.__new__(RasterExpression)
+            sub.expression, sub.tree, sub.names = ast.unparse(arg), arg, set()
+            sub._validate(arg)
+            count, mean, m2, min_, max_ = 0, 0.0, 0.0, np.inf, -np.inf
+            rows_per_chunk = max(1, chunk_pixels // max(1, int(np.prod(shape[1:]))))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                for start in range(0, shape[0], rows_per_chunk):
+                    rows = slice(start, start + rows_per_chunk)
+                    values = np.asarray(sub._eval(arg, {name: rasters[name][rows] for name in sub.names}, scalars), dtype=np.float64)
+                    values = values[~np.isnan(values)]
+                    if values.size == 0:
+                        continue
+                    count, mean, m2 = merge_moments(count, mean, m2, values)
+                    min_, max_ = min(min_, values.min()), max(max_, values.max())
+
+            if count == 0:
+                min_ = max_ = mean = std = np.nan
+            else:
+                std = np.sqrt(m2 / count)
+            # python floats keep the dtype of the rasters (e.g. float32) in the fused pass
+            scalars[key] = {'nanmin': float(min_), 'nanmax': float(max_), 'mean': float(mean), 'std': float(std), 'range': float(max_ - min_)}
+
+    def _eval(self, node: ast.AST, chunk: Dict[str, np.ndarray], scalars: Dict):
+        if isinstance(node, ast.Name):
+            return chunk[node.id]
+        elif isinstance(node, ast.Constant):
+            return node.value
+        elif isinstance(node, ast.BinOp):
+            return _BINOPS[type(node.op)](self._eval(node.left, chunk, scalars), self._eval(node.right, chunk, scalars))
+        elif isinstance(node, ast.UnaryOp):
+            operand = self._eval(node.operand, chunk, scalars)
+            if isinstance(node.op, ast.USub):
+                return np.negative(operand)
+            elif isinstance(node.op, ast.UAdd):
+                return operand
+            return np.logical_not(operand)
+        elif isinstance(node, ast.BoolOp):
+            op = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            result = self._eval(node.values[0], chunk, scalars)
+            for value in node.values[1:]:
+                result = op(result, self._eval(value, chunk, scalars))
+            return result
+        elif isinstance(node, ast.Compare):
+            result, left = None, self._eval(node.left, chunk, scalars)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self._eval(comparator, chunk, scalars)
+                part = _COMPARE[type(op)](left, right)
+                result = part if result is None else np.logical_and(result, part)
+                left = right
+            return result
+        elif isinstance(node, ast.Call):
+            return self._eval_call(node, chunk, scalars)
+        raise ValueError(f'Unsupported syntax in raster expression: {ast.unparse(node)}')
+
+    def _eval_call(self, node: ast.Call, chunk: Dict[str, np.ndarray], scalars: Dict):
+        name = node.func.id
+        kwargs = {keyword.arg: self._eval(keyword.value, chunk, scalars) for keyword in node.keywords}
+
+        if name in _ELEMENTWISE:
+            args = [self._eval(arg, chunk, scalars) for arg in node.args]
+            return _ELEMENTWISE[name](*args, **kwargs)
+
+        stats = scalars[ast.dump(node.args[0])]
+        if name == 'rel':
+            t = self._eval(node.args[1], chunk, scalars) if len(node.args) > 1 else kwargs['t']
+            return stats['nanmin'] + t * stats['range']
+        elif name == 'threshold':
+            # same semantics as threshold_expert, returned as a mask
+            args = [self._eval(arg, chunk, scalars) for arg in node.args[1:]]
+            params = dict(zip(['threshold', 'mode', 'relative'], args), **kwargs)
+            mode, relative = params.get('mode', 'greater'), params.get('relative', True)
+            threshold_val = stats['nanmin'] + params['threshold'] * stats['range'] if relative is True else params['threshold']
+            values = self._eval(node.args[0], chunk, scalars)
+            if mode == 'greater':
+                return np.greater(values, threshold_val)
+            elif mode == 'less':
+                return np.less(values, threshold_val)
+            raise ValueError("Invalid mode. Mode must be either 'greater' or 'less'.")
+        return stats[name]
+
+
+def evaluate_expression(expression: str, rasters: Dict[str, np.ndarray], chunk_pixels: int = 1 << 18) -> np.ndarray:
+    '''
+    Parses and evaluates a raster expression, see RasterExpression for the supported syntax.
+    '''
+    return RasterExpression(expression).evaluate(rasters, chunk_pixels=chunk_pixels)
+
+
+def expression_names(expression: str) -> List[str]:
+    '''
+    Returns the raster names referenced by an expression.
+    '''
+    return sorted(RasterExpression(expression).names)
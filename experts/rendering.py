@@ -0,0 +1,258 @@
+'''
+Raster overlay rendering for the map output, with colormap lookup tables and a cache of encoded PNG images
+'''
+import io, json, base64, threading
+import numpy as np
+import shapely
+import matplotlib.pyplot as plt
+from functools import lru_cache
+from PIL import Image
+import folium
+from folium.plugins import FastMarkerCluster
+from folium.utilities import write_png
+from typing import Dict, List
+from shapely.geometry.base import BaseGeometry
+
+from .base import GeoPatch, RasterType, DataPoint
+from .cache import CacheEntry, MemoryBackend
+from . import tracing
+
+
+# memory budget of the encoded overlays (bytes), a few dozen country-scale rasters
+OVERLAY_CACHE_BYTES = 64 * 1024 * 1024
+
+# zlib level of the overlay PNGs, higher levels are much slower for little size gain on rasters
+PNG_COMPRESS_LEVEL = 3
+
+_overlays = MemoryBackend(max_bytes=OVERLAY_CACHE_BYTES)
+_overlays_lock = threading.Lock()
+
+
+# size of the map output (pixels)
+MAP_WIDTH, MAP_HEIGHT = 470, 200
+
+# zoom levels beyond the fitted view at which simplified boundaries still look exact
+ZOOM_HEADROOM = 2
+
+TILE_SIZE = 256
+
+# number of data points beyond which markers are clustered in the browser
+MARKER_CLUSTER_THRESHOLD = 200
+
+# palette index of missing (NaN) pixels, fully transparent
+NAN_INDEX = 255
+
+
+@lru_cache(maxsize=64)
+def colormap_lut(name: str) -> np.ndarray:
+    '''
+    Samples a matplotlib colormap once into a (256, 4) uint8 RGBA palette,
+    255 levels followed by the transparent NAN_INDEX entry.
+    '''
+    colormap = plt.get_cmap('gray' if name is None else name) # fallback colormap
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    lut[:NAN_INDEX] = np.round(colormap(np.linspace(0.0, 1.0, NAN_INDEX)) * 255).astype(np.uint8)
+    lut.setflags(write=False)
+    return lut
+
+
+def colormap_colors(name: str) -> list:
+    '''
+    Colors of a colormap as RGBA tuples in [0, 1], for the colorbar legend.
+    '''
+    return [tuple(c) for c in (colormap_lut(name)[:NAN_INDEX] / 255.0).tolist()]
+
+
+def quantize(data: np.ndarray, min_: float, max_: float, chunk_pixels: int = 1 << 20) -> np.ndarray:
+    # min-max normalization straight into uint8 palette indices, row chunk by row chunk
+    indices = np.full(data.shape, NAN_INDEX, dtype=np.uint8)
+    scale = (NAN_INDEX - 1) / (max_ - min_ + 1e-7)
+    rows_per_chunk = max(1, chunk_pixels // max(1, data.shape[1]))
+    with np.errstate(invalid='ignore'):
+        for start in range(0, data.shape[0], rows_per_chunk):
+            chunk = data[start:start + rows_per_chunk]
+            valid = ~np.isnan(chunk)
+            indices[start:start + rows_per_chunk][valid] = np.clip((chunk[valid] - min_) * scale + 0.5, 0, NAN_INDEX - 1).astype(np.uint8)
+    return indices
+
+
+def palette_png(indices: np.ndarray, lut: np.ndarray) -> bytes:
+    '''
+    Encodes palette indices as a PNG, one byte per pixel instead of four, the palette carries the alpha channel.
+    '''
+    image = Image.fromarray(indices, mode='P')
+    image.putpalette(lut.ravel().tobytes(), rawmode='RGBA')
+    buffer = io.BytesIO()
+    image.save(buffer, format='png', compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+
+def _data_url(png: bytes) -> str:
+    return 'data:image/png;base64,' + base64.b64encode(png).decode('ascii')
+
+
+@tracing.traced('render')
+def render_overlay(patch: GeoPatch) -> Dict:
+    '''
+    Renders the raster data of a patch into a PNG data URL, encoded once per raster and colormap.
+
+    Parameters
+    ----------
+        patch (GeoPatch): Patch with raster data.
+
+    Returns
+    -------
+        Dict: with keys 'url' (str) PNG data URL for folium.raster_layers.ImageOverlay,
+            'min' and 'max' (float) value range of non-color rasters, None for color rasters.
+    '''
+    raster_data = patch.raster_data
+    colormap = raster_data.get('colormap')
+    key = f"{patch.get_fingerprint()}:{colormap}"
+
+    with _overlays_lock:
+        entry = _overlays.get(key)
+    if entry is not None:
+        return entry.value
+
+    data = np.asarray(raster_data['data'])
+    if raster_data['type'] == RasterType.color: # color data
+        # same normalization as folium, only encoded once
+        png = write_png(data, origin='upper')
+        rendered = {'url': _data_url(png), 'min': None, 'max': None}
+    else: # non-color data or binary
+        if data.ndim == 3:
+            data = data[:, :, 0] # removing channel dim
+        min_, max_ = float(np.nanmin(data)), float(np.nanmax(data))
+        indices = quantize(data, min_, max_)
+        rendered = {'url': _data_url(palette_png(indices, colormap_lut(colormap))), 'min': min_, 'max': max_}
+
+    with _overlays_lock:
+        _overlays.put(key, CacheEntry(rendered, len(rendered['url']) + 256, 0.0))
+    return rendered
+
+
+def clear_overlays() -> None:
+    with _overlays_lock:
+        _overlays.clear()
+
+
+def _mercator_y(lat: float) -> float:
+    lat = np.radians(np.clip(lat, -85.0511, 85.0511))
+    return np.log(np.tan(np.pi / 4 + lat / 2)) / (2 * np.pi) # in world widths
+
+
+def fit_zoom(bbox: List[float], width: int = MAP_WIDTH, height: int = MAP_HEIGHT) -> int:
+    '''
+    Web Mercator zoom level at which the bbox [min_lat, max_lat, min_lon, max_lon] fits a map of width x height pixels, as Leaflet's fitBounds.
+    '''
+    lon_span = max((bbox[3] - bbox[2]) / 360.0, 1e-9)
+    lat_span = max(_mercator_y(bbox[1]) - _mercator_y(bbox[0]), 1e-9)
+    zoom = min(np.log2(width / (TILE_SIZE * lon_span)), np.log2(height / (TILE_SIZE * lat_span)))
+    return int(np.clip(np.floor(zoom), 0, 22))
+
+
+def boundary_geojson(boundary: List[BaseGeometry], bbox: List[float], width: int = MAP_WIDTH, height: int = MAP_HEIGHT) -> Dict:
+    '''
+    Boundary polygons as a single GeoJSON FeatureCollection, simplified to the detail visible at the fitted zoom (plus ZOOM_HEADROOM).
+    Parts smaller than a pixel are dropped and coordinates are rounded to the simplification grid, which bounds the payload
+    by the map size instead of the vertex count of the boundary.
+
+    Parameters
+    ----------
+        boundary (List[BaseGeometry]): Boundary polygons or multipolygons in (lon, lat).
+        bbox (List[float]): View box of the map, [min_lat, max_lat, min_lon, max_lon].
+        width, height (int): Size of the map in pixels.
+
+    Returns
+    -------
+        Dict: GeoJSON FeatureCollection, one feature per boundary geometry.
+    '''
+    # size of a pixel in degrees, the latitude extent of a pixel shrinks away from the equator
+    zoom = fit_zoom(bbox, width, height) + ZOOM_HEADROOM
+    pixel = 360.0 / (TILE_SIZE * 2 ** zoom) * np.cos(np.radians(min(max(abs(bbox[0]), abs(bbox[1])), 85.0)))
+    tolerance = pixel / 2
+    decimals = int(np.clip(np.ceil(-np.log10(tolerance / 2)), 1, 7))
+
+    features = []
+    for geometry in boundary:
+        parts = shapely.get_parts(geometry)
+        parts = parts[shapely.area(parts) >= pixel * pixel] # sub-pixel islands
+        if len(parts) == 0:
+            continue
+        parts = shapely.simplify(parts, tolerance, preserve_topology=True)
+        parts = shapely.transform(parts, lambda coords: np.round(coords, decimals))
+        parts = parts[~shapely.is_empty(parts)]
+        if len(parts) == 0:
+            continue
+        simplified = parts[0] if len(parts) == 1 else shapely.multipolygons(parts)
+        features.append({'type': 'Feature', 'properties': {}, 'geometry': simplified.__geo_interface__})
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+@tracing.traced('render')
+def render_boundary(patch: GeoPatch, width: int = MAP_WIDTH, height: int = MAP_HEIGHT) -> Dict:
+    '''
+    Cached boundary_geojson of a patch, reused across reruns of the map output.
+    '''
+    key = f"boundary:{patch.get_fingerprint()}:{width}x{height}"
+    with _overlays_lock:
+        entry = _overlays.get(key)
+    if entry is not None:
+        return entry.value
+
+    geojson = boundary_geojson(patch.vector_data['boundary'], patch.vector_data['bbox'], width, height)
+    with _overlays_lock:
+        _overlays.put(key, CacheEntry(geojson, len(json.dumps(geojson)) + 256, 0.0))
+    return geojson
+
+
+# builds the marker of a [lat, lon, name, data] row on the client, with the same tooltip and popup as folium.Marker
+_MARKER_CALLBACK = """
+    var callback = function (row) {
+        var marker = L.marker(new L.LatLng(row[0], row[1]));
+        if (row[2] !== null) marker.bindTooltip(String(row[2]));
+        if (row[3] !== null) marker.bindPopup(String(row[3]));
+        return marker;
+    };
+"""
+
+
+def _json_value(value):
+    if value is None or isinstance(value, (str, bool, int)):
+        return value
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else round(float(value), 6)
+    if isinstance(value, np.integer):
+        return int(value)
+    return str(value)
+
+
+@tracing.traced('render')
+def marker_layer(points: List[DataPoint], name: str = 'Data markers', threshold: int = MARKER_CLUSTER_THRESHOLD):
+    '''
+    Map layer of data points: individual markers for a few points, otherwise a client-side cluster fed by a compact
+    [lat, lon, name, data] array, so the page grows by a few bytes per point instead of a marker object per point.
+
+    Parameters
+    ----------
+        points (List[DataPoint]): Data points to display.
+        name (str): Name of the layer in the layer control.
+        threshold (int): Number of points beyond which markers are clustered.
+
+    Returns
+    -------
+        folium.FeatureGroup or folium.plugins.FastMarkerCluster: Layer to add to the map.
+    '''
+    if len(points) <= threshold:
+        points_fg = folium.FeatureGroup(name=name)
+        for point in points:
+            folium.Marker(
+                location=(point.point.x, point.point.y),
+                tooltip=point.name,
+                popup=point.data
+            ).add_to(points_fg)
+        return points_fg
+
+    rows = [[round(point.point.x, 6), round(point.point.y, 6), _json_value(point.name), _json_value(point.data)] for point in points]
+    return FastMarkerCluster(rows, callback=_MARKER_CALLBACK, name=name, chunkedLoading=True)
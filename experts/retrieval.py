@@ -0,0 +1,142 @@
+'''
+BM25 retrieval over the expert entries of the API spec, so each prompt only carries the experts relevant to its query
+'''
+import re
+import math
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from .prompt import extract_prompt_entries
+
+
+# experts every program needs to get started, always part of the prompt
+CORE_EXPERTS = ['point_location_expert', 'patch_location_expert', 'data_to_text_expert']
+
+DEFAULT_TOP_K = 8
+
+# experts scoring below this fraction of the best match are left out, even within the top k
+MIN_RELATIVE_SCORE = 0.25
+
+STOPWORDS = {
+    'a', 'an', 'the', 'of', 'in', 'on', 'at', 'to', 'for', 'and', 'or', 'is', 'are', 'was', 'be', 'by', 'with', 'as',
+    'it', 'its', 'this', 'that', 'from', 'me', 'show', 'what', 'which', 'where', 'how', 'do', 'does', 'can', 'i', 'you',
+    'if', 'else', 'not', 'all', 'any', 'str', 'float', 'int', 'none', 'geopatch', 'patch', 'returns', 'parameters',
+}
+
+# everyday query words mapped to the vocabulary of the expert docstrings
+SYNONYMS = {
+    'hot': ['temperature'], 'cold': ['temperature'], 'warm': ['temperature'], 'heat': ['temperature'],
+    'rain': ['precipitation'], 'rainfall': ['precipitation'], 'rainy': ['precipitation'], 'wet': ['precipitation', 'humidity'], 'dry': ['humidity', 'precipitation'],
+    'humid': ['humidity'], 'pollution': ['air', 'quality'], 'polluted': ['air', 'quality'], 'smog': ['air', 'quality'],
+    'height': ['elevation'], 'altitude': ['elevation'], 'mountain': ['elevation'], 'high': ['elevation', 'threshold'],
+    'near': ['nearest', 'proximity'], 'nearby': ['nearest', 'proximity'], 'closest': ['nearest', 'proximity'], 'around': ['proximity', 'radius'],
+    'cities': ['city', 'proximity'], 'towns': ['city', 'proximity'], 'capital': ['capital', 'proximity'],
+    'both': ['intersection', 'overlay'], 'overlap': ['intersection', 'overlay'], 'common': ['intersection'], 'border': ['overlay', 'boundary'],
+    'more': ['threshold', 'greater'], 'less': ['threshold', 'less'], 'above': ['threshold', 'greater'], 'below': ['threshold', 'less'],
+    'percent': ['threshold', 'relative'], 'related': ['correlation'], 'relationship': ['correlation'], 'compare': ['correlation', 'zonal'],
+    'average': ['mean', 'zonal', 'statistics'], 'each': ['zonal', 'regions'], 'per': ['zonal', 'regions'], 'missing': ['imputation'],
+}
+
+
+def tokenize(text: str) -> List[str]:
+    '''
+    Lowercase word tokens with snake_case names split up and plural endings dropped.
+    '''
+    words = re.findall(r'[a-z0-9]+', text.lower().replace('_', ' '))
+    tokens = []
+    for word in words:
+        if word in STOPWORDS or len(word) < 2:
+            continue
+        if len(word) > 4 and word.endswith('ies'):
+            word = word[:-3] + 'y'
+        elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def expand_query(query: str) -> List[str]:
+    words = re.findall(r'[a-z0-9]+', query.lower())
+    expanded = tokenize(query)
+    for word in words:
+        expanded += tokenize(' '.join(SYNONYMS.get(word, [])))
+    return expanded
+
+
+class BM25Index():
+    '''
+    Okapi BM25 over a handful of documents, small enough to rebuild at startup.
+
+    Parameters
+    ----------
+        documents (Dict[str, str]): Text of the documents by name.
+        k1 (float): Term frequency saturation.
+        b (float): Document length normalization.
+    '''
+    def __init__(self, documents: Dict[str, str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.names = list(documents)
+        self.term_counts = [Counter(tokenize(text)) for text in documents.values()]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.average_length = sum(self.lengths) / max(len(self.lengths), 1)
+
+        document_frequency = Counter(term for counts in self.term_counts for term in counts)
+        n = len(self.names)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+
+    def scores(self, query_tokens: List[str]) -> Dict[str, float]:
+        scores = {}
+        query_counts = Counter(query_tokens)
+        for name, counts, length in zip(self.names, self.term_counts, self.lengths):
+            score = 0.0
+            for term, weight in query_counts.items():
+                tf = counts.get(term, 0)
+                if tf == 0:
+                    continue
+                norm = tf + self.k1 * (1 - self.b + self.b * length / self.average_length)
+                score += weight * self.idf[term] * tf * (self.k1 + 1) / norm
+            scores[name] = score
+        return scores
+
+    def search(self, query_tokens: List[str], k: int) -> List[Tuple[str, float]]:
+        scores = self.scores(query_tokens)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return [(name, score) for name, score in ranked[:k] if score > 0]
+
+
+class SpecRetriever():
+    '''
+    Builds prompts holding the core spec (helper classes and GeoPatch), the core experts and the top_k experts
+    most relevant to the query, in the order of base_prompt.txt.
+
+    Parameters
+    ----------
+        prompt_path (str): Prompt template with the full API spec.
+        top_k (int): Number of retrieved experts on top of CORE_EXPERTS.
+    '''
+    def __init__(self, prompt_path: str = 'codegen/base_prompt.txt', top_k: int = DEFAULT_TOP_K):
+        self.header, self.entries, self.footer = extract_prompt_entries(prompt_path)
+        self.top_k = top_k
+        # expert names are repeated so that a query naming the data (e.g. "humidity") ranks its expert first
+        self.index = BM25Index({name: f'{name} {name} {entry}' for name, entry in self.entries.items()})
+
+    def select(self, query: str, top_k: int = None) -> List[str]:
+        '''
+        Names of the experts to include for a query.
+        '''
+        top_k = self.top_k if top_k is None else top_k
+        query_tokens = expand_query(query)
+        ranked = [(name, score) for name, score in self.index.search(query_tokens, len(self.entries)) if name not in CORE_EXPERTS]
+        min_score = ranked[0][1] * MIN_RELATIVE_SCORE if ranked else 0.0
+        selected = set(CORE_EXPERTS) | {name for name, score in ranked[:top_k] if score >= min_score}
+        # experts whose data the query names outright (e.g. "humidity", "air quality") are always included
+        selected |= {name for name in self.entries if set(tokenize(name)) - {'expert'} <= set(query_tokens)}
+        return [name for name in self.entries if name in selected]
+
+    def get_prompt(self, query: str, top_k: int = None) -> str:
+        '''
+        Prompt template with the relevant experts only and the query filled in.
+        '''
+        entries = ''.join(self.entries[name] for name in self.select(query, top_k))
+        return (self.header + entries + self.footer).replace('QUERY_TAG', query)
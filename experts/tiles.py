@@ -0,0 +1,288 @@
+'''
+XYZ tile pyramid of raster data, with downsampled overviews, tiles rendered on first request into a cache directory
+and served by a local HTTP endpoint, so the map only fetches the tiles in view.
+
+The endpoint is a separate HTTP server that the browser fetches tiles from directly. It binds GEODE_TILE_HOST
+(127.0.0.1 by default) on GEODE_TILE_PORT (a random free port by default), so by default the map only shows tiles when
+the browser runs on the same machine as the app. When the app is served to other machines, bind a reachable host and a
+fixed port, and set GEODE_TILE_URL to the URL the browser should use (e.g. a reverse proxy route to the port).
+
+Rendered tiles are kept in GEODE_TILE_DIR, up to GEODE_TILE_CACHE_MB megabytes; beyond it, the tiles of the least
+recently used pyramids are deleted.
+'''
+import os, re, shutil, threading
+import numpy as np
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List
+
+from .base import GeoPatch
+from . import tracing
+from .rendering import TILE_SIZE, NAN_INDEX, colormap_lut, quantize, palette_png
+
+
+# rasters with more pixels than this are displayed as tiles instead of a single image overlay
+TILE_THRESHOLD_PIXELS = 2048 * 2048
+
+TILE_CACHE_DIR = os.environ.get('GEODE_TILE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'geode', 'tiles'))
+TILE_CACHE_MAX_BYTES = int(os.environ.get('GEODE_TILE_CACHE_MB', 1024)) << 20
+
+# pyramids kept in memory for the tile endpoint, least recently registered ones are dropped
+MAX_PYRAMIDS = 8
+
+MAX_ZOOM = 22
+
+_TILE_PATH = re.compile(r'^/(\w+)/(\d+)/(\d+)/(\d+)\.png$')
+
+
+def _overview(data: np.ndarray) -> np.ndarray:
+    # 2x2 mean ignoring NaN, odd sizes are padded with NaN
+    height, width = data.shape
+    padded = np.full((height + height % 2, width + width % 2), np.nan, dtype=np.float32)
+    padded[:height, :width] = data
+    blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+    valid = ~np.isnan(blocks)
+    count = valid.sum(axis=(1, 3))
+    total = np.where(valid, blocks, 0).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan).astype(np.float32)
+
+
+def tile_pixel_coordinates(z: int, x: int, y: int):
+    '''
+    Latitudes and longitudes of the pixel centers of a Web Mercator tile, as two 1D arrays.
+    '''
+    world = TILE_SIZE * (1 << z)
+    offsets = np.arange(TILE_SIZE) + 0.5
+    longitudes = (x * TILE_SIZE + offsets) / world * 360.0 - 180.0
+    latitudes = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y * TILE_SIZE + offsets) / world))))
+    return latitudes, longitudes
+
+
+class RasterPyramid():
+    '''
+    Tile pyramid of a non-color raster, every level halving the resolution of the previous one.
+
+    Attributes
+    ----------
+    id: str
+        Identifier of the pyramid, derived from the GeoPatch fingerprint.
+    levels: List[np.ndarray]
+        Full resolution raster followed by its overviews, down to a single tile.
+    bbox: List[float]
+        Bounding box of the raster [min_lat, max_lat, min_lon, max_lon].
+    min, max: float
+        Value range used for the colormap, shared by all tiles.
+    max_native_zoom: int
+        Zoom at which tiles reach the full raster resolution, deeper zooms are upscaled by the map.
+    '''
+    def __init__(self, patch: GeoPatch, cache_dir: str = TILE_CACHE_DIR):
+        data = np.asarray(patch.raster_data['data'])
+        if data.ndim == 3:
+            data = data[:, :, 0] # removing channel dim
+        if not np.issubdtype(data.dtype, np.floating):
+            data = data.astype(np.float32)
+
+        self.id = patch.get_fingerprint()[:20]
+        self.bbox = patch.vector_data['bbox']
+        self.lut = colormap_lut(patch.raster_data.get('colormap'))
+        self.min, self.max = float(np.nanmin(data)), float(np.nanmax(data))
+        self.cache_dir = os.path.join(cache_dir, self.id)
+        _touch(self.cache_dir)
+
+        self.levels = [data]
+        while max(self.levels[-1].shape) > TILE_SIZE:
+            self.levels.append(_overview(self.levels[-1]))
+
+        # pixel size of the raster in degrees, following the linspace grid of set_raster_data_from_points
+        height, width = data.shape
+        self.lat_step = (self.bbox[1] - self.bbox[0]) / max(height - 1, 1)
+        self.lon_step = (self.bbox[3] - self.bbox[2]) / max(width - 1, 1)
+        self.max_native_zoom = int(np.clip(np.ceil(np.log2(360.0 / (TILE_SIZE * max(self.lon_step, 1e-12)))), 0, MAX_ZOOM))
+
+        self.empty_tile = palette_png(np.full((TILE_SIZE, TILE_SIZE), NAN_INDEX, dtype=np.uint8), self.lut)
+
+    def get_bounds(self) -> List[List[float]]:
+        return [[self.bbox[0], self.bbox[2]], [self.bbox[1], self.bbox[3]]]
+
+    def tile(self, z: int, x: int, y: int) -> bytes:
+        '''
+        PNG of a tile, rendered on first request and read from the cache directory afterwards.
+        '''
+        path = os.path.join(self.cache_dir, str(z), str(x), f'{y}.png')
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            pass
+
+        png = self._render(z, x, y)
+        if png is not self.empty_tile:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(png)
+            os.replace(tmp_path, path)
+            _tile_cache.added(os.path.dirname(self.cache_dir), len(png), keep=self.cache_dir)
+        return png
+
+    def _render(self, z: int, x: int, y: int) -> bytes:
+        latitudes, longitudes = tile_pixel_coordinates(z, x, y)
+
+        # nearest full resolution pixel of every tile row and column, row 0 being the max latitude
+        height, width = self.levels[0].shape
+        rows = np.round((self.bbox[1] - latitudes) / max(self.lat_step, 1e-12)).astype(np.int64)
+        cols = np.round((longitudes - self.bbox[2]) / max(self.lon_step, 1e-12)).astype(np.int64)
+        valid_rows = (rows >= 0) & (rows < height)
+        valid_cols = (cols >= 0) & (cols < width)
+        if not valid_rows.any() or not valid_cols.any():
+            return self.empty_tile
+
+        # coarsest level whose pixels are still no larger than the tile pixels
+        tile_step = 360.0 / (TILE_SIZE * (1 << z))
+        level = int(np.clip(np.floor(np.log2(max(tile_step / max(self.lon_step, 1e-12), 1.0))), 0, len(self.levels) - 1))
+        data = self.levels[level]
+        rows = np.minimum(np.clip(rows, 0, height - 1) >> level, data.shape[0] - 1)
+        cols = np.minimum(np.clip(cols, 0, width - 1) >> level, data.shape[1] - 1)
+
+        sample = data[np.ix_(rows, cols)]
+        sample[~valid_rows, :] = np.nan
+        sample[:, ~valid_cols] = np.nan
+        indices = quantize(sample, self.min, self.max)
+        if np.all(indices == NAN_INDEX):
+            return self.empty_tile
+        return palette_png(indices, self.lut)
+
+
+def _touch(cache_dir: str) -> None:
+    # the modification time of a pyramid directory is its last use, for eviction
+    try:
+        os.utime(cache_dir)
+    except OSError:
+        pass
+
+
+def _directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass # edge case: removed by another process
+    return total
+
+
+class _TileCache():
+    '''
+    Size of the tile cache directories, scanned once and then tracked as tiles are written, evicting whole pyramid
+    directories in least recently used order once over budget.
+    '''
+    def __init__(self, max_bytes: int = TILE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    def added(self, cache_dir: str, size: int, keep: str = None) -> int:
+        with self.lock:
+            if cache_dir not in self.sizes:
+                self.sizes[cache_dir] = _directory_size(cache_dir)
+            else:
+                self.sizes[cache_dir] += size
+            if self.sizes[cache_dir] <= self.max_bytes:
+                return 0
+            return self._evict(cache_dir, keep)
+
+    def _evict(self, cache_dir: str, keep: str) -> int:
+        pyramids = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if path != keep and os.path.isdir(path):
+                pyramids.append((os.stat(path).st_mtime, path))
+
+        # evicting down to 3/4 of the budget, so that eviction scans stay rare
+        total, evicted = _directory_size(cache_dir), 0
+        for _, path in sorted(pyramids):
+            if total <= self.max_bytes * 3 // 4:
+                break
+            size = _directory_size(path)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            evicted += 1
+        self.sizes[cache_dir] = total
+        return evicted
+
+
+_tile_cache = _TileCache()
+
+
+class _TileHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        match = _TILE_PATH.match(self.path)
+        pyramid = _pyramids.get(match.group(1)) if match else None
+        if pyramid is None:
+            self.send_error(404)
+            return
+
+        z, x, y = (int(v) for v in match.groups()[1:])
+        if z > MAX_ZOOM or x >= (1 << z) or y >= (1 << z):
+            self.send_error(404)
+            return
+
+        png = pyramid.tile(z, x, y)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(png)))
+        self.send_header('Cache-Control', 'public, max-age=86400')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(png)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_pyramids = OrderedDict()
+_server = None
+_lock = threading.Lock()
+
+
+def start_tile_server(host: str = os.environ.get('GEODE_TILE_HOST', '127.0.0.1'), port: int = int(os.environ.get('GEODE_TILE_PORT', 0))) -> str:
+    '''
+    Starts the tile endpoint in a background thread, once per process, and returns its base URL.
+    By default it is only reachable from the machine running the app, see the module docstring for remote browsers.
+    '''
+    global _server
+    with _lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _TileHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+        return os.environ.get('GEODE_TILE_URL', f'http://{host}:{_server.server_address[1]}').rstrip('/')
+
+
+@tracing.traced('render')
+def get_pyramid(patch: GeoPatch) -> RasterPyramid:
+    '''
+    Registers the tile pyramid of a patch with the tile endpoint, reusing it for identical rasters.
+    '''
+    key = patch.get_fingerprint()[:20]
+    with _lock:
+        if key in _pyramids:
+            _pyramids.move_to_end(key)
+            _touch(_pyramids[key].cache_dir)
+            return _pyramids[key]
+
+    pyramid = RasterPyramid(patch)
+    with _lock:
+        _pyramids[key] = pyramid
+        while len(_pyramids) > MAX_PYRAMIDS:
+            _pyramids.popitem(last=False)
+    return pyramid
+
+
+def tile_url(pyramid: RasterPyramid) -> str:
+    '''
+    XYZ URL template of a pyramid for folium.TileLayer.
+    '''
+    return f'{start_tile_server()}/{pyramid.id}/{{z}}/{{x}}/{{y}}.png'
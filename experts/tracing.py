@@ -0,0 +1,302 @@
+'''
+Per-query execution tracing: nested spans recording wall time, CPU time, bytes transferred, cache hits and array sizes,
+exported as JSON or in the Chrome trace format (chrome://tracing, Perfetto). Off unless GEODE_TRACE=1, in which case
+spans are only recorded within a trace started with start_trace.
+'''
+import os, html, json, time, threading, contextvars
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+
+_enabled = os.environ.get('GEODE_TRACE', '0') == '1'
+
+_current_span = contextvars.ContextVar('geode_span', default=None)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def set_enabled(enabled: bool) -> None:
+    global _enabled
+    _enabled = enabled
+
+
+class Span():
+    '''
+    Timed section of a trace with its nested spans.
+
+    Parameters
+    ----------
+        name (str): Name of the traced function or section.
+        category (str): Kind of work, e.g. 'llm', 'expert', 'render', 'compute', 'sandbox'.
+        attributes (Dict): Measurements and details of the span, e.g. cache hits and array sizes.
+    '''
+    def __init__(self, name: str, category: str, attributes: Dict = None):
+        self.name = name
+        self.category = category
+        self.attributes = attributes or {}
+        self.children = []
+        self.thread = threading.current_thread().name
+        self.pid = os.getpid()
+        self.start_ns = time.perf_counter_ns() # system-wide monotonic clock, comparable across processes
+        self.cpu_start_ns = time.thread_time_ns()
+        self.end_ns = None
+        self.cpu_ns = None
+
+    def finish(self) -> None:
+        self.end_ns = time.perf_counter_ns()
+        self.cpu_ns = time.thread_time_ns() - self.cpu_start_ns
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def add(self, key: str, amount: float) -> None:
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'category': self.category, 'attributes': self.attributes, 'thread': self.thread, 'pid': self.pid,
+                'start_ns': self.start_ns, 'end_ns': self.end_ns, 'cpu_ns': self.cpu_ns, 'children': [child.to_dict() for child in self.children]}
+
+    @staticmethod
+    def from_dict(data: Dict) -> 'Span':
+        span = Span.__new__(Span)
+        span.__dict__.update({key: value for key, value in data.items() if key != 'children'})
+        span.cpu_start_ns = None
+        span.children = [Span.from_dict(child) for child in data['children']]
+        return span
+
+
+class _NullSpan():
+    # stands in for spans while tracing is off, so instrumented code needs no checks
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def add(self, key: str, amount: float) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _ActiveSpan():
+    def __init__(self, span: Span, parent: Span):
+        self.span = span
+        self.parent = parent
+
+    def __enter__(self) -> Span:
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.finish()
+        if exc_type is not None:
+            self.span.set(error=exc_type.__name__)
+        _current_span.reset(self.token)
+        self.parent.children.append(self.span)
+        return False
+
+
+def span(name: str, category: str = 'function', **attributes):
+    '''
+    Context manager recording a span nested in the current one, a no-op outside traces or with tracing off.
+    '''
+    if not _enabled:
+        return _NULL_SPAN
+    parent = _current_span.get()
+    if parent is None:
+        return _NULL_SPAN
+    return _ActiveSpan(Span(name, category, attributes), parent)
+
+
+def current_span():
+    '''
+    Innermost span being recorded, or a no-op stand-in.
+    '''
+    current = _current_span.get() if _enabled else None
+    return _NULL_SPAN if current is None else current
+
+
+def annotate(**attributes) -> None:
+    current_span().set(**attributes)
+
+
+def add(key: str, amount: float) -> None:
+    current_span().add(key, amount)
+
+
+def record_response(response) -> None:
+    '''
+    Adds the sizes of an HTTP request and its response (requests library) to the current span.
+    '''
+    if not _enabled:
+        return
+    body = response.request.body if response.request is not None else None
+    add('bytes_sent', len(body) if body is not None else 0)
+    add('bytes_received', len(response.content))
+
+
+def array_size(value: Any) -> Dict:
+    '''
+    Shape and size of the array held by a value (GeoPatch raster or NumPy array), empty if none.
+    '''
+    raster_data = getattr(value, 'raster_data', None)
+    data = raster_data.get('data') if isinstance(raster_data, dict) else value
+    if isinstance(data, np.ndarray):
+        return {'shape': list(data.shape), 'nbytes': int(data.nbytes)}
+    return {}
+
+
+def traced(category: str = 'expert', name: str = None) -> Callable:
+    '''
+    Decorator recording every call of a function as a span, along with the array sizes of its output.
+
+    Parameters
+    ----------
+        category (str): Category of the spans.
+        name (str): Name of the spans, the function name if None.
+    '''
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled or _current_span.get() is None:
+                return func(*args, **kwargs)
+            with span(span_name, category) as s:
+                inputs = [array_size(arg) for arg in list(args) + list(kwargs.values())]
+                inputs = [size for size in inputs if size]
+                if inputs:
+                    s.set(input_arrays=inputs)
+                value = func(*args, **kwargs)
+                output = array_size(value)
+                if output:
+                    s.set(output_array=output)
+                return value
+        return wrapper
+    return decorator
+
+
+class Trace():
+    '''
+    Spans recorded while handling one query.
+
+    Parameters
+    ----------
+        name (str): Name of the trace, e.g. the query.
+    '''
+    def __init__(self, name: str):
+        self.name = name
+        self.root = Span(name, 'trace')
+
+    def spans(self) -> List[Dict]:
+        '''
+        Flattened spans in start order, with their depth and times in milliseconds relative to the trace start.
+        '''
+        rows = []
+        def visit(span: Span, depth: int):
+            end_ns = span.end_ns if span.end_ns is not None else time.perf_counter_ns()
+            rows.append({'name': span.name, 'category': span.category, 'depth': depth, 'thread': span.thread, 'pid': span.pid,
+                         'start_ms': (span.start_ns - self.root.start_ns) / 1e6, 'wall_ms': (end_ns - span.start_ns) / 1e6,
+                         'cpu_ms': span.cpu_ns / 1e6 if span.cpu_ns is not None else None, **span.attributes})
+            for child in sorted(span.children, key=lambda child: child.start_ns):
+                visit(child, depth + 1)
+        visit(self.root, 0)
+        return rows
+
+    def to_json(self) -> str:
+        return json.dumps(self.root.to_dict(), default=str)
+
+    def to_chrome_trace(self) -> str:
+        '''
+        Trace in the Chrome trace event format, one complete event per span.
+        '''
+        events, threads = [], {}
+        def visit(span: Span):
+            end_ns = span.end_ns if span.end_ns is not None else span.start_ns
+            tid = threads.setdefault((span.pid, span.thread), len(threads) + 1)
+            args = dict(span.attributes)
+            if span.cpu_ns is not None:
+                args['cpu_ms'] = span.cpu_ns / 1e6
+            events.append({'name': span.name, 'cat': span.category, 'ph': 'X', 'pid': span.pid, 'tid': tid,
+                           'ts': (span.start_ns - self.root.start_ns) / 1e3, 'dur': (end_ns - span.start_ns) / 1e3, 'args': args})
+            for child in span.children:
+                visit(child)
+        visit(self.root)
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread}} for (pid, thread), tid in threads.items()]
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}, default=str)
+
+    def waterfall_html(self) -> str:
+        '''
+        Spans as an HTML waterfall: one row per span, indented by depth, with a bar placed on the trace timeline.
+        '''
+        rows = self.spans()
+        total = max(max(row['start_ms'] + row['wall_ms'] for row in rows), 1e-3)
+        colors = {'trace': '#888', 'llm': '#8e6bd1', 'expert': '#3b82c4', 'render': '#d1853b', 'compute': '#4caf50', 'sandbox': '#607d8b', 'statement': '#9e9e9e', 'copy': '#c0504d'}
+        parts = ['<div style="font-family:monospace;font-size:11px;">']
+        for row in rows:
+            left, width = 100 * row['start_ms'] / total, max(100 * row['wall_ms'] / total, 0.2)
+            # names and attributes hold queries and program source, which must not be rendered as markup
+            details = html.escape(', '.join(f'{key}={value}' for key, value in row.items() if key not in ('name', 'category', 'depth', 'thread', 'pid', 'start_ms')), quote=True)
+            label = f"{'&nbsp;' * 2 * row['depth']}{html.escape(row['name'][:60], quote=True)}"
+            parts.append(
+                f'<div title="{details}" style="display:flex;align-items:center;height:16px;">'
+                f'<div style="width:35%;overflow:hidden;white-space:nowrap;">{label}</div>'
+                f'<div style="width:50%;position:relative;height:10px;background:#f3f3f3;">'
+                f'<div style="position:absolute;left:{left:.2f}%;width:{width:.2f}%;height:10px;background:{colors.get(row["category"], "#999")};"></div></div>'
+                f'<div style="width:15%;text-align:right;">{row["wall_ms"]:.1f} ms</div></div>'
+            )
+        parts.append('</div>')
+        return ''.join(parts)
+
+
+@contextmanager
+def start_trace(name: str):
+    '''
+    Records the spans of the enclosed code into a new Trace, yields None if tracing is off.
+    '''
+    if not _enabled:
+        yield None
+        return
+    trace = Trace(name)
+    token = _current_span.set(trace.root)
+    try:
+        yield trace
+    finally:
+        trace.root.finish()
+        _current_span.reset(token)
+
+
+def export_spans() -> List[Dict]:
+    '''
+    Spans nested in the current one as dicts, to send them to another process.
+    '''
+    current = current_span()
+    return [child.to_dict() for child in current.children] if isinstance(current, Span) else []
+
+
+def graft(spans: List[Dict]) -> None:
+    '''
+    Attaches spans recorded in another process (see export_spans) under the current span.
+    '''
+    current = current_span()
+    if isinstance(current, Span):
+        current.children += [Span.from_dict(data) for data in spans]
+
+
+def submit(executor, func: Callable, *args, **kwargs):
+    '''
+    executor.submit that runs func within the current trace context, which threads do not inherit.
+    '''
+    if not _enabled:
+        return executor.submit(func, *args, **kwargs)
+    return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
@@ -0,0 +1,134 @@
+'''
+Vector overlay engine over boundary polygons, using an STRtree to prune candidate pairs and prepared geometries
+'''
+import numpy as np
+import shapely
+from shapely import STRtree
+from shapely.geometry.base import BaseGeometry
+from shapely.geometry.polygon import Polygon
+from typing import List
+
+from .base import DataPoint
+
+
+OPERATIONS = ['intersection', 'union', 'difference', 'symmetric_difference']
+
+
+def as_parts(boundary: List[BaseGeometry]) -> np.ndarray:
+    '''
+    Flattens boundary geometries (polygons or multipolygons) into an array of non-empty polygons.
+    '''
+    if boundary is None or len(boundary) == 0:
+        return np.empty(0, dtype=object)
+    parts = shapely.get_parts(np.asarray(boundary, dtype=object))
+    parts = parts[shapely.get_type_id(parts) == 3] # polygons only
+    parts = parts[~shapely.is_empty(parts)]
+    # repairing self-intersections, common in geocoded boundaries
+    invalid = ~shapely.is_valid(parts)
+    if np.any(invalid):
+        parts[invalid] = shapely.make_valid(parts[invalid])
+        parts = shapely.get_parts(parts)
+        parts = parts[shapely.get_type_id(parts) == 3]
+    return parts
+
+
+def to_polygons(geometry: BaseGeometry) -> List[Polygon]:
+    '''
+    Splits an overlay result into its polygons, dropping lines and points left by touching borders.
+    '''
+    if geometry is None or geometry.is_empty:
+        return []
+    parts = shapely.get_parts(geometry)
+    return list(parts[(shapely.get_type_id(parts) == 3) & ~shapely.is_empty(parts)])
+
+
+def _candidate_pairs(parts1: np.ndarray, parts2: np.ndarray):
+    # bulk STRtree query, parts1 is prepared so the exact predicate runs on prepared geometries
+    shapely.prepare(parts1)
+    tree = STRtree(parts2)
+    idx1, idx2 = tree.query(parts1, predicate='intersects')
+    return idx1, idx2
+
+
+def _intersection(parts1: np.ndarray, parts2: np.ndarray) -> BaseGeometry:
+    idx1, idx2 = _candidate_pairs(parts1, parts2)
+    if len(idx1) == 0:
+        return shapely.Polygon()
+    pieces = shapely.intersection(parts1[idx1], parts2[idx2])
+    return shapely.union_all(pieces)
+
+
+def _difference(parts1: np.ndarray, parts2: np.ndarray) -> BaseGeometry:
+    idx1, idx2 = _candidate_pairs(parts1, parts2)
+    result = parts1.copy()
+    if len(idx1) > 0:
+        # subtracting from every part only the union of the parts it actually intersects
+        order = np.argsort(idx1, kind='stable')
+        idx1, idx2 = idx1[order], idx2[order]
+        starts = np.flatnonzero(np.r_[True, idx1[1:] != idx1[:-1]])
+        groups = np.split(idx2, starts[1:])
+        subtrahends = np.array([shapely.union_all(parts2[group]) for group in groups], dtype=object)
+        result[idx1[starts]] = shapely.difference(parts1[idx1[starts]], subtrahends)
+    return shapely.union_all(result)
+
+
+def overlay(boundary1: List[BaseGeometry], boundary2: List[BaseGeometry], operation: str = 'intersection') -> List[Polygon]:
+    '''
+    Performs an overlay operation across all polygons of two boundaries.
+
+    Parameters
+    ----------
+        boundary1 (List[BaseGeometry]): First boundary, list of polygons or multipolygons.
+        boundary2 (List[BaseGeometry]): Second boundary, list of polygons or multipolygons.
+        operation (str): Possible values: ['intersection', 'union', 'difference', 'symmetric_difference'].
+
+    Returns
+    -------
+        List[Polygon]: Polygons of the resulting boundary, empty if nothing remains.
+    '''
+    if operation not in OPERATIONS:
+        raise ValueError(f"Invalid operation. Operation must be one of {', '.join(OPERATIONS)}.")
+
+    parts1, parts2 = as_parts(boundary1), as_parts(boundary2)
+
+    if operation == 'intersection':
+        if len(parts1) == 0 or len(parts2) == 0:
+            return []
+        result = _intersection(parts1, parts2)
+    elif operation == 'union':
+        result = shapely.union_all(np.concatenate([parts1, parts2]))
+    elif operation == 'difference':
+        if len(parts1) == 0 or len(parts2) == 0:
+            return list(parts1)
+        result = _difference(parts1, parts2)
+    else:
+        if len(parts1) == 0 or len(parts2) == 0:
+            return list(np.concatenate([parts1, parts2]))
+        result = shapely.union(_difference(parts1, parts2), _difference(parts2, parts1))
+
+    return to_polygons(result)
+
+
+def filter_points(points: List[DataPoint], boundary: List[Polygon]) -> List[DataPoint]:
+    '''
+    Keeps the data points lying within the boundary, with a single vectorized containment test.
+    '''
+    if points is None or len(points) == 0 or boundary is None or len(boundary) == 0:
+        return []
+
+    geometry = shapely.union_all(np.asarray(boundary, dtype=object))
+    shapely.prepare(geometry)
+
+    # DataPoint stores (lat, lon) as (x, y), whereas boundary polygons are in (lon, lat)
+    lats = np.fromiter((point.point.x for point in points), dtype=np.float64, count=len(points))
+    lons = np.fromiter((point.point.y for point in points), dtype=np.float64, count=len(points))
+    inside = shapely.contains_xy(geometry, lons, lats)
+    return [point for point, keep in zip(points, inside) if keep]
+
+
+def boundary_bbox(boundary: List[Polygon]) -> List[float]:
+    '''
+    Bounding box of boundary polygons as [min_lat, max_lat, min_lon, max_lon].
+    '''
+    min_lon, min_lat, max_lon, max_lat = shapely.total_bounds(np.asarray(boundary, dtype=object))
+    return [float(min_lat), float(max_lat), float(min_lon), float(max_lon)]
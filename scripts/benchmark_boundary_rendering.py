@@ -0,0 +1,72 @@
+'''
+Benchmarks boundary rendering on synthetic archipelagos (Indonesia-like multipolygons), one GeoJson layer per polygon
+versus the single simplified FeatureCollection used by patch_visualization_expert.
+Run from the repository root: python scripts/benchmark_boundary_rendering.py
+'''
+import os, sys, time
+geode_dir = os.path.abspath(os.curdir)
+if geode_dir not in sys.path:
+    sys.path.append(geode_dir)
+
+import numpy as np
+import shapely
+import folium
+from experts.rendering import render_boundary, clear_overlays
+from experts.vector_overlay import boundary_bbox
+from experts.base import GeoPatch
+
+# (islands, vertices per island)
+SIZES = [(100, 500), (1000, 500), (5000, 200)]
+STYLE = {'fillColor': '#4254f5', 'color': '#4254f5'}
+
+
+def make_patch(islands: int, vertices: int, seed: int = 0) -> GeoPatch:
+    # islands with ragged coastlines scattered over 95E-141E, 11S-6N, mostly tiny ones as in real archipelagos
+    rng = np.random.default_rng(seed)
+    centers = np.column_stack((rng.uniform(95, 141, islands), rng.uniform(-11, 6, islands)))
+    radii = 0.5 * rng.pareto(2.0, islands) * 0.05 + 0.005
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+
+    polygons = []
+    for center, radius in zip(centers, radii):
+        r = radius * (1 + 0.15 * rng.standard_normal(vertices).cumsum() / np.sqrt(vertices))
+        r = np.clip(r, radius * 0.3, None)
+        polygons.append(shapely.Polygon(np.column_stack((center[0] + r * np.cos(angles), center[1] + r * np.sin(angles)))))
+
+    boundary = [shapely.MultiPolygon(polygons)]
+    return GeoPatch(vector_data={'location': [-2.5, 118.0], 'bbox': boundary_bbox(boundary), 'boundary': boundary})
+
+
+def per_polygon_layers(patch: GeoPatch) -> folium.Map:
+    # previous implementation, one GeoJson per polygon of the boundary
+    m = folium.Map()
+    boundary_fg = folium.FeatureGroup(name='Boundary')
+    for boundary in patch.vector_data['boundary']:
+        for polygon in shapely.get_parts(boundary):
+            folium.GeoJson(polygon.__geo_interface__, name='Boundary', style_function=lambda _: STYLE).add_to(boundary_fg)
+    boundary_fg.add_to(m)
+    return m
+
+
+def single_layer(patch: GeoPatch) -> folium.Map:
+    m = folium.Map()
+    boundary_fg = folium.FeatureGroup(name='Boundary')
+    folium.GeoJson(render_boundary(patch), name='Boundary', style_function=lambda _: STYLE).add_to(boundary_fg)
+    boundary_fg.add_to(m)
+    return m
+
+
+def timed_html(build, patch: GeoPatch):
+    start = time.perf_counter()
+    html = build(patch).get_root().render()
+    return time.perf_counter() - start, len(html)
+
+
+if __name__ == '__main__':
+    print(f"{'islands':>8} {'vertices':>9} {'layers time':>12} {'layers html':>12} {'single time':>12} {'single html':>12}")
+    for islands, vertices in SIZES:
+        patch = make_patch(islands, vertices)
+        clear_overlays()
+        old_time, old_size = timed_html(per_polygon_layers, patch)
+        new_time, new_size = timed_html(single_layer, patch)
+        print(f'{islands:>8} {islands * vertices:>9} {old_time:>11.3f}s {old_size / 1e6:>10.2f}MB {new_time:>11.3f}s {new_size / 1e6:>10.2f}MB')
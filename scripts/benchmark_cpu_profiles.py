@@ -0,0 +1,53 @@
+'''
+Benchmarks the CPU serving profiles of the local code generation model: startup time, peak memory,
+time-to-first-token and decode speed. Every profile runs in its own process so memory is measured in isolation.
+Run from the repository root: python scripts/benchmark_cpu_profiles.py [model name]
+'''
+import os, sys, json, time, resource, subprocess
+geode_dir = os.path.abspath(os.curdir)
+if geode_dir not in sys.path:
+    sys.path.append(geode_dir)
+
+PROFILES = [('float32', 'torch'), ('bfloat16', 'torch'), ('int8', 'torch'), ('float32', 'onnx')]
+QUERY = 'Show me the areas of Kenya with more than 60 percent humidity'
+NEW_TOKENS = 128
+
+
+def run_profile(name: str, dtype: str, backend: str) -> dict:
+    from codegen.generator import Generator
+
+    start = time.perf_counter()
+    generator = Generator(name=name, dtype=dtype, backend=backend)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    generator.generate(QUERY, max_new_tokens=1, do_sample=False)
+    ttft = time.perf_counter() - start
+
+    start = time.perf_counter()
+    completion = generator.generate(QUERY, max_new_tokens=NEW_TOKENS, min_new_tokens=NEW_TOKENS, do_sample=False)
+    decode_time = time.perf_counter() - start
+    tokens = len(generator.tokenizer(completion, add_special_tokens=False).input_ids)
+
+    return {
+        'load_time': load_time,
+        'peak_rss_gb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2, # ru_maxrss is in KB on linux
+        'ttft': ttft,
+        'tokens_per_sec': tokens / decode_time,
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        print(json.dumps(run_profile(*sys.argv[2:5])))
+        sys.exit(0)
+
+    name = sys.argv[1] if len(sys.argv) > 1 else 'WizardLM/WizardLM-13B-V1.2'
+    print(f"{'profile':>16} {'startup':>9} {'peak mem':>9} {'ttft':>8} {'tok/s':>7}")
+    for dtype, backend in PROFILES:
+        process = subprocess.run([sys.executable, __file__, '--run', name, dtype, backend], capture_output=True, text=True)
+        if process.returncode != 0:
+            print(f"{f'{backend}/{dtype}':>16} failed: {process.stderr.strip().splitlines()[-1] if process.stderr.strip() else process.returncode}")
+            continue
+        stats = json.loads(process.stdout.strip().splitlines()[-1])
+        print(f"{f'{backend}/{dtype}':>16} {stats['load_time']:>8.1f}s {stats['peak_rss_gb']:>7.1f}GB {stats['ttft']:>7.2f}s {stats['tokens_per_sec']:>7.2f}")
@@ -0,0 +1,44 @@
+'''
+Benchmarks time-to-first-token of the local code generation model with and without the prompt prefix cache.
+Run from the repository root: python scripts/benchmark_generator.py [model name]
+'''
+import os, sys, time
+geode_dir = os.path.abspath(os.curdir)
+if geode_dir not in sys.path:
+    sys.path.append(geode_dir)
+
+from codegen.generator import Generator
+
+QUERIES = [
+    'Where is Paris?',
+    'Show me the areas of Kenya with more than 60 percent humidity',
+    'Which regions of California are both hot and dry right now?',
+]
+REPEATS = 3
+
+
+def time_to_first_token(generator: Generator, query: str) -> float:
+    start = time.perf_counter()
+    generator.generate(query, max_new_tokens=1, do_sample=False)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    kwargs = {'name': sys.argv[1]} if len(sys.argv) > 1 else {}
+
+    start = time.perf_counter()
+    generator = Generator(prefix_cache=False, **kwargs)
+    print(f'model load: {time.perf_counter() - start:.1f}s')
+
+    start = time.perf_counter()
+    generator.build_prefix_cache()
+    print(f'prefix prefill ({generator.prefix_ids.shape[1]} tokens, once at startup): {time.perf_counter() - start:.2f}s')
+    cache = generator.prefix_cache
+
+    print(f"{'query':>64} {'no cache':>10} {'cache':>10}")
+    for query in QUERIES:
+        generator.prefix_cache = None
+        uncached = min(time_to_first_token(generator, query) for _ in range(REPEATS))
+        generator.prefix_cache = cache
+        cached = min(time_to_first_token(generator, query) for _ in range(REPEATS))
+        print(f'{query[:64]:>64} {uncached:>9.2f}s {cached:>9.2f}s')
@@ -0,0 +1,57 @@
+'''
+Benchmarks the imputation_expert modes against the previous griddata based nearest fill.
+Run from the repository root: python scripts/benchmark_imputation.py
+'''
+import os, sys, time
+geode_dir = os.path.abspath(os.curdir)
+if geode_dir not in sys.path:
+    sys.path.append(geode_dir)
+
+import numpy as np
+from scipy.interpolate import griddata
+from experts.base import GeoPatch, RasterType
+from experts.cache import expert_cache
+from experts.functional_experts import imputation_expert
+
+SIZES = [100, 1000, 4000]
+MODES = ['nearest', 'linear', 'inpaint']
+GRIDDATA_MAX_SIZE = 1000 # griddata takes minutes beyond this
+
+
+def make_patch(size: int, missing: float = 0.3, seed: int = 0) -> GeoPatch:
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    data = (np.sin(8 * x) + np.cos(6 * y)).astype(np.float32)
+
+    # scattered missing pixels plus one large hole
+    data[rng.random(data.shape) < missing] = np.nan
+    data[size // 4: size // 2, size // 3: 2 * size // 3] = np.nan
+
+    return GeoPatch(raster_data={'name': 'benchmark', 'type': RasterType.non_color, 'colormap': 'gray', 'data': data},
+                    vector_data={'location': [0.0, 0.0], 'bbox': [0.0, 1.0, 0.0, 1.0]})
+
+
+def griddata_nearest(data: np.ndarray) -> np.ndarray:
+    # previous implementation of imputation_expert
+    mask = ~np.isnan(data)
+    x, y = np.meshgrid(np.arange(data.shape[1]), np.arange(data.shape[0]))
+    imputed = np.copy(data)
+    imputed[~mask] = griddata(np.column_stack((x[mask], y[mask])), data[mask], np.column_stack((x[~mask], y[~mask])), method='nearest')
+    return imputed
+
+
+def timed(func, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    expert_cache.enabled = False
+
+    print(f"{'size':>10} {'griddata':>10} " + ' '.join(f'{mode:>10}' for mode in MODES))
+    for size in SIZES:
+        patch = make_patch(size)
+        baseline = f"{timed(griddata_nearest, patch.raster_data['data']):.3f}s" if size <= GRIDDATA_MAX_SIZE else 'skipped'
+        times = [timed(imputation_expert, patch, mode=mode) for mode in MODES]
+        print(f"{f'{size}x{size}':>10} {baseline:>10} " + ' '.join(f'{t:>9.3f}s' for t in times))
@@ -0,0 +1,55 @@
+'''
+Compares the full API spec prompt with retrieval-pruned prompts: prompt size for sample queries, and with --live the
+end-to-end latency of code_gen_expert against a hosted model (needs the API keys in .env).
+Run from the repository root: python scripts/benchmark_spec_retrieval.py [--live claude-3-opus|gpt-3.5-turbo]
+'''
+import os, re, sys, time
+geode_dir = os.path.abspath(os.curdir)
+if geode_dir not in sys.path:
+    sys.path.append(geode_dir)
+
+from experts.retrieval import SpecRetriever, DEFAULT_TOP_K
+
+QUERIES = [
+    'Where is Paris?',
+    'Which one of the following countries is larger, Russia or Greenland?',
+    'What is air quality like in the city that is known for the Eiffel tower?',
+    'Which state in the United states has the highest average humidity?',
+    'Show me the areas of Kenya with more than 60 percent humidity',
+    'Which regions of California are both hot and dry right now?',
+    'Which cities are within 50 km of Lyon?',
+    'Is rainfall related to humidity in Spain?',
+]
+
+
+def approximate_tokens(text: str) -> int:
+    # words, numbers and punctuation marks, close to the token counts of LLaMA and GPT tokenizers on code and prose
+    return len(re.findall(r'[A-Za-z]+|\d|[^\sA-Za-z\d]', text))
+
+
+if __name__ == '__main__':
+    retriever = SpecRetriever()
+    with open('codegen/base_prompt.txt', 'r') as f:
+        template = f.read()
+
+    total_full, total_pruned = 0, 0
+    print(f"{'query':>72} {'full':>7} {'pruned':>7}  experts")
+    for query in QUERIES:
+        full = approximate_tokens(template.replace('QUERY_TAG', query))
+        pruned = approximate_tokens(retriever.get_prompt(query))
+        total_full, total_pruned = total_full + full, total_pruned + pruned
+        experts = [name.replace('_expert', '') for name in retriever.select(query)]
+        print(f"{query[:72]:>72} {full:>7} {pruned:>7}  {', '.join(experts)}")
+    print(f"{'total':>72} {total_full:>7} {total_pruned:>7}  ({1 - total_pruned / total_full:.0%} fewer prompt tokens)")
+
+    if '--live' in sys.argv:
+        from experts.functional_experts import code_gen_expert
+        model = sys.argv[sys.argv.index('--live') + 1]
+        print(f"\n{'query':>72} {'full':>8} {'pruned':>8}")
+        for query in QUERIES:
+            latencies = []
+            for spec_top_k in (None, DEFAULT_TOP_K):
+                start = time.perf_counter()
+                code_gen_expert(query, model=model, spec_top_k=spec_top_k)
+                latencies.append(time.perf_counter() - start)
+            print(f'{query[:72]:>72} {latencies[0]:>7.2f}s {latencies[1]:>7.2f}s')
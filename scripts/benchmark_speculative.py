@@ -0,0 +1,41 @@
+'''
+Benchmarks speculative decoding of the local code generation model with a small draft model:
+tokens/sec with and without the draft, and the estimated acceptance rate of drafted tokens.
+Run from the repository root: python scripts/benchmark_speculative.py [draft model name]
+'''
+import os, sys
+geode_dir = os.path.abspath(os.curdir)
+if geode_dir not in sys.path:
+    sys.path.append(geode_dir)
+
+from codegen.generator import Generator
+
+QUERIES = [
+    'Where is Paris?',
+    'Show me the areas of Kenya with more than 60 percent humidity',
+    'Which regions of California are both hot and dry right now?',
+    'Which is larger, Russia or Greenland?',
+]
+NEW_TOKENS = 256
+
+
+def decode(generator: Generator) -> dict:
+    generator.generate(QUERIES[0], max_new_tokens=8) # warm up
+    generator.decode_stats = {'tokens': 0, 'time': 0.0, 'model_forwards': 0, 'draft_forwards': 0}
+    for query in QUERIES:
+        generator.generate(query, max_new_tokens=NEW_TOKENS, do_sample=False)
+    return generator.get_decode_stats()
+
+
+if __name__ == '__main__':
+    draft_name = sys.argv[1] if len(sys.argv) > 1 else 'mtgv/MobileLLaMA-1.4B-Chat'
+
+    # both runs without the prefix cache, which speculative decoding does not use, so only decoding differs
+    baseline = decode(Generator(prefix_cache=False, draft_name=None))
+    print(f"model alone: {baseline['tokens_per_sec']:.2f} tokens/s")
+
+    speculative = decode(Generator(prefix_cache=False, draft_name=draft_name))
+    print(f"with {draft_name}: {speculative['tokens_per_sec']:.2f} tokens/s "
+          f"({speculative['tokens_per_sec'] / max(baseline['tokens_per_sec'], 1e-9):.2f}x), "
+          f"acceptance rate {speculative['acceptance_rate']:.1%}, "
+          f"{speculative['tokens_per_model_forward']:.2f} tokens per model forward")
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the app runs from the repository root with app/ on the path (see app/sandbox.py)
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (root, os.path.join(root, 'app')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
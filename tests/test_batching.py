@@ -0,0 +1,83 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import pytest
+
+from codegen.batching import BatchQueue, QueueFull
+
+
+class Model():
+    # records how many calls run at once
+    def __init__(self, delay: float = 0.05):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = self.most_active = 0
+        self.batches = []
+
+    def enter(self):
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+    def generate_batch(self, prompts):
+        self.enter()
+        time.sleep(self.delay)
+        self.batches.append(list(prompts))
+        self.leave()
+        return [prompt.upper() for prompt in prompts]
+
+    def generate_stream(self, prompt):
+        self.enter()
+        try:
+            for word in prompt.split():
+                time.sleep(self.delay / 5)
+                yield word
+            if prompt == 'fail':
+                raise RuntimeError('decoding failed')
+        finally:
+            self.leave()
+
+
+def test_requests_are_batched():
+    model = Model()
+    batch_queue = BatchQueue(model.generate_batch, max_batch_size=4, max_wait=0.1)
+    with ThreadPoolExecutor(4) as pool:
+        outputs = list(pool.map(batch_queue.generate, ['a', 'b', 'c', 'd']))
+    assert outputs == ['A', 'B', 'C', 'D']
+    assert sorted(map(len, model.batches)) == [4]
+
+
+def test_streams_wait_in_the_queue_and_run_alone():
+    model = Model()
+    batch_queue = BatchQueue(model.generate_batch, max_batch_size=4, max_wait=0.1, generate_stream=model.generate_stream)
+    with ThreadPoolExecutor(4) as pool:
+        batched = [pool.submit(batch_queue.generate, prompt) for prompt in ('a', 'b')]
+        streamed = pool.submit(lambda: list(batch_queue.stream('x y z')))
+        batched += [pool.submit(batch_queue.generate, prompt) for prompt in ('c', 'd')]
+        assert streamed.result() == ['x', 'y', 'z']
+        assert [future.result() for future in batched] == ['A', 'B', 'C', 'D']
+    assert model.most_active == 1
+
+    with pytest.raises(RuntimeError):
+        list(batch_queue.stream('fail'))
+
+
+def test_streams_are_rejected_when_the_queue_is_full():
+    model = Model(delay=0.5)
+    batch_queue = BatchQueue(model.generate_batch, max_batch_size=1, max_wait=0.0, max_queue=1,
+                             generate_stream=model.generate_stream)
+    batch_queue.submit('running')
+    time.sleep(0.1)
+    batch_queue.submit('waiting')
+    with pytest.raises(QueueFull):
+        batch_queue.stream('x')
+
+    # a stream not started within the timeout is dropped from the queue
+    time.sleep(0.5)
+    with pytest.raises(TimeoutError):
+        batch_queue.stream('x', timeout=0.1)
@@ -0,0 +1,151 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from experts import cache
+from experts.base import GeoPatch, PatchType, RasterType
+from experts.cache import CacheEntry, DiskBackend, MemoryBackend, cached_expert, clear_cache, get_cache_stats
+
+
+def make_patch(data):
+    return GeoPatch(type=PatchType.raster_only,
+                    raster_data={'name': 'test', 'type': RasterType.non_color, 'colormap': 'Blues', 'data': data},
+                    vector_data={'location': [0.0, 0.0], 'bbox': [0.0, 1.0, 0.0, 1.0]})
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache():
+    clear_cache(reset_stats=True)
+    yield
+    clear_cache(reset_stats=True)
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(max_bytes=250)
+    for key in 'abc':
+        backend.put(key, CacheEntry(key, 100, 0.0))
+    assert list(backend.entries) == ['b', 'c']
+
+    backend.get('b')
+    assert backend.put('d', CacheEntry('d', 100, 0.0)) == 1
+    assert list(backend.entries) == ['b', 'd']
+    assert backend.used_bytes == 200
+
+
+def test_hits_are_keyed_on_bound_arguments():
+    calls = []
+
+    @cached_expert()
+    def scale_expert(patch: GeoPatch, factor: float = 2.0) -> GeoPatch:
+        calls.append(factor)
+        return make_patch(patch.raster_data['data'] * factor)
+
+    patch = make_patch(np.arange(6, dtype=float).reshape(2, 3))
+    first = scale_expert(patch)
+    second = scale_expert(patch, factor=2.0)
+    scale_expert(make_patch(np.zeros((2, 3))))
+
+    assert calls == [2.0, 2.0]
+    np.testing.assert_array_equal(first.raster_data['data'], second.raster_data['data'])
+    stats = get_cache_stats('scale_expert')
+    assert (stats['hits'], stats['misses']) == (1, 2)
+
+
+def test_returned_arrays_are_shared_read_only():
+    @cached_expert()
+    def ones_expert(n: int) -> GeoPatch:
+        return make_patch(np.ones((n, n)))
+
+    first, second = ones_expert(3), ones_expert(3)
+    assert first is not second
+    assert first.raster_data['data'] is second.raster_data['data']
+    with pytest.raises(ValueError):
+        first.raster_data['data'][0, 0] = 5.0
+
+    # containers are copies, so changing them does not reach the cache
+    first.raster_data['name'] = 'changed'
+    assert ones_expert(3).raster_data['name'] == 'test'
+
+
+def test_arguments_returned_unchanged_stay_writeable():
+    @cached_expert()
+    def identity_expert(patch: GeoPatch) -> GeoPatch:
+        return patch
+
+    data = np.ones((3, 3))
+    patch = make_patch(data)
+    result = identity_expert(patch)
+    assert result is not patch and not result.raster_data['data'].flags.writeable
+
+    # the caller's patch is untouched and later writes to it do not reach the cached value
+    assert patch.raster_data['data'] is data and data.flags.writeable
+    data[0, 0] = 5.0
+    assert identity_expert(make_patch(np.ones((3, 3)))).raster_data['data'][0, 0] == 1.0
+
+
+def test_failed_calls_are_not_cached():
+    calls = []
+
+    @cached_expert()
+    def flaky_expert(name: str):
+        calls.append(name)
+        return None
+
+    flaky_expert('x')
+    flaky_expert('x')
+    assert len(calls) == 2
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+    calls = []
+
+    @cached_expert(ttl=60)
+    def weather_expert(name: str) -> float:
+        calls.append(name)
+        return 20.0
+
+    weather_expert('Paris')
+    now[0] += 30
+    weather_expert('Paris')
+    now[0] += 60
+    weather_expert('Paris')
+
+    assert len(calls) == 2
+    assert get_cache_stats('weather_expert')['expirations'] == 1
+
+
+def test_disk_backend_evicts_unreadable_entries(tmp_path):
+    backend = DiskBackend(cache_dir=str(tmp_path))
+    backend.put('good', CacheEntry([1, 2], 64, 0.5))
+    assert backend.get('good').value == [1, 2]
+
+    # truncated pickle, and a pickle referencing a class which no longer exists
+    (tmp_path / 'truncated.pkl').write_bytes(pickle.dumps(CacheEntry([1, 2], 64, 0.5))[:10])
+    (tmp_path / 'stale.pkl').write_bytes(b'\x80\x04\x95\x1a\x00\x00\x00\x00\x00\x00\x00\x8c\x0eexperts.cache\x94\x8c\x07Missing\x94\x93\x94.')
+    for key in ('truncated', 'stale'):
+        assert backend.get(key) is None
+        assert not os.path.exists(backend._path(key))
+
+
+def test_fingerprint_follows_raster_content():
+    data = np.ones((4, 4))
+    patch = make_patch(data)
+    before = patch.get_fingerprint()
+    data[0, 0] = 2.0
+    assert patch.get_fingerprint() != before
+
+    # read-only rasters are hashed once
+    patch = make_patch(data)
+    cache.freeze(patch)
+    frozen = patch.get_fingerprint()
+    assert patch._raster_hash['data'] is data
+    assert patch.get_fingerprint() == frozen
+
+    # and copies sharing it share the hash
+    first, second = cache.shared_copy(patch), cache.shared_copy(patch)
+    first.get_fingerprint()
+    assert second._raster_hash is first._raster_hash
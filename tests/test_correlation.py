@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from scipy.stats import spearmanr
+
+from experts.base import GeoPatch, RasterType
+from experts.functional_experts import correlation_matrix_expert
+
+
+def make_patch(data):
+    return GeoPatch(raster_data={'name': 'test', 'type': RasterType.non_color, 'colormap': 'viridis', 'data': data},
+                    vector_data={'location': [0.0, 0.0], 'bbox': [0.0, 1.0, 0.0, 1.0]})
+
+
+def make_rasters(seed: int = 0):
+    rng = np.random.default_rng(seed)
+    base = rng.normal(size=(40, 50))
+    rasters = [base, base ** 3 + rng.normal(size=base.shape), np.exp(-base) + rng.normal(size=base.shape)]
+    return [raster.copy() for raster in rasters]
+
+
+def test_pearson_matches_numpy():
+    rasters = make_rasters()
+    expected = np.corrcoef([raster.ravel() for raster in rasters])
+    result = correlation_matrix_expert([make_patch(raster) for raster in rasters])
+    np.testing.assert_allclose(result, expected)
+
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_spearman_ranks_each_pair_over_shared_pixels(masked):
+    rasters = make_rasters(1)
+    if masked:
+        # non-overlapping holes, so each pair keeps a different set of pixels
+        rasters[0][:10] = np.nan
+        rasters[1][:, :10] = np.nan
+        rasters[2][-10:] = np.nan
+
+    result = correlation_matrix_expert([make_patch(raster) for raster in rasters], method='spearman')
+    for i, x in enumerate(rasters):
+        for j, y in enumerate(rasters):
+            expected = spearmanr(x.ravel(), y.ravel(), nan_policy='omit').statistic
+            assert result[i, j] == pytest.approx(expected)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import Polygon
+
+from experts.base import GeoPatch, PatchType
+from experts.grid import CellUnion, cover, decode, encode, point_cells, quadkey
+
+
+def square(lon: float, lat: float, size: float) -> Polygon:
+    return Polygon([(lon, lat), (lon + size, lat), (lon + size, lat + size), (lon, lat + size)])
+
+
+def make_patch(boundary):
+    min_lon, min_lat, max_lon, max_lat = shapely.union_all(boundary).bounds
+    return GeoPatch(type=PatchType.vector_only, raster_data=None,
+                    vector_data={'location': [min_lat, min_lon], 'bbox': [min_lat, max_lat, min_lon, max_lon], 'boundary': boundary})
+
+
+def test_codes_round_trip():
+    x, y = np.array([0, 5, 1023, 12345]), np.array([0, 7, 1, 54321])
+    dx, dy = decode(encode(x, y))
+    np.testing.assert_array_equal(dx, x)
+    np.testing.assert_array_equal(dy, y)
+    assert quadkey(2, int(encode(np.array([1]), np.array([1]))[0])) == '03'
+
+
+def test_cell_unions_merge_and_intersect():
+    a = CellUnion(np.array([10, 0, 5]), np.array([20, 5, 8]))
+    assert list(a.starts) == [0, 10] and list(a.ends) == [8, 20]
+
+    b = CellUnion(np.array([6, 30]), np.array([12, 40]))
+    assert a.intersects(b)
+    assert a.intersection(b) == CellUnion(np.array([6, 10]), np.array([8, 12]))
+    assert not a.intersects(CellUnion(np.array([20]), np.array([30])))
+    assert a.union(b).contains(a)
+    assert not a.contains(b)
+
+
+def test_cover_contains_the_geometry():
+    geometry = Polygon([(2.0, 48.0), (3.0, 48.2), (2.6, 49.1), (1.9, 48.8)])
+    cells = cover(geometry, level=10)
+    rng = np.random.default_rng(0)
+    lons, lats = rng.uniform(1.9, 3.0, 2000), rng.uniform(48.0, 49.1, 2000)
+    inside = shapely.contains_xy(geometry, lons, lats)
+    assert cells.contains_points(lats[inside], lons[inside]).all()
+
+    # the cover is compact, and its area close to the geometry's at a fine level
+    assert len(cells) < 4096
+    exact = cells.area_km2()
+    assert cover(geometry, level=14).area_km2() < exact
+
+
+def test_point_cells_match_covers():
+    cells = CellUnion.from_cells(8, point_cells(np.array([48.85]), np.array([2.35]), 8))
+    assert cells.contains_points(np.array([48.85]), np.array([2.35])).all()
+    assert not cells.contains_points(np.array([40.0]), np.array([2.35])).any()
+
+
+def test_patch_caches_follow_boundary_content():
+    patch = make_patch([square(2.0, 48.0, 1.0)])
+    first = patch.get_cell_cover(12)
+    assert patch.get_cell_cover(12) is first
+
+    # a new list of the same length and bbox, e.g. after the previous list was freed and its id reused
+    patch.vector_data['boundary'] = [Polygon([(2.0, 48.0), (3.0, 48.0), (3.0, 49.0)])]
+    assert patch.get_cell_cover(12) != first
+
+    # identical boundaries share digests, and fingerprints
+    other = make_patch([square(2.0, 48.0, 1.0)])
+    assert other.get_boundary_digest() == make_patch([square(2.0, 48.0, 1.0)]).get_boundary_digest()
+    assert other.get_fingerprint() != patch.get_fingerprint()
+
+
+def test_overlaps_uses_cell_covers():
+    paris = make_patch([square(2.0, 48.0, 1.0)])
+    assert paris.overlaps(make_patch([square(2.5, 48.5, 1.0)]))
+    assert not paris.overlaps(make_patch([square(10.0, 40.0, 1.0)]))
@@ -0,0 +1,55 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from experts.base import GeoPatch, RasterType
+from experts.functional_experts import _impute_inpaint, imputation_expert
+
+
+def make_raster(size: int = 120, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    data = np.sin(6 * x) + np.cos(4 * y)
+    data[rng.random(data.shape) < 0.2] = np.nan
+    data[size // 4: size // 2, size // 4: 3 * size // 4] = np.nan
+    return data
+
+
+@pytest.mark.parametrize('mode', ['nearest', 'linear', 'inpaint'])
+def test_imputation_fills_every_missing_pixel(mode):
+    data = make_raster()
+    patch = GeoPatch(raster_data={'name': 'test', 'type': RasterType.non_color, 'colormap': 'gray', 'data': data},
+                     vector_data={'location': [0.0, 0.0], 'bbox': [0.0, 1.0, 0.0, 1.0]})
+    imputed = imputation_expert(patch, mode=mode).raster_data['data']
+
+    assert not np.isnan(imputed).any()
+    known = ~np.isnan(data)
+    np.testing.assert_array_equal(imputed[known], data[known])
+
+
+def test_inpainting_is_harmonic():
+    # a linear ramp is harmonic, so inpainting holes away from the edges recovers it exactly
+    data = np.add.outer(np.arange(40.0), 2 * np.arange(50.0))
+    holed = data.copy()
+    holed[5:30, 10:45] = np.nan
+    holed[7:35:7, 3:48:3] = np.nan
+    np.testing.assert_allclose(_impute_inpaint(holed, ~np.isnan(holed)), data, atol=1e-8)
+
+
+def test_large_regions_are_solved_in_tiles():
+    data = make_raster()
+    mask = ~np.isnan(data)
+    exact = _impute_inpaint(data, mask)
+    tiled = _impute_inpaint(data, mask, tile=24, halo=8)
+    assert not np.isnan(tiled).any()
+    assert np.abs(exact - tiled).mean() < 1e-2
+
+
+def test_unconverged_solves_warn():
+    data = make_raster()
+    with pytest.warns(RuntimeWarning, match='did not converge'):
+        _impute_inpaint(data, ~np.isnan(data), direct_limit=0, maxiter=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        _impute_inpaint(data, ~np.isnan(data))
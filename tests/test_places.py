@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from experts.places import PlaceIndex, chord_to_km, get_place_index, km_to_chord, to_unit_vectors
+from experts import places
+
+
+@pytest.fixture
+def index():
+    # Paris, Lyon, Marseille, London and a small town near Paris
+    return PlaceIndex(names=['Paris', 'Lyon', 'Marseille', 'London', 'Versailles'],
+                      lats=[48.8566, 45.7640, 43.2965, 51.5074, 48.8049],
+                      lons=[2.3522, 4.8357, 5.3698, -0.1278, 2.1204],
+                      population=[2_100_000, 510_000, 860_000, 8_900_000, 85_000],
+                      feature_codes=['PPLC', 'PPLA', 'PPLA', 'PPLC', 'PPLA2'],
+                      country_codes=['FR', 'FR', 'FR', 'GB', 'FR'],
+                      alternate_names=[['Lutece'], [], [], ['Londres'], []])
+
+
+def test_chord_and_km_round_trip():
+    for km in (0.0, 1.0, 500.0, 10000.0):
+        assert chord_to_km(km_to_chord(km)) == pytest.approx(km)
+    xyz = to_unit_vectors(np.array([48.8566, 51.5074]), np.array([2.3522, -0.1278]))
+    assert chord_to_km(np.linalg.norm(xyz[0] - xyz[1])) == pytest.approx(344, abs=2)
+
+
+def test_nearest_excludes_the_place_itself(index):
+    paris = index.find('lutece')
+    nearest = index.nearest(48.8566, 2.3522, count=2, exclude=paris)
+    assert [index.names[i] for i, _ in nearest] == ['Versailles', 'London']
+    assert nearest[0][1] == pytest.approx(17.7, abs=0.5)
+
+
+def test_levels_and_radius(index):
+    capitals = index.nearest(45.7640, 4.8357, count=5, level='capital')
+    assert [index.names[i] for i, _ in capitals] == ['Paris', 'London']
+    assert [index.names[i] for i, _ in index.within(48.8566, 2.3522, radius_km=360)] == ['Paris', 'Versailles', 'London']
+    assert index.nearest(48.8566, 2.3522, count=10, radius_km=100, min_population=100_000) == [(0, 0.0)]
+
+
+def test_nearest_rejects_empty_counts(index):
+    with pytest.raises(ValueError):
+        index.nearest(48.8566, 2.3522, count=0)
+
+
+def test_download_can_be_disabled(tmp_path, monkeypatch):
+    monkeypatch.setattr(places, 'DOWNLOAD_ENABLED', False)
+    monkeypatch.setattr(places, '_index', None)
+    with pytest.raises(FileNotFoundError, match='GEODE_PLACES_DOWNLOAD'):
+        get_place_index(str(tmp_path / 'missing.txt'))
@@ -0,0 +1,136 @@
+import time
+
+import numpy as np
+import pytest
+
+from planner import ProgramPlan, SessionMemo, execute_program
+
+
+class Patch():
+    def __init__(self, data):
+        self.raster_data = {'data': data}
+
+    def get_raster_data(self):
+        return self.raster_data
+
+
+def slow(value, seconds=0.2):
+    time.sleep(seconds)
+    return value
+
+
+def make_namespace():
+    return {'Patch': Patch, 'slow': slow, 'np': np,
+            'total_expert': lambda patch: float(patch.get_raster_data()['data'].sum())}
+
+
+def sequential(code: str):
+    namespace = make_namespace()
+    exec(code, namespace)
+    return namespace['result']
+
+
+def test_independent_statements_run_concurrently():
+    code = '''def compute_answer(query):
+    a = slow(1)
+    b = slow(2)
+    c = slow(3)
+    return a + b + c, query
+result = compute_answer('q')
+'''
+    start = time.perf_counter()
+    result, timings = execute_program(code, make_namespace())
+    assert result == (6, 'q')
+    assert time.perf_counter() - start < 0.5
+    assert [timing['dependencies'] for timing in timings] == [[], [], [], [0, 1, 2]]
+
+
+def test_mutations_through_aliases_are_ordered():
+    code = '''def compute_answer(query):
+    patch = Patch(np.ones(4))
+    raster = patch.get_raster_data()
+    raster['data'][:] *= slow(10)
+    total = total_expert(patch)
+    return total, None
+result = compute_answer('q')
+'''
+    assert execute_program(code, make_namespace())[0] == sequential(code) == (40.0, None)
+
+
+def test_method_calls_and_rebinding_follow_sequential_order():
+    code = '''def compute_answer(query):
+    points = []
+    alias = points
+    alias.append(slow(1))
+    count = len(points)
+    points = [1, 2, 3]
+    return count, len(points)
+result = compute_answer('q')
+'''
+    assert execute_program(code, make_namespace())[0] == sequential(code) == (1, 3)
+
+
+def test_first_failing_statement_is_raised():
+    code = '''def compute_answer(query):
+    a = slow(1, 0.1) / 0
+    b = undefined_name
+    return a, b
+result = compute_answer('q')
+'''
+    with pytest.raises(ZeroDivisionError):
+        execute_program(code, make_namespace())
+
+
+def test_unsupported_programs_run_with_exec():
+    code = "result = slow('plain', 0), None\n"
+    assert execute_program(code, make_namespace()) == (('plain', None), [])
+    with pytest.raises(Exception):
+        ProgramPlan("def compute_answer(query):\n    if query:\n        return 1\n    return 2\nresult = compute_answer('q')\n")
+
+
+def test_memoized_results_are_not_changed_by_programs():
+    calls = []
+    def totals_expert(name):
+        calls.append(name)
+        return {'inner': {'total': 6, 'values': np.arange(3)}}
+    totals_expert.cache_policy = {'ttl': None, 'backend': 'memory'}
+
+    code = '''def compute_answer(query):
+    data = totals_expert(query)
+    inner = data['inner']
+    inner['total'] = inner['total'] * 10
+    return inner['total'], inner['values'].flags.writeable
+result = compute_answer('q')
+'''
+    memo = SessionMemo()
+    results = [execute_program(code, {'totals_expert': totals_expert}, memo=memo)[0] for _ in range(3)]
+    assert results == [(60, False)] * 3
+    assert calls == ['q'] and memo.hits == 2
+
+
+def test_memo_keys_do_not_survive_mutations_through_aliases():
+    def humidity_expert(name):
+        return {'data': np.ones(3)}
+    def total_expert(patch):
+        return float(patch['data'].sum())
+    humidity_expert.cache_policy = total_expert.cache_policy = {'ttl': None, 'backend': 'memory'}
+    namespace = {'humidity_expert': humidity_expert, 'total_expert': total_expert}
+
+    memo = SessionMemo()
+    first = '''def compute_answer(query):
+    h = humidity_expert(query)
+    t = total_expert(h)
+    return t, None
+result = compute_answer('q')
+'''
+    second = '''def compute_answer(query):
+    h = humidity_expert(query)
+    d = h
+    d['data'] = d['data'] * 100
+    t = total_expert(h)
+    return t, None
+result = compute_answer('q')
+'''
+    assert execute_program(first, dict(namespace), memo=memo)[0] == (3.0, None)
+    assert execute_program(second, dict(namespace), memo=memo)[0] == (300.0, None)
+    assert memo.hits == 1
@@ -0,0 +1,78 @@
+import ast
+import os
+
+import pytest
+
+from codegen.query_cache import QueryCache, extract_entities, normalize
+
+
+SPEC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'codegen', 'base_prompt.txt')
+
+PROGRAM = '''def compute_answer(query):
+    patch = precipitation_expert(patch_location_expert('Paris'))
+    return f"Rain in Paris for {query}", patch
+result = compute_answer("rain in Paris")
+'''
+
+
+@pytest.fixture
+def query_cache(tmp_path):
+    return QueryCache(path=str(tmp_path / 'cache.json'), spec_path=SPEC_PATH)
+
+
+def test_extract_entities():
+    assert extract_entities('What is the rainfall in New York and "Rio de Janeiro"?') == ['Rio de Janeiro', 'New York']
+    assert normalize('Show me the rain in Paris', ['Paris']) == ['rain', '<e0>']
+
+
+def test_bound_values_are_escaped(query_cache):
+    query_cache.put('rain in Paris', PROGRAM)
+    query = 'rain in "Côte d\'Ivoire"'
+    code = query_cache.get(query)
+    namespace = {'patch_location_expert': lambda place: place, 'precipitation_expert': lambda patch: patch}
+    exec(code, namespace)
+    assert namespace['result'] == (f"Rain in Côte d'Ivoire for {query}", "Côte d'Ivoire")
+
+    code = QueryCache.bind(QueryCache.templatize(PROGRAM, 'rain in Paris', ['Paris'])[0], 'rain in X', ['a\\\\b"\n{c}'])
+    namespace = {'patch_location_expert': lambda place: place, 'precipitation_expert': lambda patch: patch}
+    exec(code, namespace)
+    assert namespace['result'] == ('Rain in a\\\\b"\n{c} for rain in X', 'a\\\\b"\n{c}')
+
+
+def test_identifiers_are_not_rewritten():
+    code = "points = [DataPoint('Data', data) for data in []]\n"
+    template, rebindable = QueryCache.templatize(code, 'Data here', ['Data'])
+    assert rebindable
+    assert QueryCache.bind(template, 'Lyon here', ['Lyon']) == "points = [DataPoint('Lyon', data) for data in []]\n"
+
+
+def test_programs_missing_an_entity_are_not_rebound(query_cache):
+    code = "result = compute_answer(patch_location_expert('Paris'))\n"
+    query_cache.put('rain at the Eiffel Tower', code)
+    assert query_cache.get('rain at the Eiffel Tower') == code
+    assert query_cache.get('rain at the Space Needle') is None
+
+
+def test_reordered_queries_do_not_collide(query_cache):
+    query_cache.put('temperature above 30 and humidity below 60 in Paris', PROGRAM)
+    assert query_cache.get('humidity above 30 and temperature below 60 in Paris') is None
+    assert query_cache.get('temperature above 30 and humidity below 60 in Lyon') is not None
+
+
+def test_reworded_queries_hit(query_cache):
+    query_cache.put('air quality in Paris', PROGRAM)
+    assert query_cache.get('Paris air quality') is not None
+    assert query_cache.get('air quality in London') is not None
+    assert query_cache.stats['hits'] == 2
+
+    query_cache.put('temperature above 30 in Paris', PROGRAM)
+    assert query_cache.get('Lyon temperature above 30') is not None
+    assert query_cache.get('above 30 temperature in Lyon') is None
+
+
+def test_entries_persist(query_cache, tmp_path):
+    query_cache.put('rain in Paris', PROGRAM)
+    reloaded = QueryCache(path=str(tmp_path / 'cache.json'), spec_path=SPEC_PATH)
+    assert ast.dump(ast.parse(reloaded.get('rain in Paris'))) == ast.dump(ast.parse(PROGRAM))
+    reloaded.remove('rain in Paris')
+    assert reloaded.get('rain in Paris') is None
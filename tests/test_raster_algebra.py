@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from experts.raster_algebra import RasterExpression, evaluate_expression, expression_names
+
+
+@pytest.fixture
+def rasters():
+    rng = np.random.default_rng(0)
+    humidity = rng.random((37, 23))
+    precipitation = rng.random((37, 23)).astype(np.float32)
+    humidity[rng.random(humidity.shape) < 0.1] = np.nan
+    return {'humidity': humidity, 'precipitation': precipitation}
+
+
+@pytest.mark.parametrize('chunk_pixels', [1, 50, 1 << 18])
+def test_arithmetic_matches_numpy(rasters, chunk_pixels):
+    h, p = rasters['humidity'], rasters['precipitation']
+    result = evaluate_expression('sqrt(abs(humidity - precipitation)) * 2 + maximum(humidity, precipitation) ** 2', rasters, chunk_pixels)
+    np.testing.assert_allclose(result, np.sqrt(np.abs(h - p)) * 2 + np.fmax(h, p) ** 2, rtol=1e-6)
+
+
+def test_conditions_and_nan_comparisons(rasters):
+    h, p = rasters['humidity'], rasters['precipitation']
+    result = evaluate_expression('(humidity > 0.4) & (precipitation < 0.5) | (humidity != humidity)', rasters, chunk_pixels=64)
+    assert result.dtype == bool
+    np.testing.assert_array_equal(result, ((h > 0.4) & (p < 0.5)))
+    np.testing.assert_array_equal(evaluate_expression('0.2 < humidity <= 0.6', rasters), (h > 0.2) & (h <= 0.6))
+
+
+def test_reductions_are_global(rasters):
+    h = rasters['humidity']
+    result = evaluate_expression('humidity > rel(humidity, 0.4)', rasters, chunk_pixels=10)
+    np.testing.assert_array_equal(result, h > np.nanmin(h) + 0.4 * (np.nanmax(h) - np.nanmin(h)))
+    result = evaluate_expression('(humidity - mean(humidity)) / std(humidity)', rasters, chunk_pixels=10)
+    np.testing.assert_allclose(result, (h - np.nanmean(h)) / np.nanstd(h))
+
+
+def test_std_of_values_far_from_zero(rasters):
+    # small deviations around a large offset, where sums of squares lose every significant digit
+    h = rasters['humidity'] + 1e8
+    result = evaluate_expression('elevation * 0 + std(elevation)', {'elevation': h}, chunk_pixels=10)
+    np.testing.assert_allclose(result[~np.isnan(h)], np.nanstd(h), rtol=1e-6)
+
+
+def test_threshold_matches_threshold_expert_semantics(rasters):
+    p = rasters['precipitation']
+    relative = p.min() + 0.6 * (p.max() - p.min())
+    np.testing.assert_array_equal(evaluate_expression('threshold(precipitation, 0.6)', rasters), p > relative)
+    np.testing.assert_array_equal(evaluate_expression("threshold(precipitation, 0.3, mode='less', relative=False)", rasters), p < 0.3)
+
+
+def test_float32_rasters_stay_float32(rasters):
+    assert evaluate_expression('precipitation * 2 + rel(precipitation, 0.5)', rasters).dtype == np.float32
+
+
+@pytest.mark.parametrize('expression', ['humidity.sum()', '__import__("os")', 'humidity[0]', 'lambda: 1', 'humidity @ precipitation', 'humidity +'])
+def test_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        RasterExpression(expression)
+
+
+def test_unknown_and_misaligned_rasters(rasters):
+    assert expression_names('humidity * wind') == ['humidity', 'wind']
+    with pytest.raises(ValueError):
+        evaluate_expression('humidity * wind', rasters)
+    with pytest.raises(ValueError):
+        evaluate_expression('humidity * precipitation', {'humidity': np.zeros((2, 2)), 'precipitation': np.zeros((3, 2))})
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from shapely.geometry import Polygon
+
+from experts.base import GeoPatch, RasterType, summarize_raster
+
+
+QUANTILES = (0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 1.0)
+
+
+def make_patch(data, boundary=None):
+    vector_data = {'location': [0.0, 0.0], 'bbox': [0.0, 1.0, 0.0, 1.0]}
+    if boundary is not None:
+        vector_data['boundary'] = boundary
+    return GeoPatch(raster_data={'name': 'test', 'type': RasterType.non_color, 'colormap': 'gray', 'data': data},
+                    vector_data=vector_data)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_summary_matches_numpy(dtype):
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(300, 400)).astype(dtype)
+    data[rng.random(data.shape) < 0.3] = np.nan
+    values = data[~np.isnan(data)].astype(np.float64)
+
+    summary = summarize_raster(data, bins=7, quantiles=QUANTILES, chunk_pixels=1000)
+    assert summary['count'] == values.size
+    assert summary['mean'] == pytest.approx(values.mean())
+    assert summary['variance'] == pytest.approx(values.var())
+    assert (summary['min'], summary['max']) == (values.min(), values.max())
+    counts, edges = np.histogram(values, bins=7, range=(values.min(), values.max()))
+    np.testing.assert_array_equal(summary['histogram'][0], counts)
+    np.testing.assert_allclose(summary['histogram'][1], edges)
+    for q in QUANTILES:
+        assert summary['quantiles'][q] == np.quantile(values, q)
+
+
+def test_quantiles_of_skewed_and_binary_rasters():
+    # most values in a single fine bin, so the search narrows over several rounds
+    rng = np.random.default_rng(1)
+    skewed = np.concatenate([np.zeros(5000), rng.random(20) * 1e-12, [1e9]]).reshape(1, -1)
+    binary = (rng.random((100, 100)) > 0.5) * 255.0
+    for data in (skewed, binary):
+        summary = summarize_raster(data, quantiles=QUANTILES, chunk_pixels=50)
+        for q in QUANTILES:
+            assert summary['quantiles'][q] == np.quantile(data, q)
+
+
+def test_empty_and_constant_rasters():
+    summary = summarize_raster(np.full((4, 4), np.nan))
+    assert summary['count'] == 0 and np.isnan(summary['mean'])
+    assert all(np.isnan(v) for v in summary['quantiles'].values())
+
+    summary = summarize_raster(np.full((4, 4), 3.0))
+    assert summary['variance'] == 0.0 and summary['quantiles'] == {0.25: 3.0, 0.5: 3.0, 0.75: 3.0}
+
+
+def test_infinite_values_are_ignored():
+    # e.g. the result of a division by zero in raster algebra
+    data = np.array([[1.0, np.inf, 2.0], [-np.inf, np.nan, 3.0]])
+    summary = summarize_raster(data, bins=2, quantiles=[0.5])
+    assert summary['count'] == 3
+    assert (summary['mean'], summary['min'], summary['max']) == (2.0, 1.0, 3.0)
+    np.testing.assert_array_equal(summary['histogram'][0], [1, 2])
+    assert summary['quantiles'] == {0.5: 2.0}
+    assert make_patch(data).get_mean() == 2.0
+
+
+def test_invalid_quantiles():
+    with pytest.raises(ValueError):
+        summarize_raster(np.zeros((2, 2)), quantiles=[1.5])
+
+
+def test_in_place_writes_invalidate_the_cached_summary():
+    patch = make_patch(np.ones((10, 10)))
+    assert patch.get_mean() == 1.0
+    patch.raster_data['data'][:] *= 10
+    assert patch.get_mean() == 10.0
+    patch.set_raster_data({**patch.raster_data, 'data': np.full((10, 10), 2.0)})
+    assert patch.get_mean() == 2.0
+
+
+def test_summary_within_boundary():
+    data = np.zeros((10, 10))
+    data[:, :5] = 1.0 # western half
+    patch = make_patch(data, boundary=[Polygon([(0, 0), (0.5, 0), (0.5, 1), (0, 1)])])
+    assert patch.get_mean() == 0.5
+    assert patch.get_mean(within_boundary=True) == 1.0
+    assert patch.get_count(within_boundary=True) == patch.get_boundary_mask().sum() < 100
@@ -0,0 +1,71 @@
+import time
+
+import pytest
+
+import sandbox
+from sandbox import ExecutionPool
+
+
+def program(body: str) -> str:
+    return 'def compute_answer(query):\n' + ''.join(f'    {line}\n' for line in body.splitlines()) + "result = compute_answer('query')\n"
+
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = ExecutionPool(num_workers=1, timeout=5, cpu_seconds=1, memory_bytes=256 << 20, modules=[])
+    yield pool
+    pool.close()
+
+
+def test_runs_programs(pool):
+    answer, patch, error_text, timings = pool.execute(program("a = 1\nb = 2\nreturn f'{query} {a + b}', None"))
+    assert (answer, patch, error_text) == ('query 3', None, None)
+    assert len(timings) == 3
+
+
+def test_reports_errors(pool):
+    answer, patch, error_text, _ = pool.execute(program("return 1 / 0, None"))
+    assert answer is None and 'ZeroDivisionError' in error_text
+
+
+def test_cpu_limit_cannot_be_caught_by_programs(pool):
+    code = 'while True:\n    try:\n        sum(range(10 ** 6))\n    except Exception:\n        pass\nresult = None, None\n'
+    _, _, error_text, _ = pool.execute(code)
+    assert 'CPUTimeExceeded' in error_text
+    # the worker survives and runs the next program
+    assert pool.execute(program("return 'ok', None"))[0] == 'ok'
+
+
+def test_memory_limit(pool):
+    _, _, error_text, _ = pool.execute(program("data = bytearray(1 << 30)\nreturn 'allocated', None"))
+    assert 'MemoryError' in error_text
+    assert pool.execute(program("data = bytearray(1 << 20)\nreturn len(data), None"))[0] == 1 << 20
+
+
+def test_timeout_replaces_the_worker(pool):
+    worker = pool.workers[0]
+    _, _, error_text, _ = pool.execute("import time\ntime.sleep(60)\nresult = None, None\n")
+    assert error_text.startswith('TimeoutError')
+    assert pool.workers[0] is not worker
+    assert pool.execute(program("return 'ok', None"))[0] == 'ok'
+
+
+def test_cpu_limit_of_planned_programs_replaces_the_worker(pool):
+    worker = pool.workers[0]
+    start = time.perf_counter()
+    _, _, error_text, _ = pool.execute(program('a = 1\nwhile True:\n    a += 1'))
+    assert 'CPUTimeExceeded' in error_text
+    assert time.perf_counter() - start < 4 # not the wall-clock timeout
+    assert pool.workers[0] is not worker
+    assert pool.execute(program("return 'ok', None"))[0] == 'ok'
+
+
+def test_session_affinity_is_bounded(monkeypatch):
+    monkeypatch.setattr(sandbox, 'SESSIONS_PER_WORKER', 2)
+    pool = ExecutionPool(num_workers=1, timeout=5, cpu_seconds=1, memory_bytes=0, modules=[])
+    try:
+        for session in ['a', 'b', 'c', 'b']:
+            assert pool.execute(program("return 'ok', None"), session=session)[0] == 'ok'
+        assert list(pool.affinity) == ['c', 'b']
+    finally:
+        pool.close()
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+
+from experts import tiles
+from experts.base import GeoPatch, RasterType
+from experts.tiles import RasterPyramid, _overview, _TileCache
+
+
+def make_patch(data, bbox=(40.0, 50.0, 0.0, 10.0)):
+    return GeoPatch(raster_data={'name': 'test', 'type': RasterType.non_color, 'colormap': 'viridis', 'data': data},
+                    vector_data={'location': [bbox[0], bbox[2]], 'bbox': list(bbox)})
+
+
+def test_overview_ignores_nan():
+    data = np.array([[1.0, np.nan, 2.0], [3.0, np.nan, np.nan]])
+    np.testing.assert_array_equal(_overview(data), [[2.0, 2.0]])
+
+
+def test_tiles_are_cached_and_empty_tiles_are_not_written(tmp_path):
+    rng = np.random.default_rng(0)
+    pyramid = RasterPyramid(make_patch(rng.random((600, 600))), cache_dir=str(tmp_path))
+    assert len(pyramid.levels) == 3
+
+    # zoom 4 tile 8/5 covers the raster, tile 0/0 is far from it
+    png = pyramid.tile(4, 8, 5)
+    assert png.startswith(b'\x89PNG') and png is not pyramid.empty_tile
+    assert os.path.exists(os.path.join(pyramid.cache_dir, '4', '8', '5.png'))
+    assert pyramid.tile(4, 8, 5) == png
+    assert pyramid.tile(4, 0, 0) is pyramid.empty_tile
+    assert not os.path.exists(os.path.join(pyramid.cache_dir, '4', '0'))
+
+
+def test_least_recently_used_pyramids_are_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(tiles, '_tile_cache', _TileCache(max_bytes=1))
+    rng = np.random.default_rng(1)
+    old = RasterPyramid(make_patch(rng.random((300, 300))), cache_dir=str(tmp_path))
+    old.tile(4, 8, 5)
+    os.utime(old.cache_dir, (0, 0))
+
+    new = RasterPyramid(make_patch(rng.random((300, 300))), cache_dir=str(tmp_path))
+    new.tile(4, 8, 5)
+    # the pyramid being written is kept even over budget
+    assert not os.path.exists(old.cache_dir)
+    assert os.path.exists(os.path.join(new.cache_dir, '4', '8', '5.png'))
+
+    # evicted tiles are rendered again on request
+    assert old.tile(4, 8, 5).startswith(b'\x89PNG')
@@ -0,0 +1,65 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from experts import tracing
+
+
+@pytest.fixture
+def enabled():
+    was_enabled = tracing.is_enabled()
+    tracing.set_enabled(True)
+    yield
+    tracing.set_enabled(was_enabled)
+
+
+@tracing.traced('expert')
+def double_expert(data):
+    return data * 2
+
+
+def test_disabled_tracing_records_nothing():
+    tracing.set_enabled(False)
+    with tracing.start_trace('query') as trace:
+        assert trace is None
+        assert double_expert(1) == 2
+
+
+def test_spans_nest_across_threads(enabled):
+    with tracing.start_trace('query') as trace:
+        with tracing.span('outer', 'compute') as outer:
+            outer.set(cache='hit')
+            double_expert(np.zeros((2, 3)))
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                tracing.submit(executor, double_expert, np.zeros(4)).result()
+
+    rows = trace.spans()
+    assert [(row['name'], row['depth']) for row in rows] == [('query', 0), ('outer', 1), ('double_expert', 2), ('double_expert', 2)]
+    assert rows[1]['cache'] == 'hit'
+    assert rows[2]['output_array'] == {'shape': [2, 3], 'nbytes': 48}
+
+    events = json.loads(trace.to_chrome_trace())['traceEvents']
+    assert sum(event['ph'] == 'X' for event in events) == 4
+    assert json.loads(trace.to_json())['name'] == 'query'
+
+
+def test_spans_are_grafted_from_other_processes(enabled):
+    with tracing.start_trace('worker'):
+        with tracing.span('statement', 'statement'):
+            pass
+        spans = tracing.export_spans()
+    with tracing.start_trace('query') as trace:
+        tracing.graft(json.loads(json.dumps(spans)))
+    assert [row['name'] for row in trace.spans()] == ['query', 'statement']
+
+
+def test_waterfall_escapes_names_and_details(enabled):
+    with tracing.start_trace('<script>alert(1)</script>') as trace:
+        with tracing.span('x = "a" & b', 'statement') as s:
+            s.set(line='" onmouseover="alert(1)')
+    page = trace.waterfall_html()
+    assert '<script>' not in page and '&lt;script&gt;' in page
+    assert '" onmouseover' not in page and '&quot; onmouseover=&quot;' in page
+    assert 'x = &quot;a&quot; &amp; b' in page
@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+from codegen.validation import CodeValidator
+
+
+SPEC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'codegen', 'base_prompt.txt')
+
+VALID = '''def compute_answer(query):
+    patch = threshold_expert(precipitation_expert(patch_location_expert(query)), threshold=0.6)
+    return f"Rain in {query}", patch
+result = compute_answer('Kenya')
+'''
+
+
+@pytest.fixture(scope='module')
+def validator():
+    return CodeValidator(prompt_path=SPEC_PATH, known_names=['st'])
+
+
+def test_valid_program(validator):
+    assert validator.validate(VALID) == []
+
+
+@pytest.mark.parametrize('code, problem', [
+    (None, 'no code was generated'),
+    ('   ', 'no code was generated'),
+    ('def compute_answer(query):\n    return (', 'syntax error'),
+    ("result = patch_location_expert('Kenya')\n", 'compute_answer is not defined'),
+    ('def compute_answer(query):\n    return None\n', 'result is not assigned'),
+    (VALID.replace('threshold_expert(', 'thresholding_expert('), 'unknown function thresholding_expert()'),
+    (VALID.replace('threshold=0.6', 'level=0.6'), "unexpected keyword argument 'level'"),
+    (VALID.replace('patch_location_expert(query)', 'patch_location_expert()'), 'missing required arguments'),
+])
+def test_problems(validator, code, problem):
+    problems = validator.validate(code)
+    assert any(problem in p for p in problems), problems
+
+
+def test_names_bound_by_the_program_are_known(validator):
+    code = VALID.replace('    return', '    helper = lambda patch: patch\n    import math\n    return helper(math.floor(1)),')
+    assert validator.validate(code) == []
+
+
+def test_rank_puts_valid_candidates_first(validator):
+    broken = VALID.replace('threshold_expert(', 'thresholding_expert(')
+    ranked = validator.rank([broken, None, VALID])
+    assert [code for code, _ in ranked] == [VALID, broken, None]
+    assert ranked[0][1] == [] and ranked[2][1] == ['no code was generated']
+    assert validator.rank([]) == []
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import MultiPolygon, Polygon
+
+from experts.base import DataPoint
+from experts.vector_overlay import as_parts, boundary_bbox, filter_points, overlay
+
+
+def square(lon: float, lat: float, size: float) -> Polygon:
+    return Polygon([(lon, lat), (lon + size, lat), (lon + size, lat + size), (lon, lat + size)])
+
+
+def grid(offset: float, count: int = 5):
+    return [square(offset + i, offset + j, 1.0) for i in range(count) for j in range(count)]
+
+
+@pytest.mark.parametrize('operation', ['intersection', 'union', 'difference', 'symmetric_difference'])
+def test_overlay_matches_shapely(operation):
+    boundary1, boundary2 = grid(0.0), grid(2.5) + [MultiPolygon([square(-3, -3, 1), square(10, 10, 1)])]
+    expected = getattr(shapely, operation)(shapely.union_all(boundary1), shapely.union_all(boundary2))
+    result = overlay(boundary1, boundary2, operation)
+    assert all(isinstance(polygon, Polygon) for polygon in result)
+    assert shapely.union_all(result).symmetric_difference(expected).area < 1e-9
+
+
+def test_touching_borders_leave_no_lines():
+    assert overlay([square(0, 0, 1)], [square(1, 0, 1)], 'intersection') == []
+
+
+def test_empty_boundaries():
+    boundary = [square(0, 0, 1)]
+    assert overlay(boundary, [], 'intersection') == []
+    assert overlay(boundary, [], 'difference') == boundary
+    assert overlay([], boundary, 'symmetric_difference') == boundary
+    with pytest.raises(ValueError):
+        overlay(boundary, boundary, 'xor')
+
+
+def test_invalid_polygons_are_repaired():
+    bowtie = Polygon([(0, 0), (2, 2), (2, 0), (0, 2)])
+    parts = as_parts([bowtie])
+    assert len(parts) == 2 and all(shapely.is_valid(parts))
+    assert sum(polygon.area for polygon in overlay([bowtie], [square(0, 0, 2)], 'intersection')) == pytest.approx(2.0)
+
+
+def test_filter_points_and_bbox():
+    # DataPoint holds (lat, lon), boundaries (lon, lat)
+    boundary = [square(10, 40, 1), square(20, 40, 1)]
+    points = [DataPoint(40.5, 10.5, 'a'), DataPoint(40.5, 15.0, 'b'), DataPoint(40.2, 20.8, 'c'), DataPoint(10.5, 40.5, 'd')]
+    assert [point.name for point in filter_points(points, boundary)] == ['a', 'c']
+    assert filter_points([], boundary) == [] and filter_points(points, []) == []
+    assert boundary_bbox(boundary) == [40.0, 41.0, 10.0, 21.0]